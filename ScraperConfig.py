@@ -3,5 +3,69 @@ Scraper configuration file
 """
 
 configuration = {
-    'database_name': 'productscraper.db'
+    'database_name': 'productscraper.db',
+    'config_poll_interval': 60,  # Seconds between checks of the database for new or disabled scrapers
+    'execution_mode': 'serial',  # 'serial' runs due scrapers one after another, 'threaded' uses a worker pool,
+    # 'asyncio' runs them all on one event loop with aiohttp and 'pipeline' splits each run into fetch, parse and
+    # store stages with parsing on a process pool
+    'max_workers': 8,  # Maximum number of scrapers running at once in threaded mode
+    'async_max_concurrency': 1000,  # Maximum number of fetches in flight at once in asyncio mode
+    'async_limit_per_host': 8,  # Maximum number of connections to any one host in asyncio mode
+    'http_pool_size': 10,  # Maximum number of keep-alive connections kept open to each host
+    'http_pool_idle_timeout': 300,  # Seconds a host can go unused before its connections are closed
+    'http2': False,  # Talk HTTP/2 to the sites supporting it so every scraper shares one connection to each, needs
+    # httpx installed with its http2 extra. Not used in asyncio mode
+    'accept_encoding': None,  # Content encodings asked for, None for every one the http client can decode with zstd
+    # and br preferred when their modules are installed, 'identity' to have pages sent uncompressed
+    # Requests allowed to each host, hosts not listed use 'default'. rate is requests started per second (None for no
+    # limit), burst the requests that can start at once and the requests in flight adapt between min_concurrency
+    # and max_concurrency, backing off when the host responds with 429 or 503 or slows down
+    'host_limits': {
+        'default': {'rate': 5.0, 'burst': 10, 'min_concurrency': 1, 'max_concurrency': 8},
+    },
+    # Timeouts, dropped connections and responses with one of retry_codes are retried up to retries times, after a
+    # random wait of up to backoff_base * 2 ** attempt seconds (capped at backoff_max) or the site's Retry-After.
+    # Retry-After waits longer than max_retry_after are not retried. Waits up to max_wait are waited out within the
+    # run, longer ones end the run and the scraper is run again once the wait is over
+    'retry': {'retries': 2, 'backoff_base': 1.0, 'backoff_max': 30.0, 'max_retry_after': 120.0,
+              'retry_codes': (429, 500, 502, 503, 504), 'max_wait': 5.0},
+    # Requests to a host fail straight away once failure_threshold requests in a row have failed, until a probe
+    # request is let through reset_timeout seconds later
+    'circuit_breaker': {'failure_threshold': 5, 'reset_timeout': 60.0},
+    'coalesce_requests': True,  # Scrapers requesting a url already being requested wait for that response
+    'response_cache_ttl': 60.0,  # Seconds a successful response is kept and handed to scrapers requesting the same
+    # url, 0 to not keep responses
+    'response_cache_max_bytes': 64 * 1024 * 1024,  # Most memory used by the kept responses, the least recently used
+    # are dropped first
+    'log_buffer_size': 100,  # Number of buffered scrapers_log rows that triggers a write to the database
+    'log_flush_interval': 5.0,  # Seconds buffered scrapers_log rows can wait before being written
+    'db_writer_thread': True,  # Apply all database writes from one writer thread in grouped transactions
+    'db_write_batch_size': 500,  # Maximum number of queued writes applied in one transaction
+    'parser_backend': 'lxml',  # 'lxml' for precompiled XPath extraction or 'bs4' for BeautifulSoup
+    'partial_parse': True,  # Only parse the parts of each page matched by the searches rule
+    'plan_cache_size': 1024,  # Compiled extraction plans kept, the least recently used are dropped past this
+    'stream_responses': False,  # Scan pages as they download and stop once the search results have arrived, only
+    # the part of the page read is stored in raw_data
+    'max_response_bytes': 5 * 1024 * 1024,  # Stop reading a streamed page once this many bytes have been received
+    'stream_chunk_size': 16384,  # Bytes read from a streamed page at a time
+    # Most pages of search results fetched per run by scrapers with a pagination rule. The first page gates the run,
+    # when it is unchanged the further pages are not fetched either
+    'max_pages': 10,
+    'pagination_workers': 8,  # Threads fetching further pages of search results at the same time
+    'pipeline_fetch_workers': 16,  # Fetch threads in pipeline mode
+    'pipeline_parse_workers': None,  # Parse processes in pipeline mode, None for one per core
+    'pipeline_queue_size': 64,  # Maximum runs waiting at each pipeline stage
+    'pipeline_store_batch': 50,  # Maximum finished runs stored together in pipeline mode
+    'distributed': False,  # Share the scrapers with factories in other processes or on other machines using the same
+    # database. Each factory claims due scrapers by taking a lease on them, so no scraper is run by two at once
+    'lease_seconds': 300.0,  # Seconds a claimed scraper's lease lasts before another factory can take it over
+    'lease_renew_interval': None,  # Seconds between renewals of the leases held, None for a third of lease_seconds
+    'claim_limit': None,  # Most scrapers a factory holds at once when distributed, None to match the execution mode
+    'claim_poll_interval': 5.0,  # Most seconds between checks for due scrapers when distributed
+    'metrics_port': None,  # Port the metrics are served on at /metrics in the Prometheus text format, None to not serve
+    'metrics_address': '127.0.0.1',  # Address the metrics are served on
+    'metrics_file': None,  # File the metrics are written to every metrics_dump_interval seconds, None to not write
+    'metrics_dump_interval': 15.0,  # Seconds between writes of the metrics file
+    'metrics_scraper_label': True,  # Label the stage timings with the scraper as well as the host, turn off to keep
+    # the number of metrics down when there are thousands of scrapers
 }
@@ -1,6 +1,13 @@
 # Imports
-from scraper import ScraperBot
-from datetime import datetime as dt
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Event
+from time import time
+from leases import LeaseManager
+from registry import ScraperRegistry
+from scraper import ScraperBot, load_configurations, iter_configurations
+from ScraperConfig import configuration
 
 
 class ScraperFactory:
@@ -16,8 +23,11 @@ class ScraperFactory:
         Sets in the DB the last time a scraper ran
 
     _update_scraper_list()
-        This gets a list from the DB of all enabled scrapers. If the scraper is already
-        in the internal scraper list then it is removed so it no longer runs
+        Reloads the scrapers whose configuration has changed since the last check. Disabled and
+        deleted scrapers are removed so they no longer run, changed ones have their new rules swapped in
+
+    _config_version()
+        Gets the current version of the scraper configuration from the DB
 
     _load_scrapers()
         Generates a new scraper object and adds it to the internal DB
@@ -25,50 +35,153 @@ class ScraperFactory:
     _getScrapers()
         Retrueves a list of all enabled scrapers from the DB
 
-    _addScrapers(scraper_id, scraper_obj)
+    _addScrapers(scraper_id, config)
         Adds a scraper to the internal scraper list
 
     _delScraper(scraper_id)
         Deletes a scraper from the internal scraper list
 
+    _schedule(scraper_id, due_at)
+        Places a scraper on the run queue to be run at the specified time
+
+    _pop_due(now)
+        Removes and yields the ids of all scrapers that are due to run
+
+    _claim_due(now)
+        Claims the scrapers that are due to run when sharing them with other factories
+
+    _next_wake(now)
+        Works out when the main loop next needs to wake up
+
+    _wait(now)
+        Sleeps until the next scraper is due, the config needs checking or we are woken up
+
+    _materialize(scraper_id)
+        Builds the scraper bot for a run
+
+    _dispatch(scraper_id)
+        Runs a due scraper, either straight away or by handing it to the worker pool
+
+    _collect_finished()
+        Gathers the results of scrapers that have finished running on the worker pool
+
+    _finish(scraper_id, scraper, num_found)
+        Reports on a finished scraper run and puts the scraper back on the run queue
+
+    wake(config_changed)
+        Interrupts the main loop sleep, optionally forcing a reload of the scraper list
+
+    stop()
+        Stops the main application loop
+
     run()
         Runs each scraper bot in turn and at specified intervals
     """
 
     # TODO: Add in logging to local log
 
+    bot_class = ScraperBot  # The class used to create each scraper bot
+
     def __init__(self, dbo):
         self.dbo = dbo  # DB Object
-        self.scrapers = {}  # List of active scrapers
+        self.scrapers = ScraperRegistry()  # The active scrapers, a bot is only built for each run
+        self._running = {}  # The ScraperEntry each running scraper's bot was built from
         self.app_loop = True  # The main application loop
 
+        # Run queue, a min-heap of (due_at, scraper_id). _due holds the current due time of each queued
+        # scraper so entries superseded by a reschedule or a delete can be skipped when popped
+        self._run_queue = []
+        self._due = {}
+        self._wakeup = Event()  # Set to interrupt the main loop sleep
+        self.config_poll_interval = configuration.get('config_poll_interval', 60)  # Seconds between list updates
+        self._next_config_poll = time() + self.config_poll_interval
+        self.config_version = None  # The version of the scraper configuration last loaded
+
+        # When distributed the scrapers are shared with factories in other processes. Each factory claims the due
+        # scrapers from the database rather than keeping its own run queue, up to claim_limit at a time
+        self.leases = None
+        self.claim_poll_interval = configuration.get('claim_poll_interval', 5.0)  # Most seconds between claims
+        self.claim_limit = configuration.get('claim_limit') or {
+            'threaded': configuration.get('max_workers', 8),
+            'pipeline': configuration.get('pipeline_fetch_workers', 16),
+            'asyncio': configuration.get('async_max_concurrency', 1000),
+        }.get(configuration.get('execution_mode', 'serial'), 1)
+        if configuration.get('distributed', False):
+            self.leases = LeaseManager(dbo, configuration.get('lease_seconds', 300.0),
+                                       configuration.get('lease_renew_interval')).start()
+
+        # In threaded mode due scrapers are handed to a worker pool, which caps how many run at once.
+        # Finished runs are passed back to the main loop through self._finished
+        self.execution_mode = configuration.get('execution_mode', 'serial')
+        self.executor = None
+        self.pipeline = None
+        self._finished = Queue()
+        if self.execution_mode == 'threaded':
+            self.executor = ThreadPoolExecutor(max_workers=configuration.get('max_workers', 8),
+                                               thread_name_prefix='scraper')
+        elif self.execution_mode == 'pipeline':
+            # Imported here so the process pool machinery is only loaded when it is used
+            from pipeline import ScrapePipeline
+            self.pipeline = ScrapePipeline(dbo, configuration.get('pipeline_fetch_workers', 16),
+                                           configuration.get('pipeline_parse_workers'),
+                                           configuration.get('pipeline_queue_size', 64),
+                                           configuration.get('pipeline_store_batch', 50),
+                                           configuration.get('parser_backend', 'lxml'),
+                                           configuration.get('partial_parse', True))
+
         # Get the list of active scrapers and add them to the list to be run later
         self._load_scrapers()
 
-        self.this_tick = dt.now()  # Records the current time in the main loop
-        self.last_tick = dt.now()  # Keeps track of the previous time in the main loop
-
     def _update_scraper_list(self):
         """
 
         Updates the internal list of scrapers, removes disabled scrapers and adds new ones if needed
 
+        Only the scrapers changed since the last update are loaded, nothing but the configuration version is read
+        when there have been no changes
+
         :return:
         """
-        scraper_sql = "SELECT id FROM scrapers"
-
-        # The following sql only extracts the enabled scrapers from the DB
-        scrapers_sql = "SELECT id, enabled from scrapers"
-        # Execute the query and return the list
-        scrapers = self.dbo.query(scrapers_sql)
+        # Read the version first, anything changed after this is picked up again on the next update
+        version = self._config_version()
+        if version is None or version == self.config_version:
+            return
+
+        print("ScraperFactory: Scraper configuration changed, reloading changed scrapers.")
+
+        changed = load_configurations(self.dbo, "s.config_version > ?", [self.config_version])
+        deleted_sql = "SELECT scraper_id FROM config_deletions WHERE version > ?"
+        deleted = self.dbo.query(deleted_sql, [self.config_version])
+        if changed is None or deleted is None:
+            return
+
+        for scraper_id, config in changed.items():
+            if config['enabled'] != 1:
+                self._delScraper(scraper_id)
+            elif scraper_id in self.scrapers:
+                entry = self.scrapers.reload(scraper_id, config)
+                # The run frequency may have changed, a running scraper is rescheduled once it finishes
+                if scraper_id in self._due:
+                    self._schedule(scraper_id, entry.next_run_at())
+            else:
+                self._addScraper(scraper_id, config)
+
+        for deletion in deleted:
+            if deletion[0] not in changed:
+                self._delScraper(deletion[0])
+
+        self.config_version = version
+
+    def _config_version(self):
+        """Gets the current version of the scraper configuration, which changes whenever a scraper or its rules do
+
+        :return: The version number, None if it could not be read
+        """
+        version_sql = "SELECT version FROM config_state WHERE id = 1"
+        for version in self.dbo.query(version_sql) or []:
+            return version[0]
 
-        # Now for each record returned, check if it is in the list already. If it is and it should
-        # disabled now, remove it from the list. Otherwise, add it to the list
-        for scraper in scrapers:
-            if scraper[0] in self.scrapers and scraper[1] == 0:
-                self._delScraper(scraper[0])
-            elif scraper[0] not in self.scrapers and scraper[1] == 1:
-                self._addScraper(scraper[0], ScraperBot(scraper[0], self.dbo))
+        return None
 
     def _load_scrapers(self):
         """
@@ -77,33 +190,31 @@ class ScraperFactory:
 
         :return:
         """
-        active_scrapers = self._getScrapers()
+        self.config_version = self._config_version()
 
-        if active_scrapers is not None:
-            for active_scraper in active_scrapers:
-                self._addScraper(active_scraper[0], ScraperBot(active_scraper[0], self.dbo))
+        for scraper_id, config in self._getScrapers():
+            self._addScraper(scraper_id, config)
 
     def _getScrapers(self):
-        """Gets a list of the currently active scrapers from the database
+        """Gets the configuration of the currently active scrapers from the database
 
-        :return: The resultset of the enabled scrapers from the database
+        :return: A generator of (scraper_id, configuration) for the enabled scrapers
         """
         print("ScraperFactory: Getting list of active scrapers.")
-        # The following sql only extracts the enabled scrapers from the DB
-        scraper_enabled_sql = "SELECT id from scrapers where enabled = 1"
-        # Execute the query and return the list
-        return self.dbo.query(scraper_enabled_sql)
+        # Load every enabled scraper along with its rules in one query, read a chunk at a time
+        return iter_configurations(self.dbo, "s.enabled = 1")
 
-    def _addScraper(self, scraper_id, scraper_obj):
+    def _addScraper(self, scraper_id, config):
         """Adds a scraper to the active scrapers list
 
-        :param scraper_id:   The ID to identify this scraper in the internal list
-        :param scraper_obj:  The scraper object to add to the list
+        :param scraper_id:  The ID to identify this scraper in the internal list
+        :param config:      The scraper's configuration from load_configurations
         """
         # Only add new scrapers to the list
         print("ScraperFactory: Adding scraper to internal list.")
         if scraper_id not in self.scrapers:
-            self.scrapers[scraper_id] = scraper_obj
+            entry = self.scrapers.add(scraper_id, config)
+            self._schedule(scraper_id, entry.next_run_at())
 
     def _delScraper(self, scraper_id):
         """Deletes a scraper from the internal scraper list
@@ -114,6 +225,211 @@ class ScraperFactory:
         print("ScraperFactory: Deleting scraper from internal list.")
         if scraper_id in self.scrapers:
             del (self.scrapers[scraper_id])
+            # Any queued entry for the scraper is now stale and will be skipped when popped
+            self._due.pop(scraper_id, None)
+
+    def _schedule(self, scraper_id, due_at):
+        """Adds a scraper to the run queue
+
+        :param scraper_id:  The ID of the scraper to run
+        :param due_at:      Timestamp of when the scraper should next run
+        :return: Nothing
+        """
+        # When distributed the database holds when each scraper is due
+        if self.leases is not None:
+            return
+
+        self._due[scraper_id] = due_at
+        heapq.heappush(self._run_queue, (due_at, scraper_id))
+
+        # Rebuild the queue once stale entries outnumber the live ones so it cannot grow unbounded
+        if len(self._run_queue) > 2 * len(self._due) + 64:
+            self._run_queue = [(due_at, idx) for idx, due_at in self._due.items()]
+            heapq.heapify(self._run_queue)
+
+    def _pop_due(self, now):
+        """Removes every scraper which is due to run from the run queue
+
+        :param now: The current timestamp
+        :return: A generator of the ids of the scrapers that are due
+        """
+        if self.leases is not None:
+            yield from self._claim_due(now)
+            return
+
+        while self._run_queue and self._run_queue[0][0] <= now:
+            due_at, scraper_id = heapq.heappop(self._run_queue)
+
+            # Skip entries for scrapers that have since been removed or rescheduled
+            if self._due.get(scraper_id) != due_at:
+                continue
+
+            del (self._due[scraper_id])
+            yield scraper_id
+
+    def _claim_due(self, now):
+        """Claims the scrapers which are due to run from the database, up to claim_limit running at once
+
+        :param now: The current timestamp
+        :return: A list of the ids of the scrapers claimed
+        """
+        claimed = []
+        for scraper_id in self.leases.claim(now, self.claim_limit - len(self.leases.held)):
+            if scraper_id in self.scrapers:
+                claimed.append(scraper_id)
+                continue
+
+            # Added since the scraper list was last updated, hand it back and update the list straight away
+            self.leases.release(scraper_id)
+            self._next_config_poll = 0
+
+        return claimed
+
+    def _next_wake(self, now):
+        """Works out when the main loop next needs to wake up
+
+        :param now: The current timestamp
+        :return: The timestamp to wake up at
+        """
+        wake_at = self._next_config_poll
+        if self._run_queue:
+            wake_at = min(wake_at, self._run_queue[0][0])
+
+        # Other factories change when scrapers are due, so check back at least every claim_poll_interval
+        if self.leases is not None:
+            wake_at = min(wake_at, now + self.claim_poll_interval)
+            next_claim_at = self.leases.next_claim_at(now) if len(self.leases.held) < self.claim_limit else None
+            if next_claim_at is not None:
+                wake_at = min(wake_at, next_claim_at)
+
+        # Buffered log rows must not wait past their flush interval while we sleep
+        log_flush_due_in = self.dbo.log_flush_due_in()
+        if log_flush_due_in is not None:
+            wake_at = min(wake_at, now + log_flush_due_in)
+
+        return wake_at
+
+    def _wait(self, now):
+        """Sleeps until the next scraper is due or the scraper list needs refreshing
+
+        :param now: The current timestamp
+        :return: Nothing
+        """
+        wake_at = self._next_wake(now)
+
+        if wake_at > now:
+            self._wakeup.wait(wake_at - now)
+        self._wakeup.clear()
+
+    def _materialize(self, scraper_id):
+        """Builds the scraper bot for a run of a scraper, the bot is dropped once the run has finished
+
+        :param scraper_id: The ID of the scraper to run
+        :return: The scraper bot
+        """
+        self._running[scraper_id] = self.scrapers[scraper_id]
+        return self.scrapers.materialize(scraper_id, self.bot_class, self.dbo)
+
+    def _dispatch(self, scraper_id):
+        """Runs a scraper that is due, straight away, on the worker pool or through the pipeline
+
+        :param scraper_id: The ID of the scraper to run
+        :return: Nothing
+        """
+        scraper = self._materialize(scraper_id)
+
+        print("Running scraper bot #{}".format(scraper_id))
+
+        if self.pipeline is not None:
+            future = self.pipeline.submit(scraper)
+        elif self.executor is not None:
+            future = self.executor.submit(scraper.run)
+        else:
+            # A failed run is reported the same way as one on the worker pool rather than stopping the main loop
+            try:
+                num_found = scraper.run()
+            except Exception as err:
+                print("Scraper bot #{} failed: {}".format(scraper_id, err))
+                num_found = 0
+            self._finish(scraper_id, scraper, num_found)
+            return
+
+        future.add_done_callback(lambda done: self._on_done(scraper_id, scraper, done))
+
+    def _on_done(self, scraper_id, scraper, future):
+        """Called on the worker or pipeline thread once a scraper has finished, hands the result back to the main loop
+
+        :param scraper_id:  The ID of the scraper that finished
+        :param scraper:     The scraper object that was run
+        :param future:      The finished future holding the result of the run
+        :return: Nothing
+        """
+        self._finished.put((scraper_id, scraper, future))
+        self._wakeup.set()
+
+    def _collect_finished(self):
+        """Gathers the results of all scrapers which have finished on the worker pool
+
+        :return: Nothing
+        """
+        while True:
+            try:
+                scraper_id, scraper, future = self._finished.get_nowait()
+            except Empty:
+                return
+
+            # A cancelled run raises CancelledError from result(), which is not an Exception
+            if future.cancelled():
+                print("Scraper bot #{} was cancelled.".format(scraper_id))
+                num_found = 0
+            else:
+                try:
+                    num_found = future.result()
+                except Exception as err:
+                    print("Scraper bot #{} failed: {}".format(scraper_id, err))
+                    num_found = 0
+
+            self._finish(scraper_id, scraper, num_found)
+
+    def _finish(self, scraper_id, scraper, num_found):
+        """Reports the outcome of a scraper run and queues the scrapers next run
+
+        :param scraper_id:  The ID of the scraper that finished
+        :param scraper:     The scraper object that was run
+        :param num_found:   The number of entries the scraper found
+        :return: Nothing
+        """
+        print("Scraper scraped {} entries from the specified url".format(num_found))
+        print("Last run: {}".format(scraper.last_run_at))
+
+        # Keep what the next run needs, the bot itself is not kept
+        entry = self.scrapers.finished(scraper_id, self._running.pop(scraper_id, None), scraper)
+
+        if self.leases is not None:
+            self.leases.release(scraper_id, entry.next_run_at() if entry is not None else None)
+            return
+
+        # Only requeue the scraper if it was not removed while it was running
+        if entry is not None:
+            self._schedule(scraper_id, entry.next_run_at())
+
+    def wake(self, config_changed=False):
+        """Wakes the main loop up early
+
+        :param config_changed: Reload the scraper list from the database straight away
+        :return: Nothing
+        """
+        if config_changed:
+            self._next_config_poll = 0
+        self._wakeup.set()
+
+    def stop(self):
+        """Stops the main loop after any scraper currently running has finished
+
+        :return: Nothing
+        """
+        self.app_loop = False
+        self._wakeup.set()
 
     def run(self):
         """
@@ -127,17 +443,31 @@ class ScraperFactory:
 
         while self.app_loop:
 
+            now = time()
+
             # Update internal list of scrapers
-            self._update_scraper_list()
+            if now >= self._next_config_poll:
+                self._update_scraper_list()
+                self._next_config_poll = now + self.config_poll_interval
+
+            # Only run the scrapers whose run frequency has been exceeded
+            for idx in self._pop_due(now):
+                self._dispatch(idx)
+
+            self._collect_finished()
+
+            self.dbo.flush_logs(force=False)
+
+            self._wait(time())
 
-            for idx, scraper in self.scrapers.items():
-                # Only run the scraper if the scrapers run frequency has been exceeded
+        # Let any scrapers still running on the worker pool or pipeline finish before we return
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.pipeline is not None:
+            self.pipeline.close()
+        self._collect_finished()
 
-                # Update the timings for the scraper
-                scraper.update()
+        if self.leases is not None:
+            self.leases.stop()
 
-                if scraper.enabled:
-                    print("Running scraper bot #{}".format(idx))
-                    num_found = scraper.run()
-                    print("Scraper scraped {} entries from the specified url".format(num_found))
-                    print("Last run: {}".format(scraper.last_run_at))
+        self.dbo.flush_logs()
@@ -0,0 +1,486 @@
+""" Asyncio scraper classes
+
+    An alternative to the requests based ScraperBot and thread based ScraperFactory. All fetches run on a single
+    asyncio event loop using aiohttp, so a single process can have thousands of requests in flight at once.
+
+    Storing and processing of the fetched pages is handed off to the default executor so it does not hold up the
+    event loop. So is every other call into the database, the task log, the scraper list and the leases, as sqlite
+    blocks whether or not the writer thread is in use. The same raw_data and scrapers_log rows are written as the
+    requests based scraper.
+
+    aiohttp only speaks HTTP/1.1, so the http2 setting does not apply here. The content encodings asked for are the
+    same as for the requests based scraper.
+
+"""
+
+# Imports
+import asyncio
+import aiohttp
+import json
+from datetime import datetime as dt, timedelta
+from aiohttp import compression_utils
+from time import perf_counter, time
+from scraper import ScraperBot, FetchResult, SearchPage, CIRCUIT_OPEN, RETRIES
+from ScraperFactory import ScraperFactory
+from ScraperConfig import configuration
+from ratelimit import get_rate_limiter
+from session_pool import accept_encoding
+from response_cache import get_response_cache, MISS
+from retry import CircuitOpenError, RetryLaterError, get_retry_policy, get_circuit_breakers
+
+# The content encodings aiohttp can decode, br and zstd need their modules installed
+AIOHTTP_ENCODINGS = ', '.join(['gzip', 'deflate'] + (['br'] if getattr(compression_utils, 'HAS_BROTLI', False) else [])
+                              + (['zstd'] if getattr(compression_utils, 'HAS_ZSTD', False) else []))
+
+
+class AsyncScraperBot(ScraperBot):
+    """
+
+    Scraper bot which fetches its search results using aiohttp
+
+    :param scraper_id: The unique ID of the scraper in the database
+    :param dbo: The object that allows us to run commands against the database
+
+    Methods
+    ----------
+    _get_search_results_async(session)
+        Go to the target url and extracts the raw data to parse through
+
+    _fetch_async(session, url, headers)
+        Requests a url, sharing the response with other scrapers requesting the same url
+
+    _request_async(session, url, headers)
+        Requests a url within the host's rate limit, retrying failures which are likely to pass
+
+    _wire_bytes(result, body)
+        Works out the size of a response body as it was received
+
+    _log_task_async(*task)
+        Logs a task without blocking the event loop
+
+    _get_more_pages_async(session)
+        Retrieves the further pages of search results when the scraper has a pagination rule
+
+    _fetch_page_async(session, page_url)
+        Retrieves a single further page of search results
+
+    run_async(session)
+        Runs the scraper on the event loop
+    """
+
+    async def _get_search_results_async(self, session):
+        """
+        Extract the search results from the target url
+
+        :param session: The aiohttp session to make the request with
+        :returns: True if the search results were retrieved
+        """
+        print("Scraper #{}: Retrieving data from target URL.".format(self.id))
+
+        try:
+            with self._stage_timer('fetch') as timer:
+                url = self._search_url()
+                self.response, cache_result = await self._fetch_async(session, url, self._conditional_headers())
+
+            self.status_code = self.response.status_code
+
+            # Record the task details to the log along with the rate limit stats for the host
+            host_stats = dict(get_rate_limiter().host(url).stats(), response_cache=cache_result)
+            await self._log_task_async(self.id, timer.start_dt, timer.end_dt, 'extract-data', self.status_code,
+                                       'GOOD', json.dumps(host_stats), timer.duration, 'scraper')
+
+            return True
+        except CircuitOpenError as err_circuit:
+            print("Scraper #{}: {}".format(self.id, err_circuit))
+            self.response = None
+            return False
+        except RetryLaterError as err_retry:
+            print("Scraper #{}: {}".format(self.id, err_retry))
+            self.retry_at = dt.now() + timedelta(seconds=err_retry.delay)
+            self.response = None
+            return False
+        except asyncio.TimeoutError:
+            print("Request to {} timed out using search terms: {}".format(self.rules['url'], self.terms))
+            self.response = None
+            return False
+        except aiohttp.ClientConnectionError:
+            print("Unable to connect to {}".format(self.rules['url']))
+            self.response = None
+            return False
+        except aiohttp.ClientError:
+            print("We have encountered an error in the aiohttp library")
+            self.response = None
+            return False
+
+    async def _fetch_async(self, session, url, headers=None):
+        """
+        Requests a url through the shared response cache, so scrapers requesting the same url at about the same time
+        share one request
+
+        :param session: The aiohttp session to make the request with
+        :param url:     The url to request
+        :param headers: Request headers
+        :return: A tuple of (FetchResult, how the request was answered by the response cache)
+        """
+        cache = get_response_cache()
+        if not cache.enabled:
+            return await self._request_async(session, url, headers), MISS
+
+        return await cache.fetch_async(url, headers, lambda: self._request_async(session, url, headers))
+
+    async def _request_async(self, session, url, headers=None):
+        """
+        Requests a url, waiting for the host's rate limit, failing straight away while the host's circuit is open
+        and retrying timeouts, dropped connections and the responses the retry policy picks out. A retry further off
+        than the policy's max_wait raises RetryLaterError rather than being waited for
+
+        :param session: The aiohttp session to make the request with
+        :param url:     The url to request
+        :param headers: Request headers
+        :return: A FetchResult of the final response
+        """
+        limiter = get_rate_limiter().host(url)
+        breaker = get_circuit_breakers().host(url)
+        policy = get_retry_policy()
+
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                CIRCUIT_OPEN.inc(host=breaker.host)
+                raise CircuitOpenError("{} is failing, skipping the request until it recovers".format(breaker.host))
+
+            # Wait our turn with the other scrapers using the same host
+            await limiter.acquire_async()
+            request_start = perf_counter()
+            response = None
+            error = None
+            try:
+                timeout = aiohttp.ClientTimeout(total=self.timeout)
+                async with session.get(url, headers=headers, timeout=timeout) as result:
+                    text = await result.text(errors='replace')
+                    response = FetchResult(result.status, text, result.headers,
+                                           self._wire_bytes(result, await result.read()),
+                                           'HTTP/{}.{}'.format(*result.version))
+            except (asyncio.TimeoutError, aiohttp.ClientError) as err:
+                error = err
+            except BaseException:
+                # Any other error, a cancelled task included, still has to be reported or a probe request would
+                # leave the circuit half-open
+                breaker.record_failure()
+                raise
+            finally:
+                latency = perf_counter() - request_start
+                limiter.release(response.status_code if response is not None else None, latency)
+
+            status_code = response.status_code if response is not None else None
+            self._record_request(breaker.host, status_code, error, latency)
+            if response is not None:
+                self._record_transfer(breaker.host, response)
+            if status_code is None or status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+            # Only failures likely to pass are retried, and not once the host's circuit has opened or if the site
+            # asks us to wait too long
+            delay = None
+            retryable = error is None or isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+            if breaker.closed and retryable and attempt < policy.retries and policy.should_retry(status_code):
+                delay = policy.delay(attempt, response.headers.get('Retry-After') if response is not None else None)
+
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+
+            if not policy.wait_in_run(delay):
+                raise RetryLaterError("Retrying {} in {:.1f}s after {}, running again then".format(
+                    url, delay, status_code or type(error).__name__), delay)
+
+            print("Scraper #{}: Retrying {} in {:.1f}s after {}.".format(self.id, url, delay,
+                                                                        status_code or type(error).__name__))
+            RETRIES.inc(host=breaker.host)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def _wire_bytes(result, body):
+        """
+        Works out the size of a response body as it was received. aiohttp only hands over the decoded body, so the
+        size of an encoded body is taken from its Content-Length
+
+        :param result:  The aiohttp response
+        :param body:    The decoded body
+        :return: Bytes, None if the body was encoded and sent without a Content-Length
+        """
+        if result.headers.get('Content-Encoding', 'identity') == 'identity':
+            return len(body)
+
+        content_length = result.headers.get('Content-Length')
+        return int(content_length) if content_length and content_length.isdigit() else None
+
+    async def _log_task_async(self, *task):
+        """
+        Logs a task without blocking the event loop. log_task writes the buffered rows to the database once the
+        buffer fills, so it is run on the default executor
+
+        :param task: The arguments of DbSqlite3Wrapper.log_task
+        :return: Nothing
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.db.log_task, *task)
+
+    async def _get_more_pages_async(self, session):
+        """
+        Retrieves the further pages of search results into more_pages. With a page template every page is
+        requested at once, with a next page link they are followed one at a time
+
+        :param session: The aiohttp session to make the requests with
+        :return:
+        """
+        self.more_pages = []
+        if self.pagination is None or self.status_code != 200:
+            return
+
+        with self._stage_timer('fetch_pages') as timer:
+            if self.pagination.follows_links:
+                page_url = self._search_url()
+                response = self.response
+                for page in range(2, self.pagination.max_pages + 1):
+                    page_url = self.pagination.next_url(page_url, response.text)
+                    if page_url is None:
+                        break
+
+                    response = await self._fetch_page_async(session, page_url)
+                    if response is None:
+                        break
+
+                    self.more_pages.append(SearchPage(page, response))
+                    if response.status_code != 200:
+                        break
+            else:
+                page_urls = self.pagination.page_urls(self._search_url(), self.response.text)
+                responses = await asyncio.gather(*[self._fetch_page_async(session, page_url)
+                                                   for page, page_url in page_urls])
+                self.more_pages = [SearchPage(page, response)
+                                   for (page, page_url), response in zip(page_urls, responses) if response is not None]
+
+        if not self.more_pages:
+            return
+
+        print("Scraper #{}: Retrieved {} more pages of search results.".format(self.id, len(self.more_pages)))
+
+        # Record the task details to the log
+        await self._log_task_async(self.id, timer.start_dt, timer.end_dt, 'extract-pages', self.status_code,
+                                   'GOOD', json.dumps({'pages': len(self.more_pages) + 1}), timer.duration, 'scraper')
+
+    async def _fetch_page_async(self, session, page_url):
+        """
+        Retrieves a further page of search results
+
+        :param session: The aiohttp session to make the request with
+        :param page_url: The url of the page
+        :return: A FetchResult, None if the page could not be retrieved
+        """
+        try:
+            return (await self._fetch_async(session, page_url))[0]
+        except (asyncio.TimeoutError, aiohttp.ClientError, CircuitOpenError, RetryLaterError) as err:
+            print("Scraper #{}: Unable to retrieve {}: {}".format(self.id, page_url, err or type(err).__name__))
+            return None
+
+    async def run_async(self, session):
+        """
+
+        Performs the main function of the scraper, extracting and then processing the data
+
+        :param session: The aiohttp session to make the request with
+        :return: The number of items found
+        """
+
+        loop = asyncio.get_running_loop()
+        run_timer = self._stage_timer('run')
+
+        current_run_at = self._start_run()
+
+        items_found = 0
+
+        # Perform the search against the website, the storing and parsing is blocking so keep it off the loop
+        if await self._get_search_results_async(session):
+            # Fetch any further pages on the loop as well, unless the first page shows nothing has changed. The page
+            # is hashed once, off the loop, and the result handed on rather than hashed again when it is stored
+            unchanged = None
+            if self.pagination is not None:
+                unchanged = await loop.run_in_executor(None, self._is_unchanged)
+                if not unchanged:
+                    await self._get_more_pages_async(session)
+
+            items_found = await loop.run_in_executor(None, self._store_and_process, unchanged)
+
+        # Logs the run, which can write to the database
+        await loop.run_in_executor(None, self._finish_run, current_run_at, run_timer)
+
+        return items_found
+
+
+class AsyncScraperFactory(ScraperFactory):
+    """
+
+    Factory which runs all of the scraper bots on a single asyncio event loop
+
+    :param dbo: Database object for querying and executing commands
+
+    Methods
+    ----------
+    _run_async()
+        The main application loop
+
+    _wait_async(now)
+        Sleeps until the next scraper is due, the config needs checking or we are woken up
+
+    _blocking(func, *args)
+        Runs a call into the database on the default executor
+    """
+
+    bot_class = AsyncScraperBot
+
+    def __init__(self, dbo):
+        super().__init__(dbo)
+
+        self.max_concurrency = configuration.get('async_max_concurrency', 1000)  # Fetches in flight at once
+        self.limit_per_host = configuration.get('async_limit_per_host', 8)  # Connections open to any one host
+
+        self._loop = None
+        self._session = None
+        self._async_wakeup = None
+        self._tasks = set()
+
+    def _dispatch(self, scraper_id):
+        """Starts a due scraper as a task on the event loop
+
+        :param scraper_id: The ID of the scraper to run
+        :return: Nothing
+        """
+        scraper = self._materialize(scraper_id)
+
+        print("Running scraper bot #{}".format(scraper_id))
+
+        task = asyncio.ensure_future(scraper.run_async(self._session))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda done: self._on_done(scraper_id, scraper, done))
+
+    def _on_done(self, scraper_id, scraper, future):
+        """Hands the result of a finished scraper back to the main loop
+
+        :param scraper_id:  The ID of the scraper that finished
+        :param scraper:     The scraper object that was run
+        :param future:      The finished task holding the result of the run
+        :return: Nothing
+        """
+        self._finished.put((scraper_id, scraper, future))
+        self._async_wakeup.set()
+
+    def wake(self, config_changed=False):
+        """Wakes the main loop up early, safe to call from any thread
+
+        :param config_changed: Reload the scraper list from the database straight away
+        :return: Nothing
+        """
+        super().wake(config_changed)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._async_wakeup.set)
+
+    def stop(self):
+        """Stops the main loop after any scraper currently running has finished
+
+        :return: Nothing
+        """
+        self.app_loop = False
+        self.wake()
+
+    async def _blocking(self, func, *args):
+        """Runs a call into the database on the default executor so it does not hold up the event loop. The main
+        loop waits for it, so the scheduler state it touches is not changed by anything else in the meantime
+
+        :param func:    The function to call
+        :param args:    The arguments to call it with
+        :return: What the function returned
+        """
+        return await self._loop.run_in_executor(None, func, *args)
+
+    async def _wait_async(self, now):
+        """Sleeps until the next scraper is due or the scraper list needs refreshing
+
+        :param now: The current timestamp
+        :return: Nothing
+        """
+        wake_at = self._next_wake(now)
+
+        if wake_at > now:
+            try:
+                await asyncio.wait_for(self._async_wakeup.wait(), wake_at - now)
+            except asyncio.TimeoutError:
+                pass
+        self._async_wakeup.clear()
+
+    async def _run_async(self):
+        """
+        Runs the scraper bots as they become due until stopped
+
+        :return: Nothing
+        """
+        self._loop = asyncio.get_running_loop()
+        self._async_wakeup = asyncio.Event()
+
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.limit_per_host)
+
+        headers = {'Accept-Encoding': accept_encoding(AIOHTTP_ENCODINGS)}
+        async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+            self._session = session
+
+            while self.app_loop:
+
+                now = time()
+
+                # Update internal list of scrapers
+                if now >= self._next_config_poll:
+                    await self._blocking(self._update_scraper_list)
+                    self._next_config_poll = now + self.config_poll_interval
+
+                # Only run the scrapers whose run frequency has been exceeded, claiming them when distributed
+                if self.leases is not None:
+                    due = await self._blocking(lambda: list(self._pop_due(now)))
+                else:
+                    due = self._pop_due(now)
+                for idx in due:
+                    self._dispatch(idx)
+
+                # Releases the leases of the finished scrapers when distributed
+                await self._blocking(self._collect_finished)
+
+                await self._blocking(self.dbo.flush_logs, False)
+
+                await self._wait_async(time())
+
+            # Let any scrapers still in flight finish before we return
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._blocking(self._collect_finished)
+
+        if self.leases is not None:
+            await self._blocking(self.leases.stop)
+
+        await self._blocking(self.dbo.flush_logs)
+
+        self._loop = None
+
+    def run(self):
+        """
+        Runs the scraper bots on an asyncio event loop
+
+        :return: Nothing
+        """
+
+        # Print out some information
+        print("We have {} scraper(s) to run.".format(len(self.scrapers)))
+
+        asyncio.run(self._run_async())
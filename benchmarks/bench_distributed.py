@@ -0,0 +1,216 @@
+""" Distributed scraper benchmark
+
+    Runs every scraper once with one or more factories, each in its own process, sharing one database in distributed
+    mode. Checks that the scrapers are shared out between the factories without any of them being run twice and
+    measures how the scrapes per second scale with the number of factories. The results are written as JSON.
+
+    Usage: python benchmarks/bench_distributed.py --processes 1,2,4 --scrapers 400 --latency 0.1 --mode threaded
+           --output results.json
+
+"""
+
+# Imports
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime as dt
+from time import sleep, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_scrapers import create_db, git_commit, peak_rss_mb
+from database import DbSqlite3Wrapper
+from ScraperConfig import configuration
+from stand_in_server import StandInServer, RETAILERS
+
+# Scrapers which have not run yet or are running, the benchmark is over once there are none
+REMAINING_SQL = "SELECT COUNT(*) FROM scrapers WHERE next_due IS NULL OR lease_owner IS NOT NULL"
+
+
+def open_db(db_file):
+    """Connects to the benchmark database the same way main.py does
+
+    :param db_file: The database file
+    :return: The connected database object
+    """
+    dbo = DbSqlite3Wrapper(db_file, configuration.get('log_buffer_size', 100),
+                           configuration.get('log_flush_interval', 5.0), configuration.get('db_writer_thread', True),
+                           configuration.get('db_write_batch_size', 500))
+    dbo.connect()
+    return dbo
+
+
+def run_factory(args):
+    """Runs one factory until every scraper has run, called in each child process
+
+    Tells the parent it is ready once the scrapers are loaded and waits to be told to start, so every factory
+    starts claiming at the same time
+
+    :param args: The parsed command line arguments
+    :return: A dictionary of the results of this factory
+    """
+    configuration['distributed'] = True
+    configuration['execution_mode'] = args.mode
+    configuration['max_workers'] = args.workers
+    configuration['pipeline_fetch_workers'] = args.workers
+    configuration['claim_poll_interval'] = 0.1
+    configuration['host_limits'] = {'default': {'rate': None, 'max_concurrency': args.workers * args.max_processes}}
+
+    if args.mode == 'asyncio':
+        from async_scraper import AsyncScraperFactory as factory_class
+    else:
+        from ScraperFactory import ScraperFactory as factory_class
+
+    class BenchFactory(factory_class):
+        """Counts the scrapers this factory ran"""
+
+        finished = 0
+
+        def _finish(self, scraper_id, scraper, num_found):
+            super()._finish(scraper_id, scraper, num_found)
+            self.finished += 1
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        dbo = open_db(args.child_db)
+        factory = BenchFactory(dbo)
+
+    print('ready', file=sys.__stdout__, flush=True)
+    sys.stdin.readline()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        runner = threading.Thread(target=factory.run)
+        runner.start()
+
+        while dbo.query(REMAINING_SQL)[0][0] > 0:
+            sleep(0.05)
+        finished_at = time()
+
+        factory.stop()
+        runner.join()
+        dbo.close()
+
+    return {'runs': factory.finished, 'finished_at': finished_at, 'peak_rss_mb': peak_rss_mb()['self']}
+
+
+def bench_processes(args, server, processes):
+    """Runs every scraper once shared between a number of factories
+
+    :param args:        The parsed command line arguments
+    :param server:      The running stand-in server
+    :param processes:   The number of factories to run
+    :return: A dictionary of the results
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, 'bench.db')
+        dbo = open_db(db_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_db(dbo, server.url, args.retailer, args.scrapers, args.pages)
+        dbo.close()
+
+        requests_before = server.requests
+        children = [subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                                     ['--child-db', db_file], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     text=True)
+                    for idx in range(processes)]
+
+        for child in children:
+            child.stdout.readline()
+
+        start = time()
+        for child in children:
+            child.stdin.write('go\n')
+            child.stdin.flush()
+
+        results = []
+        for child in children:
+            output = child.stdout.read()
+            child.wait()
+            if child.returncode != 0:
+                return {'processes': processes, 'error': 'A factory exited with code {}'.format(child.returncode)}
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+        elapsed = max(result['finished_at'] for result in results) - start
+
+        dbo = open_db(db_file)
+        duplicate_sql = "SELECT COUNT(*) FROM (SELECT scraper_id FROM scrapers_log WHERE task = 'scraper-run' " \
+                        "GROUP BY scraper_id HAVING COUNT(*) > 1)"
+        duplicates = dbo.query(duplicate_sql)[0][0]
+        runs = dbo.query("SELECT COUNT(*) FROM scrapers_log WHERE task = 'scraper-run'")[0][0]
+        dbo.close()
+
+    return {
+        'processes': processes,
+        'runs': runs,
+        'runs_per_process': [result['runs'] for result in results],
+        'scrapers_run_twice': duplicates,
+        'elapsed_s': round(elapsed, 3),
+        'scrapes_per_s': round(runs / elapsed, 2),
+        'requests': server.requests - requests_before,
+        'peak_rss_mb': [result['peak_rss_mb'] for result in results],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', default='1,2,4', help='Numbers of factories to compare')
+    parser.add_argument('--mode', default='threaded', help='Execution mode of each factory')
+    parser.add_argument('--workers', type=int, default=8, help='Worker threads in each factory')
+    parser.add_argument('--scrapers', type=int, default=200, help='Number of scrapers to run')
+    parser.add_argument('--retailer', default='wickes', choices=sorted(RETAILERS), help='Shape of the pages served')
+    parser.add_argument('--items', type=int, default=20, help='Products on each search page')
+    parser.add_argument('--page-bytes', type=int, default=50000, help='Size each page is padded to')
+    parser.add_argument('--pages', type=int, default=1, help='Pages of results for each search')
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds the server waits per request')
+    parser.add_argument('--output', help='File to write the JSON results to, printed when not given')
+    parser.add_argument('--child-db', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.max_processes = max(int(processes) for processes in args.processes.split(','))
+
+    # Run as one of the factories
+    if args.child_db:
+        print(json.dumps(run_factory(args)))
+        return
+
+    server = StandInServer(args.items, args.latency, args.retailer, args.page_bytes, args.pages).start()
+
+    parameters = {name: value for name, value in vars(args).items() if name not in ('output', 'child_db')}
+    report = {
+        'benchmark': 'distributed',
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': dt.now().isoformat(timespec='seconds'),
+        'parameters': parameters,
+        'results': [],
+    }
+
+    for processes in [int(processes) for processes in args.processes.split(',')]:
+        print("Running {} scrapers with {} factories".format(args.scrapers, processes), file=sys.stderr)
+        result = bench_processes(args, server, processes)
+        report['results'].append(result)
+        if 'error' in result:
+            print(result['error'], file=sys.stderr)
+            continue
+
+        print("{:>3} factories {:>8.2f}s {:>10.1f} scrapes/s {:>6} runs {:>4} run twice".format(
+            processes, result['elapsed_s'], result['scrapes_per_s'], result['runs'], result['scrapers_run_twice']),
+            file=sys.stderr)
+
+    server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+""" Engine benchmark
+
+    Compares the threaded requests based scraper against the asyncio scraper by running every scraper once against
+    a local stand-in server.
+
+    Usage: python benchmarks/bench_engines.py --scrapers 200 --latency 0.25
+
+"""
+
+# Imports
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+from database import DbSqlite3Wrapper
+from scraper import ScraperBot
+from async_scraper import AsyncScraperBot
+from ScraperConfig import configuration
+from stand_in_server import StandInServer
+
+
+def create_db(db_file, url, scraper_count):
+    """Creates a database holding scraper_count scrapers which all search the stand-in server
+
+    :param db_file:         The database file to create
+    :param url:             The search url of the stand-in server
+    :param scraper_count:   The number of scrapers to add
+    :return: The connected database object
+    """
+    dbo = DbSqlite3Wrapper(db_file)
+    dbo.connect()
+    dbo.setup_scrapers_db()
+
+    scrapers = [(idx, 'bench-{}'.format(idx), '', 1, 1, 'bath taps', 1) for idx in range(1, scraper_count + 1)]
+    rules = []
+    for idx in range(1, scraper_count + 1):
+        rules += [
+            ('url', url, idx, 1),
+            ('searches', 'class/products-list', idx, 1),
+            ('products', 'class/card', idx, 1),
+            ('title', 'class/product-card__title', idx, 1),
+            ('price', 'class/product-card__price', idx, 1),
+            ('stock', '', idx, 1)
+        ]
+
+    dbo.execute("INSERT INTO customers(id,name,description) VALUES(?, ?, ?)", [(1, 'bench', '')])
+    dbo.execute("INSERT INTO scrapers(id,name,description,enabled,customer_id, search_terms, run_frequency) "
+                "VALUES(?, ?, ?, ?, ?, ?, ?)", scrapers)
+    dbo.execute("INSERT INTO rules(name,value,scraper_id,customer_id) VALUES(?, ?, ?, ?)", rules)
+    return dbo
+
+
+def bench_threaded(dbo, scraper_count, workers):
+    bots = [ScraperBot(idx, dbo) for idx in range(1, scraper_count + 1)]
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        found = sum(pool.map(lambda bot: bot.run() or 0, bots))
+    return perf_counter() - start, found
+
+
+def bench_asyncio(dbo, scraper_count, limit_per_host):
+    bots = [AsyncScraperBot(idx, dbo) for idx in range(1, scraper_count + 1)]
+
+    async def run_all():
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=limit_per_host)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            results = await asyncio.gather(*[bot.run_async(session) for bot in bots])
+        return sum(result or 0 for result in results)
+
+    start = perf_counter()
+    found = asyncio.run(run_all())
+    return perf_counter() - start, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scrapers', type=int, default=200, help='Number of scrapers to run')
+    parser.add_argument('--items', type=int, default=20, help='Products on each search page')
+    parser.add_argument('--latency', type=float, default=0.25, help='Seconds the server waits per request')
+    parser.add_argument('--workers', type=int, default=8, help='Worker threads for the threaded engine')
+    parser.add_argument('--limit-per-host', type=int, default=100, help='Connections per host for asyncio')
+    args = parser.parse_args()
+
+    # Only the engines' own limits should hold the scrapers back, not the per host rate limiting
+    max_concurrency = max(args.workers, args.limit_per_host)
+    configuration['host_limits'] = {'default': {'rate': None, 'max_concurrency': max_concurrency}}
+
+    server = StandInServer(args.items, args.latency).start()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, bench, limit in (('threaded', bench_threaded, args.workers),
+                                   ('asyncio', bench_asyncio, args.limit_per_host)):
+            dbo = create_db(os.path.join(tmp_dir, '{}.db'.format(name)), server.url, args.scrapers)
+
+            # The scrapers are chatty, keep the benchmark output readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                elapsed, found = bench(dbo, args.scrapers, limit)
+
+            dbo.close()
+            print("{:<10} {:>8.2f}s {:>10.1f} scrapes/s {:>8} items".format(
+                name, elapsed, args.scrapers / elapsed, found))
+
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
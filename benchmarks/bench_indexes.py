@@ -0,0 +1,108 @@
+""" Index benchmark
+
+    Times the lookups the scrapers and reports make on a database holding millions of scrapers_log rows, first with
+    the tables as created by setup_scrapers_db before any migrations and then after migrating to the current schema.
+
+    Usage: python benchmarks/bench_indexes.py --log-rows 2000000
+
+"""
+
+# Imports
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime as dt, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DbSqlite3Wrapper
+
+TASKS = ['extract-data', 'save-raw-data', 'process-data', 'scraper-run']
+
+LOOKUPS = [
+    ('rules', "SELECT name, value FROM rules WHERE scraper_id = ?"),
+    ('raw_data history', "SELECT rowid, date_time FROM raw_data WHERE scraper_id = ? ORDER BY date_time DESC LIMIT 10"),
+    ('log history', "SELECT started, duration FROM scrapers_log WHERE scraper_id = ? AND task = 'extract-data' "
+                    "ORDER BY started DESC LIMIT 100"),
+]
+
+
+def fill(dbo, scraper_count, log_rows, raw_rows):
+    """Fills the database with generated rows
+
+    :param dbo:             The database object
+    :param scraper_count:   The number of scrapers the rows are spread over
+    :param log_rows:        The number of scrapers_log rows to add
+    :param raw_rows:        The number of raw_data rows to add
+    :return: Nothing
+    """
+    start = dt(2020, 1, 1)
+    rules = [(name, 'class/x', idx, 1) for idx in range(1, scraper_count + 1)
+             for name in ('url', 'searches', 'products', 'title', 'price', 'stock')]
+    dbo.execute("INSERT INTO rules(name,value,scraper_id,customer_id) VALUES(?, ?, ?, ?)", rules)
+
+    chunk = 100000
+    for offset in range(0, log_rows, chunk):
+        rows = []
+        for idx in range(offset, min(offset + chunk, log_rows)):
+            started = start + timedelta(seconds=idx)
+            rows.append((idx % scraper_count + 1, started, started, TASKS[idx % len(TASKS)], 200, 'GOOD', '', 0.1,
+                         'scraper'))
+        dbo.execute("INSERT INTO scrapers_log(scraper_id, started, ended, task, http_code, status_code, content, "
+                    "duration, owner) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    rows = [(idx % scraper_count + 1, start + timedelta(seconds=idx), 200) for idx in range(raw_rows)]
+    dbo.execute("INSERT INTO raw_data(scraper_id, date_time, http_code) VALUES(?, ?, ?)", rows)
+
+
+def time_lookups(dbo, scraper_count, repeats):
+    """Times each lookup for a random selection of scrapers
+
+    :return: A dictionary of {lookup name: average milliseconds}
+    """
+    ids = [random.randint(1, scraper_count) for _ in range(repeats)]
+    results = {}
+    for name, sql in LOOKUPS:
+        start = perf_counter()
+        for scraper_id in ids:
+            dbo.query(sql, [scraper_id])
+        results[name] = (perf_counter() - start) * 1000 / repeats
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scrapers', type=int, default=10000, help='Number of scrapers the rows belong to')
+    parser.add_argument('--log-rows', type=int, default=2000000, help='Number of scrapers_log rows')
+    parser.add_argument('--raw-rows', type=int, default=200000, help='Number of raw_data rows')
+    parser.add_argument('--repeats', type=int, default=50, help='Lookups timed per query')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dbo = DbSqlite3Wrapper(os.path.join(tmp_dir, 'bench.db'))
+        dbo.connect()
+        dbo.setup_scrapers_db(migrate=False)
+
+        print("Filling database with {} log rows".format(args.log_rows))
+        fill(dbo, args.scrapers, args.log_rows, args.raw_rows)
+
+        before = time_lookups(dbo, args.scrapers, args.repeats)
+
+        start = perf_counter()
+        dbo.migrate()
+        migrate_time = perf_counter() - start
+
+        after = time_lookups(dbo, args.scrapers, args.repeats)
+        dbo.close()
+
+    print("Migration took {:.2f}s".format(migrate_time))
+    print("{:<18} {:>12} {:>12}".format('lookup', 'before ms', 'after ms'))
+    for name, sql in LOOKUPS:
+        print("{:<18} {:>12.3f} {:>12.3f}".format(name, before[name], after[name]))
+
+
+if __name__ == '__main__':
+    main()
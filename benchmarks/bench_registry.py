@@ -0,0 +1,145 @@
+""" Scraper registry memory benchmark
+
+    Measures the memory a ScraperFactory holds for a large number of registered scrapers, once they have been
+    loaded and again after some of them have run against the stand-in retailer server, so the memory kept per
+    scraper and anything left behind by finished runs can be compared between versions. The results are written as
+    JSON.
+
+    Usage: python benchmarks/bench_registry.py --scrapers 100000 --runs 200 --page-bytes 200000 --output results.json
+
+"""
+
+# Imports
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime as dt
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_scrapers import git_commit, peak_rss_mb
+from database import DbSqlite3Wrapper
+from ScraperConfig import configuration
+from stand_in_server import StandInServer, RETAILERS
+
+
+def fill_db(dbo, url, retailer, scraper_count):
+    """Adds scraper_count scrapers, each with its rules and the validators of an earlier run
+
+    :param dbo:             The connected database object
+    :param url:             The search url of the stand-in server
+    :param retailer:        The shape of the pages the server returns
+    :param scraper_count:   The number of scrapers to add
+    :return: Nothing
+    """
+    dbo.setup_scrapers_db()
+
+    retailer_rules = dict(RETAILERS[retailer]['rules'], url=url)
+    dbo.execute("INSERT INTO customers(id,name,description) VALUES(?, ?, ?)", [(1, retailer, '')])
+    dbo.execute("INSERT INTO scrapers(id,name,description,enabled,customer_id, search_terms, run_frequency) "
+                "VALUES(?, ?, ?, ?, ?, ?, ?)",
+                [(idx, 'bench-{}'.format(idx), '', 1, 1, 'term {}'.format(idx), 24)
+                 for idx in range(1, scraper_count + 1)])
+    dbo.execute("INSERT INTO rules(name,value,scraper_id,customer_id) VALUES(?, ?, ?, ?)",
+                [(name, value, idx, 1)
+                 for idx in range(1, scraper_count + 1) for name, value in retailer_rules.items()])
+    dbo.execute("INSERT INTO scraper_validators(scraper_id, etag, last_modified, content_hash, updated_at) "
+                "VALUES(?, ?, ?, ?, ?)",
+                [(idx, '"{:032x}"'.format(idx), None, '{:064x}'.format(idx), dt.now())
+                 for idx in range(1, scraper_count + 1)])
+
+
+def traced_mb():
+    """Gets the memory currently allocated by python, after a full collection
+
+    :return: Megabytes
+    """
+    gc.collect()
+    return round(tracemalloc.get_traced_memory()[0] / 1024 / 1024, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scrapers', type=int, default=100000, help='Number of scrapers to register')
+    parser.add_argument('--runs', type=int, default=200, help='Number of scrapers to run once loaded')
+    parser.add_argument('--retailer', default='wickes', choices=sorted(RETAILERS), help='Shape of the pages served')
+    parser.add_argument('--items', type=int, default=20, help='Products on each search page')
+    parser.add_argument('--page-bytes', type=int, default=200000, help='Size each page is padded to')
+    parser.add_argument('--output', help='File to write the JSON results to, printed when not given')
+    args = parser.parse_args()
+
+    configuration['execution_mode'] = 'serial'
+    configuration['db_writer_thread'] = False
+    configuration['host_limits'] = {'default': {'rate': None}}
+
+    from ScraperFactory import ScraperFactory
+
+    server = StandInServer(args.items, 0.0, args.retailer, args.page_bytes).start()
+
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.redirect_stdout(io.StringIO()):
+        dbo = DbSqlite3Wrapper(os.path.join(tmp_dir, 'bench.db'), writer_thread=False)
+        dbo.connect()
+        fill_db(dbo, server.url, args.retailer, args.scrapers)
+
+        tracemalloc.start()
+        baseline_mb = traced_mb()
+
+        start = perf_counter()
+        factory = ScraperFactory(dbo)
+        load_s = perf_counter() - start
+        loaded_mb = traced_mb()
+
+        # Run the first few scrapers straight through the factory, serial mode runs each as it is dispatched
+        start = perf_counter()
+        for scraper_id in sorted(factory.scrapers)[:args.runs]:
+            factory._dispatch(scraper_id)
+        run_s = perf_counter() - start
+        dbo.flush_logs()
+        after_runs_mb = traced_mb()
+
+        tracemalloc.stop()
+        registered = len(factory.scrapers)
+        dbo.close()
+
+    server.stop()
+
+    report = {
+        'benchmark': 'registry',
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': dt.now().isoformat(timespec='seconds'),
+        'parameters': {name: value for name, value in vars(args).items() if name != 'output'},
+        'results': {
+            'scrapers': registered,
+            'load_s': round(load_s, 2),
+            'loaded_mb': round(loaded_mb - baseline_mb, 1),
+            'bytes_per_scraper': round((loaded_mb - baseline_mb) * 1024 * 1024 / max(registered, 1)),
+            'runs': min(args.runs, registered),
+            'run_s': round(run_s, 2),
+            'retained_after_runs_mb': round(after_runs_mb - loaded_mb, 1),
+            'peak_rss_mb': peak_rss_mb()['self'],
+        },
+    }
+
+    print("{} scrapers loaded in {:.1f}s using {:.1f} MB, {:.1f} MB more held after {} runs".format(
+        registered, load_s, loaded_mb - baseline_mb, after_runs_mb - loaded_mb, report['results']['runs']),
+        file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+""" Scraper benchmark
+
+    Runs every scraper once through ScraperFactory against the stand-in retailer server and measures the end to
+    end scrapes per second, the fetch, parse and store stage timings recorded in scrapers_log and the peak memory
+    used. The results are written as JSON so the results of different versions can be compared.
+
+    Each execution mode is measured in a fresh process so the peak memory reported is its own.
+
+    Usage: python benchmarks/bench_scrapers.py --modes serial,threaded,asyncio,pipeline --scrapers 200
+           --latency 0.1 --error-rate 0.02 --output results.json
+
+"""
+
+# Imports
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime as dt
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DbSqlite3Wrapper
+from ScraperConfig import configuration
+from stand_in_server import StandInServer, RETAILERS
+
+# The scrapers_log task recorded for each stage of a run
+STAGES = {
+    'fetch': 'extract-data',
+    'fetch_pages': 'extract-pages',
+    'store': 'save-raw-data',
+    'parse': 'process-data',
+    'run': 'scraper-run',
+}
+
+
+def create_db(dbo, url, retailer, scraper_count, pages, searches=None):
+    """Adds scraper_count scrapers which all search the stand-in server
+
+    :param dbo:             The connected database object
+    :param url:             The search url of the stand-in server
+    :param retailer:        The shape of the pages the server returns
+    :param scraper_count:   The number of scrapers to add
+    :param pages:           The number of pages of results the server returns
+    :param searches:        The number of different search terms shared out between the scrapers, None for each
+                            scraper to search for its own
+    :return: Nothing
+    """
+    dbo.setup_scrapers_db()
+
+    searches = searches or scraper_count
+    scrapers = [(idx, 'bench-{}'.format(idx), '', 1, 1, 'term {}'.format((idx - 1) % searches + 1), 1)
+                for idx in range(1, scraper_count + 1)]
+    retailer_rules = dict(RETAILERS[retailer]['rules'], url=url)
+    if pages > 1:
+        retailer_rules['pagination'] = '?page={page}'
+
+    rules = [(name, value, idx, 1) for idx in range(1, scraper_count + 1) for name, value in retailer_rules.items()]
+
+    dbo.execute("INSERT INTO customers(id,name,description) VALUES(?, ?, ?)", [(1, retailer, '')])
+    dbo.execute("INSERT INTO scrapers(id,name,description,enabled,customer_id, search_terms, run_frequency) "
+                "VALUES(?, ?, ?, ?, ?, ?, ?)", scrapers)
+    dbo.execute("INSERT INTO rules(name,value,scraper_id,customer_id) VALUES(?, ?, ?, ?)", rules)
+
+
+def percentile(values, fraction):
+    """Gets a percentile of a sorted list of values
+
+    :param values:      The sorted values
+    :param fraction:    The percentile as a fraction, 0.95 for the 95th
+    :return: The value, None if there are no values
+    """
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def stage_timings(dbo):
+    """Summarises how long each stage of the runs took from scrapers_log
+
+    :param dbo: The database object
+    :return: A dictionary of {stage: {count, total_s, mean_ms, p50_ms, p95_ms, max_ms}}
+    """
+    timings = {}
+    for stage, task in STAGES.items():
+        durations = sorted(row[0] for row in dbo.query("SELECT duration FROM scrapers_log WHERE task = ?", [task])
+                           or [] if row[0] is not None)
+        if not durations:
+            continue
+
+        timings[stage] = {
+            'count': len(durations),
+            'total_s': round(sum(durations), 4),
+            'mean_ms': round(sum(durations) * 1000 / len(durations), 3),
+            'p50_ms': round(percentile(durations, 0.5) * 1000, 3),
+            'p95_ms': round(percentile(durations, 0.95) * 1000, 3),
+            'max_ms': round(durations[-1] * 1000, 3),
+        }
+    return timings
+
+
+def peak_rss_mb():
+    """Gets the peak resident memory of this process and of its finished child processes
+
+    :return: A dictionary of {'self': megabytes, 'children': megabytes}, None where it can not be measured
+    """
+    if resource is None:
+        return {'self': None, 'children': None}
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)}
+
+
+def bench_mode(args, mode):
+    """Runs every scraper once in an execution mode
+
+    :param args: The parsed command line arguments
+    :param mode: The execution mode to run
+    :return: A dictionary of the results
+    """
+    configuration['execution_mode'] = mode
+    configuration['max_workers'] = args.workers
+    configuration['pipeline_fetch_workers'] = args.workers
+    configuration['async_limit_per_host'] = args.limit_per_host
+    configuration['parser_backend'] = args.backend
+    configuration['retry'] = dict(configuration.get('retry', {}), backoff_base=args.backoff)
+    configuration['http2'] = args.http2
+    configuration['accept_encoding'] = args.accept_encoding
+    if args.no_response_cache:
+        configuration['coalesce_requests'] = False
+        configuration['response_cache_ttl'] = 0
+
+    # Only the engines' own limits should hold the scrapers back, not the per host rate limiting
+    max_concurrency = max(args.workers, args.limit_per_host)
+    configuration['host_limits'] = {'default': {'rate': None, 'max_concurrency': max_concurrency}}
+
+    # Imported after the configuration is set, the asyncio engine needs aiohttp
+    if mode == 'asyncio':
+        from async_scraper import AsyncScraperFactory as factory_class
+    else:
+        from ScraperFactory import ScraperFactory as factory_class
+
+    class BenchFactory(factory_class):
+        """Stops once every scraper has run once"""
+
+        finished = 0
+        items = 0
+
+        def _finish(self, scraper_id, scraper, num_found):
+            super()._finish(scraper_id, scraper, num_found)
+            self.finished += 1
+            self.items += num_found or 0
+            if self.finished >= len(self.scrapers):
+                self.stop()
+
+    server = StandInServer(args.items, args.latency, args.retailer, args.page_bytes, args.pages, args.error_rate,
+                           args.jitter).start()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dbo = DbSqlite3Wrapper(os.path.join(tmp_dir, 'bench.db'), configuration.get('log_buffer_size', 100),
+                               configuration.get('log_flush_interval', 5.0),
+                               configuration.get('db_writer_thread', True),
+                               configuration.get('db_write_batch_size', 500))
+        dbo.connect()
+
+        # The scrapers are chatty, keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_db(dbo, server.url, args.retailer, args.scrapers, args.pages, args.searches)
+
+            if args.tracemalloc:
+                tracemalloc.start()
+
+            start = perf_counter()
+            factory = BenchFactory(dbo)
+            factory.run()
+            elapsed = perf_counter() - start
+
+            python_peak_mb = None
+            if args.tracemalloc:
+                python_peak_mb = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+                tracemalloc.stop()
+
+            dbo.sync()
+            timings = stage_timings(dbo)
+            stored = dbo.query("SELECT COUNT(*) FROM raw_data")[0][0]
+            dbo.close()
+
+    server.stop()
+
+    return {
+        'mode': mode,
+        'scrapers': factory.finished,
+        'items': factory.items,
+        'pages_stored': stored,
+        'elapsed_s': round(elapsed, 3),
+        'scrapes_per_s': round(factory.finished / elapsed, 2),
+        'requests': server.requests,
+        'bytes_sent': server.bytes_sent,
+        'server_errors': server.errors,
+        'stages': timings,
+        'peak_rss_mb': peak_rss_mb(),
+        'python_peak_mb': python_peak_mb,
+    }
+
+
+def git_commit():
+    """Gets the commit of the code being benchmarked
+
+    :return: The short commit hash, None outside of a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='serial,threaded,asyncio,pipeline', help='Execution modes to compare')
+    parser.add_argument('--scrapers', type=int, default=100, help='Number of scrapers to run')
+    parser.add_argument('--retailer', default='wickes', choices=sorted(RETAILERS), help='Shape of the pages served')
+    parser.add_argument('--items', type=int, default=20, help='Products on each search page')
+    parser.add_argument('--page-bytes', type=int, default=200000, help='Size each page is padded to')
+    parser.add_argument('--pages', type=int, default=1, help='Pages of results for each search')
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds the server waits per request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random seconds added to each request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 503')
+    parser.add_argument('--backoff', type=float, default=0.05, help='Seconds the retry backoff is based on')
+    parser.add_argument('--searches', type=int, help='Different search terms shared by the scrapers, one each when '
+                        'not given')
+    parser.add_argument('--no-response-cache', action='store_true', help='Turn off sharing of requests and responses')
+    parser.add_argument('--accept-encoding', help="Encodings to ask for, 'identity' for none, all the client can "
+                        "decode when not given")
+    parser.add_argument('--http2', action='store_true', help='Use HTTP/2 where the server supports it')
+    parser.add_argument('--workers', type=int, default=8, help='Worker threads for the threaded and pipeline modes')
+    parser.add_argument('--limit-per-host', type=int, default=100, help='Connections per host for asyncio')
+    parser.add_argument('--backend', default=configuration.get('parser_backend', 'lxml'), help='Parser backend')
+    parser.add_argument('--tracemalloc', action='store_true', help='Also measure the peak python heap, slower')
+    parser.add_argument('--output', help='File to write the JSON results to, printed when not given')
+    parser.add_argument('--child-mode', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Run inside a fresh process for each mode, printing only the results
+    if args.child_mode:
+        print(json.dumps(bench_mode(args, args.child_mode)))
+        return
+
+    parameters = {name: value for name, value in vars(args).items() if name not in ('output', 'child_mode')}
+    report = {
+        'benchmark': 'scrapers',
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': dt.now().isoformat(timespec='seconds'),
+        'parameters': parameters,
+        'results': [],
+    }
+
+    for mode in args.modes.split(','):
+        print("Running {} scrapers in {} mode".format(args.scrapers, mode), file=sys.stderr)
+        child = subprocess.run([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--child-mode', mode],
+                               capture_output=True, text=True)
+        if child.returncode != 0:
+            print(child.stderr, file=sys.stderr)
+            report['results'].append({'mode': mode, 'error': child.stderr.strip().splitlines()[-1:]})
+            continue
+
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        report['results'].append(result)
+        print("{:<10} {:>8.2f}s {:>10.1f} scrapes/s {:>8} items {:>8.1f} MB peak {:>8.1f} MB sent".format(
+            mode, result['elapsed_s'], result['scrapes_per_s'], result['items'], result['peak_rss_mb']['self'] or 0,
+            result['bytes_sent'] / 1024 / 1024), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+""" Stand-in retailer server
+
+    A local http server which serves generated search results pages in the same shapes as the wickes and argos
+    search pages. Used to benchmark the scrapers without hitting a live site.
+
+    The number of products, the size of the page, the number of pages of results, how long each response takes and
+    how often the server fails can all be set, so the scrapers can be measured against fast, slow, large and
+    unreliable sites. Pages are compressed with the best encoding the client asks for, zstd and br when their modules
+    are installed and otherwise gzip, as most retailers' sites do.
+
+    This script is intended to be imported from the benchmark scripts and not run on it's own.
+
+"""
+
+# Imports
+import gzip
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The encodings the server can compress pages with, best first
+ENCODERS = {'gzip': lambda body: gzip.compress(body, 6)}
+if brotli is not None:
+    ENCODERS = dict({'br': lambda body: brotli.compress(body, quality=5)}, **ENCODERS)
+if zstandard is not None:
+    ENCODERS = dict({'zstd': lambda body: zstandard.ZstdCompressor(level=3).compress(body)}, **ENCODERS)
+
+
+def pick_encoding(accept_encoding, encoders):
+    """Picks the best encoding the client asked for
+
+    :param accept_encoding: The request's Accept-Encoding header
+    :param encoders:        The encodings available, best first
+    :return: The encoding, None to send the page uncompressed
+    """
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        name, _, quality = part.strip().partition(';q=')
+        if name and quality.strip() not in ('0', '0.0', '0.00', '0.000'):
+            accepted.add(name.strip())
+
+    for encoding in encoders:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def wickes_products(item_count):
+    """Builds the search results in the shape of the wickes search page"""
+    cards = "".join(
+        '<div class="card"><a class="product-card__title">Product {0}</a>'
+        '<div class="product-card__price"> &pound;{0}.99 </div></div>'.format(idx)
+        for idx in range(item_count)
+    )
+    return '<div class="products-list">{}</div>'.format(cards)
+
+
+def argos_products(item_count):
+    """Builds the search results in the shape of the argos search page"""
+    cards = "".join(
+        '<div class="ProductCardstyles__Wrapper-l8f8q8-1 dDMpqT" data-test="component-product-card">'
+        '<a class="ProductCardstyles__Link-l8f8q8-2" href="/product/{0}">'
+        '<div class="ProductCardstyles__Title-l8f8q8-12 bAJdTw"><p>Product {0}</p></div></a>'
+        '<div class="ProductCardstyles__PriceText-l8f8q8-14 gaEHXF"><strong>&pound;{0}.99</strong></div>'
+        '</div>'.format(idx)
+        for idx in range(item_count)
+    )
+    return '<div class="search" data-test="component-search-results">{}</div>'.format(cards)
+
+
+# The markup and matching scraper rules of each retailer shape
+RETAILERS = {
+    'wickes': {
+        'products': wickes_products,
+        'rules': {
+            'searches': 'class/products-list',
+            'products': 'class/card',
+            'title': 'class/product-card__title',
+            'price': 'class/product-card__price',
+            'stock': '',
+        },
+    },
+    'argos': {
+        'products': argos_products,
+        'rules': {
+            'searches': 'class/search',
+            'products': 'class/ProductCardstyles__Wrapper-l8f8q8-1',
+            'title': 'class/ProductCardstyles__Title-l8f8q8-12',
+            'price': 'class/ProductCardstyles__PriceText-l8f8q8-14',
+            'stock': '',
+        },
+    },
+}
+
+
+def search_page(item_count, retailer='wickes', page_bytes=0, page=1, pages=1):
+    """Builds a search results page
+
+    :param item_count:  The number of products to put on the page
+    :param retailer:    The shape of the page, one of RETAILERS
+    :param page_bytes:  Pad the page with scripts and navigation before and after the results to at least this size
+    :param page:        The page number
+    :param pages:       The number of pages of results, links to each page are added when there is more than one
+    :return: The page as bytes
+    """
+    results = RETAILERS[retailer]['products'](item_count)
+
+    pager = ''
+    if pages > 1:
+        pager = '<nav class="pagination">{}</nav>'.format(''.join(
+            '<a href="?page={0}">{0}</a>'.format(number) for number in range(1, pages + 1) if number != page))
+
+    # Real pages carry far more markup around the results than in them, split the padding either side
+    padding = max(page_bytes - len(results) - len(pager), 0)
+    filler = '<script>var config = {{"id": {}, "flags": "{}"}};</script><ul class="nav"><li>Menu</li></ul>'
+    head = ''.join(filler.format(idx, 'x' * 64) for idx in range(padding // 2 // 130 + 1)) if padding else ''
+    foot = ''.join(filler.format(idx, 'y' * 64) for idx in range(padding // 2 // 130 + 1)) if padding else ''
+
+    page_html = '<html><head><title>Search</title>{}</head><body><header></header>{}{}<footer>{}</footer></body>' \
+                '</html>'
+    return page_html.format(head, results, pager, foot).encode('utf-8')
+
+
+class StandInServer:
+    """
+    Runs the stand-in server on a background thread
+
+    :param item_count:  The number of products on each search page
+    :param latency:     Seconds to wait before answering each request
+    :param retailer:    The shape of the pages, one of RETAILERS
+    :param page_bytes:  The size each page is padded to
+    :param pages:       The number of pages of results for each search
+    :param error_rate:  The fraction of requests answered with a 503
+    :param jitter:      Seconds of random latency added on top of latency
+    :param seed:        Seed for the errors and jitter, so runs can be repeated
+    :param compress:    Compress pages for clients which ask for it
+    """
+
+    def __init__(self, item_count=20, latency=0.0, retailer='wickes', page_bytes=0, pages=1, error_rate=0.0,
+                 jitter=0.0, seed=0, compress=True):
+        bodies = {page: search_page(item_count, retailer, page_bytes, page, pages) for page in range(1, pages + 1)}
+        encoders = ENCODERS if compress else {}
+        encoded = {(page, encoding): encode(body)
+                   for page, body in bodies.items() for encoding, encode in encoders.items()}
+        chance = random.Random(seed)
+        chance_lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0  # Bytes of the page bodies sent, after compression
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # The headers and a small compressed body go out as separate writes, without this the body waits on
+            # the client's delayed ack
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with chance_lock:
+                    server.requests += 1
+                    failed = chance.random() < error_rate
+                    delay = latency + (chance.uniform(0, jitter) if jitter else 0)
+                    if failed:
+                        server.errors += 1
+
+                if delay:
+                    sleep(delay)
+
+                if failed:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                page = parse_qs(urlsplit(self.path).query).get('page', ['1'])[0]
+                page = int(page) if page.isdigit() and int(page) in bodies else 1
+                encoding = pick_encoding(self.headers.get('Accept-Encoding'), encoders)
+                body = encoded[page, encoding] if encoding else bodies[page]
+
+                with chance_lock:
+                    server.bytes_sent += len(body)
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.request_queue_size = 1024
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """The url of the search page"""
+        return "http://127.0.0.1:{}/search".format(self.httpd.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,115 @@
+""" Blob store
+
+    Content addressed storage for the raw pages retrieved by the scrapers. Each distinct page body is stored once,
+    compressed, in the raw_blobs table under the sha256 hash of its text. The raw_data rows only reference the hash.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import hashlib
+import zlib
+
+
+class BlobStore:
+    """
+    Stores and retrieves compressed page bodies by their content hash
+
+    :param dbo: Database object for querying and executing commands
+
+    Methods
+    -----------
+    content_hash(text)
+        Works out the hash a body will be stored under
+
+    put(text, content_hash)
+        Stores a body if it is not already held, returning its hash
+
+    get(content_hash)
+        Retrieves and decompresses a stored body
+
+    read_raw_data(raw_id)
+        Retrieves the body of a raw_data row, whether it was stored in the blob store or inline
+    """
+
+    compression_level = 6
+
+    def __init__(self, dbo):
+        self.db = dbo
+
+    @staticmethod
+    def content_hash(text):
+        """Works out the hash a body will be stored under
+
+        :param text: The body of the page
+        :return: The hex sha256 of the utf-8 encoded text
+        """
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def put(self, text, content_hash=None):
+        """Stores a page body, bodies already held are not stored again
+
+        :param text:            The body of the page
+        :param content_hash:    The hash of the text if it has already been worked out
+        :return: The hash the body is stored under
+        """
+        data = None
+        if content_hash is None:
+            data = text.encode('utf-8')
+            content_hash = hashlib.sha256(data).hexdigest()
+
+        # Most runs retrieve a page which is already held, only compress a body the first time it is seen
+        held_sql = "SELECT 1 FROM raw_blobs WHERE hash = ?"
+        if self.db.query(held_sql, [content_hash]):
+            return content_hash
+
+        if data is None:
+            data = text.encode('utf-8')
+
+        # Still ignored if another scraper stored the same body in the meantime
+        blob_sql = "INSERT OR IGNORE INTO raw_blobs(hash, encoding, size, content) VALUES(?, ?, ?, ?)"
+        blob_values = [(content_hash, 'zlib', len(data), zlib.compress(data, self.compression_level))]
+        self.db.execute(blob_sql, blob_values)
+
+        return content_hash
+
+    def get(self, content_hash):
+        """Retrieves a stored page body
+
+        :param content_hash: The hash the body is stored under
+        :return: The body text, None if it is not held
+        """
+        blob_sql = "SELECT encoding, content FROM raw_blobs WHERE hash = ?"
+        for blob in self.db.query(blob_sql, [content_hash]) or []:
+            return self.decode(blob[0], blob[1])
+
+        return None
+
+    @staticmethod
+    def decode(encoding, content):
+        """Decompresses a stored body
+
+        :param encoding:    The encoding the body was stored with
+        :param content:     The stored bytes
+        :return: The body text
+        """
+        if encoding == 'zlib':
+            content = zlib.decompress(content)
+        return content.decode('utf-8')
+
+    def read_raw_data(self, raw_id):
+        """Retrieves the page body of a raw_data row
+
+        :param raw_id: The rowid of the raw_data row
+        :return: The body text, None if there is no such row
+        """
+        raw_sql = "SELECT r.content, b.encoding, b.content FROM raw_data r " \
+                  "LEFT JOIN raw_blobs b ON b.hash = r.content_hash WHERE r.rowid = ?"
+        for raw in self.db.query(raw_sql, [raw_id]) or []:
+            # Rows written before the blob store hold their content inline
+            if raw[2] is None:
+                return raw[0]
+            return self.decode(raw[1], raw[2])
+
+        return None
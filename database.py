@@ -6,7 +6,24 @@ This script is intended to be imported from other scripts and not
 run on it's own.
 
 """
+import atexit
+import os
 import sqlite3
+import migrations
+from contextlib import contextmanager
+from queue import Queue, Empty
+from threading import Condition, Lock, RLock, Thread, local
+from time import monotonic
+from metrics import get_metrics
+
+# Metrics recorded by the database wrapper
+metrics = get_metrics()
+WRITE_QUEUE_DEPTH = metrics.gauge('db_write_queue_depth', 'Writes waiting for the writer thread')
+LOG_BUFFER_ROWS = metrics.gauge('db_log_buffer_rows', 'scrapers_log rows waiting to be written')
+WRITE_BATCH_SIZE = metrics.histogram('db_write_batch_size', 'Writes applied in each transaction by the writer thread',
+                                     (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+WRITE_SECONDS = metrics.histogram('db_write_seconds', 'Seconds taken to apply and commit each write transaction')
+QUERY_SECONDS = metrics.histogram('db_query_seconds', 'Seconds taken by each query')
 
 
 # TODO: Move to SQLAlchemy to utilise any number of DBs
@@ -29,6 +46,25 @@ class DbSqlite3Wrapper:
     db_file : str
         Stores the path and name of the database file to open
 
+    lock : RLock
+        Serialises use of the shared connection and cursor between threads
+
+    log_buffer : list
+        scrapers_log rows waiting to be written to the database
+
+    log_buffer_size : int
+        The number of buffered log rows that triggers a flush
+
+    log_flush_interval : float
+        The number of seconds buffered log rows can wait before they are flushed
+
+    writer_thread : bool
+        When True all writes are queued and applied in grouped transactions by a single writer thread with its own
+        connection, and queries run on a read connection per thread
+
+    write_batch_size : int
+        The maximum number of queued writes applied in one transaction by the writer thread
+
     Methods
     -----------
     connect(db_file)
@@ -44,35 +80,86 @@ class DbSqlite3Wrapper:
         Run the supplied query statement against the database, returns a list of the
         data found by the sql
 
+    iter_query(query_sql, query_params, chunk_size)
+        Run the supplied query statement against the database on its own connection, returns a generator
+        of lists of rows
+
     execute(cmd_sql, query_values)
         Run a sql command against the database and does not return anything
 
     update(cmd_sql, cmd_values)
         Updates an entry in the database
 
+    sync()
+        Waits until every queued write has been committed by the writer thread
+
+    transaction()
+        Runs statements in a transaction which holds the write lock from the start, on a connection of its own
+
     log_task(id, start_dt, end_dt, task_name, http_code, status_code, content, duration, owner)
-        Add a log entry for a task into the database for timings and errors
+        Add a log entry for a task into the log buffer for timings and errors
+
+    flush_logs(force)
+        Writes the buffered log entries to the database in a single transaction
+
+    log_flush_due_in()
+        Works out how long until the buffered log entries are due to be flushed
 
-    setup_scrapers_db()
+    migrate()
+        Bring the database up to the current schema
+
+    setup_scrapers_db(migrate)
         Create the initial database
 
     scrapers_sample_data()
         Add the sample data to the database for testing
     """
 
-    def __init__(self, db_file):
+    # Pragmas applied to every connection. WAL lets readers carry on while the writer commits and NORMAL
+    # sync is safe in WAL mode, it only risks the last transactions on power loss rather than corruption
+    pragmas = [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000"
+    ]
+
+    def __init__(self, db_file, log_buffer_size=100, log_flush_interval=5.0, writer_thread=False,
+                 write_batch_size=500):
         """ Standard class initializer method
         :param db_file: The name and path to the database file
+        :param log_buffer_size: The number of buffered log rows that triggers a flush
+        :param log_flush_interval: The number of seconds buffered log rows can wait before they are flushed
+        :param writer_thread: Apply all writes from a single writer thread
+        :param write_batch_size: The maximum number of queued writes applied in one transaction
         :returns: Nothing
         """
         self.db_file = db_file
+        self.db_name = os.path.basename(db_file)  # Labels the metrics of this database
         self.conn = None
         self.curs = None
+        self.lock = RLock()
+        self.log_buffer = []
+        self.log_buffer_size = log_buffer_size
+        self.log_flush_interval = log_flush_interval
+        self._log_buffer_started = monotonic()  # When the oldest buffered log row was added
+
+        # Writer thread mode
+        self.writer_thread = writer_thread
+        self.write_batch_size = write_batch_size
+        self._writer = None
+        self._write_queue = Queue(maxsize=10000)  # Bounded so producers are held back if the writer falls behind
+        self._submit_lock = Lock()  # Keeps write sequence numbers in queue order
+        self._write_seq = 0  # Sequence number of the last queued write
+        self._committed_seq = 0  # Sequence number of the last write committed by the writer thread
+        self._committed = Condition()
+        self._local = local()  # Per thread read connection and last queued write
+        self._read_conns = []
 
     def log_task(self, id, start_dt, end_dt, task_name, http_code=None, status_code=None, content=None,
                  duration=None, owner='scraper'):
         """
-        Logs a task into the database
+        Logs a task into the database. The row is buffered and written along with others by flush_logs
 
         :param id:              The ID of the process logging the task
         :param start_dt:        The start time of the task
@@ -86,21 +173,76 @@ class DbSqlite3Wrapper:
         :return:
         """
 
+        with self.lock:
+            if not self.log_buffer:
+                self._log_buffer_started = monotonic()
+            self.log_buffer.append((id, start_dt, end_dt, task_name, http_code, status_code, content, duration,
+                                    owner))
+
+        self.flush_logs(force=False)
+
+    def flush_logs(self, force=True):
+        """
+        Writes all of the buffered log rows to the database in a single transaction
+
+        :param force:   When False the rows are only written once the buffer is full or the flush interval has passed
+        :return:
+        """
         log_sql = "INSERT INTO scrapers_log(scraper_id, started, ended, task, http_code, status_code, content, " \
                   "duration, owner) " \
                   "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)"
 
-        log_values = [(id, start_dt, end_dt, task_name, http_code, status_code, content, duration, owner)]
+        with self.lock:
+            if not self.log_buffer:
+                return
+
+            if not force and len(self.log_buffer) < self.log_buffer_size and self.log_flush_due_in() > 0:
+                return
+
+            log_values = self.log_buffer
+            self.log_buffer = []
+
+            self.execute(log_sql, log_values)
 
-        self.execute(log_sql, log_values)
+    def log_flush_due_in(self):
+        """
+        Works out how long until the buffered log rows are due to be flushed
+
+        :return: The number of seconds until the flush is due, None if nothing is buffered
+        """
+        with self.lock:
+            if not self.log_buffer:
+                return None
+            return self.log_flush_interval - (monotonic() - self._log_buffer_started)
+
+    def _open_connection(self):
+        """Opens a new connection to the database with the tuned pragmas applied
+
+        :returns: The connection
+        """
+        # Scrapers may run on worker threads, access is serialised through self.lock or kept to one thread
+        conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
 
     def connect(self):
         """Connects to the requested database
         :returns: nothing
         """
         try:
-            self.conn = sqlite3.connect(self.db_file)
+            self.conn = self._open_connection()
             self.curs = self.conn.cursor()
+
+            if self.writer_thread:
+                self._writer = Thread(target=self._write_loop, name='db-writer', daemon=True)
+                self._writer.start()
+                WRITE_QUEUE_DEPTH.set_function(self._write_queue.qsize, db=self.db_name)
+
+            LOG_BUFFER_ROWS.set_function(lambda: len(self.log_buffer), db=self.db_name)
+
+            # Make sure buffered and queued rows are written even if close is never called
+            atexit.register(self.close)
         except sqlite3.Error as err:
             print(err)
 
@@ -109,7 +251,147 @@ class DbSqlite3Wrapper:
         :returns: Nothing
         """
         if self.conn:
+            self.flush_logs()
+
+            # Let the writer thread finish everything queued before it stops
+            if self._writer is not None:
+                self._write_queue.put(None)
+                self._writer.join()
+                self._writer = None
+
+            for read_conn in self._read_conns:
+                read_conn.close()
+            self._read_conns = []
+
+            WRITE_QUEUE_DEPTH.remove(db=self.db_name)
+            LOG_BUFFER_ROWS.remove(db=self.db_name)
+
             self.conn.close()
+            self.conn = None
+            atexit.unregister(self.close)
+
+    def _write_loop(self):
+        """The writer thread. Applies queued writes in grouped transactions on its own connection
+
+        :returns: Nothing
+        """
+        conn = self._open_connection()
+        curs = conn.cursor()
+        running = True
+
+        while running:
+            # Wait for a write then take whatever else is queued up to the batch size
+            batch = [self._write_queue.get()]
+            while len(batch) < self.write_batch_size:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except Empty:
+                    break
+
+            last_seq = None
+            with WRITE_SECONDS.time(db=self.db_name):
+                for entry in batch:
+                    if entry is None:
+                        running = False
+                        continue
+
+                    last_seq, cmd_sql, cmd_values = entry
+                    try:
+                        if len(cmd_values) == 0:
+                            curs.execute(cmd_sql)
+                        else:
+                            curs.executemany(cmd_sql, cmd_values)
+                    except sqlite3.Error as err:
+                        print(err)
+
+                try:
+                    conn.commit()
+                except sqlite3.Error as err:
+                    print(err)
+            WRITE_BATCH_SIZE.observe(sum(entry is not None for entry in batch), db=self.db_name)
+
+            if last_seq is not None:
+                with self._committed:
+                    self._committed_seq = last_seq
+                    self._committed.notify_all()
+
+            for entry in batch:
+                self._write_queue.task_done()
+
+        conn.close()
+
+    def _submit(self, cmd_sql, cmd_values):
+        """Queues a write for the writer thread
+
+        :param cmd_sql: The sql to execute
+        :param cmd_values: A list of tuples of the parameters for the sql
+        :returns: The sequence number of the queued write
+        """
+        with self._submit_lock:
+            self._write_seq += 1
+            seq = self._write_seq
+            self._write_queue.put((seq, cmd_sql, cmd_values))
+
+        self._local.last_write = seq
+        return seq
+
+    def _wait_for_write(self, seq):
+        """Waits until a queued write has been committed
+
+        :param seq: The sequence number of the write
+        :returns: Nothing
+        """
+        with self._committed:
+            while self._committed_seq < seq and self._writer is not None and self._writer.is_alive():
+                self._committed.wait(1)
+
+    def sync(self):
+        """Waits until every write queued so far has been committed
+
+        :returns: Nothing
+        """
+        if self._writer is not None:
+            self._wait_for_write(self._write_seq)
+
+    @contextmanager
+    def transaction(self):
+        """Runs statements in a transaction which takes the database's write lock from the start, so rows read in it
+        can not be changed by another connection or process before it commits. Each thread has a connection of its
+        own for these transactions, apart from the shared and writer thread connections
+
+        Committed when the block finishes, rolled back if it raises
+
+        :returns: A context manager giving the cursor to run the statements with
+        """
+        conn = getattr(self._local, 'transaction_conn', None)
+        if conn is None:
+            conn = self._open_connection()
+            self._local.transaction_conn = conn
+            with self.lock:
+                self._read_conns.append(conn)
+
+        curs = conn.cursor()
+        curs.execute("BEGIN IMMEDIATE")
+        try:
+            yield curs
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def _read_connection(self):
+        """Gets the calling thread's read connection, opening it on first use
+
+        :returns: The connection
+        """
+        read_conn = getattr(self._local, 'conn', None)
+        if read_conn is None:
+            read_conn = self._open_connection()
+            self._local.conn = read_conn
+            with self.lock:
+                self._read_conns.append(read_conn)
+        return read_conn
 
     def create_table(self, table_sql):
         """Create a table within the database
@@ -118,7 +400,12 @@ class DbSqlite3Wrapper:
         :returns: Nothing
         """
         try:
-            self.curs.execute(table_sql)
+            if self._writer is not None:
+                self._wait_for_write(self._submit(table_sql, []))
+                return True
+
+            with self.lock:
+                self.curs.execute(table_sql)
             return True
         except sqlite3.ProgrammingError as prog_err:
             print(prog_err)
@@ -132,12 +419,19 @@ class DbSqlite3Wrapper:
         :returns: An iterable resultset of data
         """
         try:
-            if len(query_params) == 0:
-                self.curs.execute(query_sql)
-                return self.curs.fetchall()
-            else:
-                self.curs.execute(query_sql, query_params)
-                return self.curs.fetchall()
+            if self._writer is not None:
+                # Make sure this thread sees its own queued writes
+                self._wait_for_write(getattr(self._local, 'last_write', 0))
+                with QUERY_SECONDS.time(db=self.db_name):
+                    return self._read_connection().execute(query_sql, query_params).fetchall()
+
+            with self.lock, QUERY_SECONDS.time(db=self.db_name):
+                if len(query_params) == 0:
+                    self.curs.execute(query_sql)
+                    return self.curs.fetchall()
+                else:
+                    self.curs.execute(query_sql, query_params)
+                    return self.curs.fetchall()
         except sqlite3.OperationalError as op_err:
             print(op_err)
         except sqlite3.ProgrammingError as prog_err:
@@ -145,6 +439,38 @@ class DbSqlite3Wrapper:
         except sqlite3.Error as err:
             print(err)
 
+    def iter_query(self, query_sql, query_params=[], chunk_size=1000):
+        """Performs a query against the database, returning the rows a chunk at a time rather than all at once
+
+        The query runs on its own connection so it does not hold up other users of the database while the rows
+        are being worked through
+
+        :param query_sql: The sql you wish to be executed against the database
+        :param query_params: Any paramitesed query values needed to be added to the sql
+        :param chunk_size: The number of rows fetched at a time
+        :returns: A generator of lists of up to chunk_size rows
+        """
+        # Make sure this thread sees its own queued writes
+        self.sync()
+
+        try:
+            conn = self._open_connection()
+        except sqlite3.Error as err:
+            print(err)
+            return
+
+        try:
+            curs = conn.execute(query_sql, query_params)
+            while True:
+                rows = curs.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield rows
+        except sqlite3.Error as err:
+            print(err)
+        finally:
+            conn.close()
+
     def execute(self, cmd_sql, query_values=[]):
         """Executes a sql command against the database and returns nothing
 
@@ -153,12 +479,17 @@ class DbSqlite3Wrapper:
         :returns: Nothing
         """
         try:
-            if len(query_values) == 0:
-                self.curs.execute(cmd_sql)
-                self.conn.commit()
-            else:
-                self.curs.executemany(cmd_sql, query_values)
-                self.conn.commit()
+            if self._writer is not None:
+                self._submit(cmd_sql, query_values)
+                return
+
+            with self.lock, WRITE_SECONDS.time(db=self.db_name):
+                if len(query_values) == 0:
+                    self.curs.execute(cmd_sql)
+                    self.conn.commit()
+                else:
+                    self.curs.executemany(cmd_sql, query_values)
+                    self.conn.commit()
         except sqlite3.OperationalError as op_err:
             print(op_err)
         except sqlite3.ProgrammingError as prog_err:
@@ -175,20 +506,42 @@ class DbSqlite3Wrapper:
         :return:
         """
         try:
-            self.curs.executemany(cmd_sql, cmd_values)
-            self.conn.commit()
+            if self._writer is not None:
+                self._submit(cmd_sql, cmd_values)
+                return
+
+            with self.lock, WRITE_SECONDS.time(db=self.db_name):
+                self.curs.executemany(cmd_sql, cmd_values)
+                self.conn.commit()
+        except sqlite3.Error as err:
+            print(err)
+
+    def migrate(self):
+        """
+        Brings the database up to the current schema
+
+        :return: The schema version of the database, None if the migration failed
+        """
+        # Any queued schema changes have to be in place before we look at the schema
+        self.sync()
+
+        try:
+            with self.lock:
+                return migrations.migrate(self.conn)
         except sqlite3.Error as err:
             print(err)
 
-    def setup_scrapers_db(self):
+    def setup_scrapers_db(self, migrate=True):
         """
 
         Creates the scarpers database locally
 
+        :param migrate:     Bring the new tables up to the current schema
         :return:
         """
 
-        # SQL for creating tables
+        # SQL for creating tables, these are the tables as first released and migrations.py takes them
+        # up to the current schema
         scrapers_table_sql = "CREATE TABLE scrapers(id INTEGER PRIMARY KEY, name TEXT NOT NULL, description TEXT NULL, " \
                              "enabled INTEGER DEFAULT 0, " \
                              "last_updated TEXT NULL, status_code INTEGER NULL, customer_id INTEGER NOT NULL, " \
@@ -220,6 +573,9 @@ class DbSqlite3Wrapper:
             self.create_table(scrapers_log_sql)
             self.create_table(raw_data_sql)
 
+            if migrate:
+                self.migrate()
+
     def scrapers_sample_data(self):
         """
 
@@ -0,0 +1,589 @@
+""" Extraction plans
+
+    Compiles a scraper's rules into an extraction plan once, rather than splitting the rule strings and searching
+    the page with them on every run. The plan can run on one of two parser backends:
+
+    - lxml   Parses with lxml and runs precompiled XPath expressions. Much faster on large pages
+    - bs4    Parses with BeautifulSoup, using the lxml parser when it is installed
+
+    Plans can also parse only the parts of the page matched by the searches rule, so headers, footers, scripts and
+    everything else around the search results are never built into a tree. The same scan can be run over a page as
+    it is downloaded so the download can stop as soon as the search results have been received.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import codecs
+import re
+from collections import OrderedDict
+from datetime import datetime as dt
+from threading import Lock
+from time import perf_counter
+from bs4 import BeautifulSoup as BS, SoupStrainer
+from ScraperConfig import configuration
+
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:
+    etree = None
+    lxml_html = None
+
+# Rules which pick the fields out of each product, in the order they are extracted
+FIELD_RULES = ('title', 'price', 'stock')
+
+
+PRICE_PATTERN = re.compile(r'\d[\d,.]*')
+
+# The attribute names a rule can match on
+ATTRIBUTE_PATTERN = re.compile(r'[A-Za-z_][\w.-]*$')
+
+
+def normalize_price(text):
+    """Turns a displayed price such as '£1,299.99' into a number
+
+    :param text: The price as shown on the page
+    :return: The price as a float, None if there is no number in the text
+    """
+    if not text:
+        return None
+
+    found = PRICE_PATTERN.search(text)
+    if found is None:
+        return None
+
+    number = found.group().rstrip('.,')
+
+    # Whichever of , and . comes last is the decimal separator, unless a lone , is followed by three digits
+    # in which case it separates the thousands
+    if ',' in number and '.' in number:
+        if number.rindex(',') > number.rindex('.'):
+            number = number.replace('.', '').replace(',', '.')
+        else:
+            number = number.replace(',', '')
+    elif ',' in number:
+        whole, sep, fraction = number.rpartition(',')
+        if len(fraction) == 3 or whole.count(','):
+            number = number.replace(',', '')
+        else:
+            number = whole.replace(',', '') + '.' + fraction
+    elif number.count('.') > 1:
+        number = number.replace('.', '')
+
+    try:
+        return float(number)
+    except ValueError:
+        return None
+
+
+class ExtractionError(Exception):
+    """Raised when a scraper's rules can not be compiled into a plan or a page can not be parsed with them"""
+
+
+def parse_rule(rule):
+    """Splits a rule value such as 'class/products-list' into its attribute and value
+
+    :param rule: The rule value
+    :return: A tuple of (attribute, value), None if the rule is empty
+    """
+    if not rule:
+        return None
+
+    attribute, sep, value = rule.partition('/')
+    if not sep or not attribute:
+        raise ExtractionError("Invalid rule '{}', expected attribute/value".format(rule))
+    if not ATTRIBUTE_PATTERN.match(attribute):
+        raise ExtractionError("Invalid attribute '{}' in rule '{}'".format(attribute, rule))
+
+    return attribute, value
+
+
+def xpath_literal(value):
+    """Quotes a string for use in an XPath expression. XPath has no escapes, so a string holding both kinds of quote
+    is built up with concat()
+
+    :param value: The string
+    :return: The XPath string literal
+    """
+    if "'" not in value:
+        return "'{}'".format(value)
+    if '"' not in value:
+        return '"{}"'.format(value)
+    return "concat('{}')".format("', \"'\", '".join(value.split("'")))
+
+
+class Bs4Backend:
+    """
+    Runs an extraction plan with BeautifulSoup
+
+    :param rules: Dictionary of the parsed searches, products and field rules
+    """
+
+    name = 'bs4'
+    parser = 'lxml' if etree is not None else 'html.parser'
+
+    def __init__(self, rules):
+        # BeautifulSoup attribute filters, built once
+        self.filters = {name: {rule[0]: rule[1]} for name, rule in rules.items() if rule is not None}
+
+    def parse(self, text):
+        return BS(text, self.parser)
+
+    def parse_containers(self, text):
+        """Parses only the elements matched by the searches rule
+
+        :param text: The html of the page
+        :return: The matched elements
+        """
+        document = BS(text, self.parser, parse_only=SoupStrainer(attrs=self.filters['searches']))
+        return self.containers(document)
+
+    def parse_fragments(self, fragments):
+        """Parses the html of elements matched by the searches rule
+
+        :param fragments: The html of each matched element
+        :return: The matched elements
+        """
+        containers = []
+        for fragment in fragments:
+            containers += self.containers(BS(fragment, self.parser))[:1]
+        return containers
+
+    def containers(self, document):
+        return document.find_all(attrs=self.filters['searches'])
+
+    def products(self, container):
+        return container.find_all(attrs=self.filters['products'])
+
+    def field(self, product, name):
+        if name not in self.filters:
+            return None
+
+        found = product.find(attrs=self.filters[name])
+        if found is None:
+            return None
+        return found.get_text().strip()
+
+
+class LxmlBackend:
+    """
+    Runs an extraction plan with lxml using precompiled XPath expressions
+
+    :param rules: Dictionary of the parsed searches, products and field rules
+    """
+
+    name = 'lxml'
+
+    def __init__(self, rules):
+        self.searches_pattern = container_pattern(rules['searches'])
+        self.expressions = {}
+        for name, rule in rules.items():
+            if rule is None:
+                continue
+
+            # The searches rule is looked for across the whole page, the others within the element above them
+            scope = '//*' if name == 'searches' else './/*'
+            expression = "{}[{}]".format(scope, self.predicate(rule))
+            if name in FIELD_RULES:
+                expression = "({})[1]".format(expression)
+            try:
+                self.expressions[name] = etree.XPath(expression)
+            except etree.XPathSyntaxError as err:
+                raise ExtractionError("Unable to compile the {} rule: {}".format(name, err))
+
+    @staticmethod
+    def predicate(rule):
+        """Builds the XPath predicate matching a rule the same way BeautifulSoup does
+
+        :param rule: Tuple of (attribute, value)
+        :return: The predicate
+        """
+        attribute, value = rule
+        literal = xpath_literal(value)
+
+        # Classes are matched against each of the element's classes rather than the whole attribute
+        if attribute == 'class':
+            return "contains(concat(' ', normalize-space(@class), ' '), concat(' ', {}, ' '))".format(literal)
+        return "@{}={}".format(attribute, literal)
+
+    def parse(self, text):
+        if not text.strip():
+            return None
+        return lxml_html.document_fromstring(text)
+
+    def parse_containers(self, text):
+        """Parses only the elements matched by the searches rule
+
+        :param text: The html of the page
+        :return: The matched elements
+        """
+        return self.parse_fragments(prescan_containers(text, self.searches_pattern))
+
+    def parse_fragments(self, fragments):
+        """Parses the html of elements matched by the searches rule
+
+        :param fragments: The html of each matched element
+        :return: The matched elements
+        """
+        containers = []
+        for fragment in fragments:
+            # Only the matched element is wanted, anything after it that was caught up in the fragment is dropped
+            containers += [element for element in lxml_html.fragments_fromstring(fragment)
+                           if not isinstance(element, str)][:1]
+        return containers
+
+    def containers(self, document):
+        if document is None:
+            return []
+        return self.expressions['searches'](document)
+
+    def products(self, container):
+        return self.expressions['products'](container)
+
+    def field(self, product, name):
+        if name not in self.expressions:
+            return None
+
+        found = self.expressions[name](product)
+        if not found:
+            return None
+        return ''.join(found[0].itertext()).strip()
+
+
+def container_pattern(rule):
+    """Builds the regular expression which finds the start tags matching a rule
+
+    :param rule: Tuple of (attribute, value)
+    :return: The compiled expression, the tag name is captured as 'tag'
+    """
+    attribute, value = rule
+    value = re.escape(value)
+
+    # Classes are matched against each of the element's classes rather than the whole attribute
+    if attribute == 'class':
+        value = r'(?:[^"\'>]*\s)?{}(?:\s[^"\'>]*)?'.format(value)
+
+    return re.compile(r'<(?P<tag>[a-zA-Z][\w:-]*)(?=[^>]*?\s{}\s*=\s*(?P<quote>["\']){}(?P=quote))[^>]*>'.format(
+        re.escape(attribute), value), re.IGNORECASE)
+
+
+def tag_pattern(tag):
+    """Builds the regular expression which walks the opening and closing tags of an element. Comments, scripts and
+    styles are matched as a whole so tags inside them are not counted
+
+    :param tag: The name of the element's tag
+    :return: The compiled expression. A match with 'skip' set is a comment, script or style, with 'unclosed_comment'
+             or 'unclosed_raw' set as well if it runs to the end of the text. Otherwise 'close' is '/' for a closing
+             tag
+    """
+    return re.compile(r'(?P<skip><!--(?:.*?-->|(?P<unclosed_comment>.*))'
+                      r'|<(?P<raw>script|style)\b[^>]*>(?:.*?</(?P=raw)\s*>|(?P<unclosed_raw>.*)))'
+                      r'|<(?P<close>/?){}\b[^>]*>'.format(re.escape(tag)), re.IGNORECASE | re.DOTALL)
+
+
+def prescan_containers(text, pattern):
+    """Finds the html of every element matched by the searches rule without parsing the page
+
+    :param text:    The html of the page
+    :param pattern: The expression from container_pattern
+    :return: A list of the html of each matched element, an element that is never closed runs to the end of the page
+    """
+    containers = []
+    position = 0
+
+    while True:
+        start = pattern.search(text, position)
+        if start is None:
+            return containers
+
+        # Walk the opening and closing tags of the same name to find where the element ends
+        tags = tag_pattern(start.group('tag'))
+        depth = 1
+        end = len(text)
+        for tag in tags.finditer(text, start.end()):
+            if tag.group('skip') is not None:
+                continue
+            depth += -1 if tag.group('close') else 1
+            if depth == 0:
+                end = tag.end()
+                break
+
+        containers.append(text[start.start():end])
+        position = end
+
+
+class StreamScanner:
+    """
+    Finds the first element matched by the searches rule in a page as it is downloaded
+
+    Only the matched element is held once it has been found, along with a short tail of the page before it in case
+    its start tag is split between chunks.
+
+    :param pattern:     The expression from container_pattern
+    :param encoding:    The character encoding of the page
+
+    Methods
+    -----------
+    feed(data)
+        Scans the next chunk of the page
+
+    finish()
+        Finishes scanning and returns the html of the matched element
+    """
+
+    # Characters kept from the end of the page while looking for the start tag
+    tail_length = 4096
+
+    def __init__(self, pattern, encoding='utf-8'):
+        try:
+            decoder = codecs.getincrementaldecoder(encoding or 'utf-8')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')
+
+        self.decoder = decoder(errors='replace')
+        self.pattern = pattern
+        self.buffer = ''
+        self.tags = None  # Expression for the matched element's tags, set once the start tag is found
+        self.depth = 0
+        self.position = 0  # Where to carry on scanning the buffer from
+        self.container = None
+
+    @property
+    def complete(self):
+        """True once the matched element has been closed"""
+        return self.container is not None
+
+    def feed(self, data):
+        """Scans the next chunk of the page
+
+        :param data: The chunk as bytes
+        :return: True once the matched element is complete and there is no need to read any more
+        """
+        if not self.complete:
+            self._scan(self.decoder.decode(data))
+        return self.complete
+
+    def _scan(self, text):
+        self.buffer += text
+
+        if self.tags is None:
+            start = self.pattern.search(self.buffer)
+            if start is None:
+                self.buffer = self.buffer[-self.tail_length:]
+                return
+
+            self.buffer = self.buffer[start.start():]
+            self.tags = tag_pattern(start.group('tag'))
+            self.depth = 1
+            self.position = start.end() - start.start()
+
+        # Walk the opening and closing tags of the same name until the element closes
+        for tag in self.tags.finditer(self.buffer, self.position):
+            if tag.group('unclosed_comment') is not None or tag.group('unclosed_raw') is not None:
+                # The rest of the comment or script has not arrived yet, carry on from its start with the next chunk
+                self.position = tag.start()
+                return
+
+            self.position = tag.end()
+            if tag.group('skip') is not None:
+                continue
+            self.depth += -1 if tag.group('close') else 1
+            if self.depth == 0:
+                self.container = self.buffer[:tag.end()]
+                self.buffer = ''
+                return
+
+    def finish(self):
+        """Finishes scanning the page
+
+        :return: A list holding the html of the matched element, an element that is never closed runs to the end of
+                 what was read. Empty if nothing matched
+        """
+        if not self.complete:
+            self._scan(self.decoder.decode(b'', final=True))
+
+        if self.container is not None:
+            return [self.container]
+        if self.tags is not None:
+            return [self.buffer]
+        return []
+
+
+BACKENDS = {
+    'bs4': Bs4Backend,
+    'lxml': LxmlBackend,
+}
+
+
+class ExtractionPlan:
+    """
+    A scraper's rules compiled ready to extract the products from a page
+
+    :param rules:   The scraper's rules as {'rule_name': 'rule_value'}
+    :param backend: The name of the parser backend to use, falls back to bs4 when lxml is not installed
+
+    Methods
+    -----------
+    extract(text, partial)
+        Extracts every product from the page
+
+    scanner(encoding)
+        Creates a StreamScanner to find the search results in a page as it is downloaded
+
+    extract_fragments(fragments)
+        Extracts every product from the html of the elements matched by the searches rule
+    """
+
+    def __init__(self, rules, backend='lxml'):
+        if backend == 'lxml' and etree is None:
+            backend = 'bs4'
+        if backend not in BACKENDS:
+            raise ExtractionError("Unknown parser backend '{}'".format(backend))
+
+        parsed = {name: parse_rule(rules.get(name)) for name in ('searches', 'products') + FIELD_RULES}
+        for required in ('searches', 'products'):
+            if parsed[required] is None:
+                raise ExtractionError("The {} rule is required".format(required))
+
+        self.rules = parsed
+        self.backend = BACKENDS[backend](parsed)
+        self.searches_pattern = container_pattern(parsed['searches'])
+
+    def extract(self, text, partial=False):
+        """Extracts every product from a page
+
+        :param text: The html of the page
+        :param partial: Only parse the parts of the page matched by the searches rule, the whole page is parsed if
+                        the rule matches nothing, the matched parts can not be parsed or hold no products
+        :return: A list of dictionaries, one per product, of the title, price and stock found
+        """
+        if partial:
+            try:
+                items = self.extract_from(self.backend.parse_containers(text))
+            except Exception as err:
+                print("Unable to parse the search results on their own, parsing the whole page: {}".format(err))
+                items = []
+            if items:
+                return items
+
+        try:
+            document = self.backend.parse(text)
+            return self.extract_from(self.backend.containers(document))
+        except Exception as err:
+            raise ExtractionError("Unable to parse the page: {}".format(err)) from err
+
+    def scanner(self, encoding='utf-8'):
+        """Creates a scanner to find the search results in a page as it is downloaded
+
+        :param encoding: The character encoding of the page
+        :return: A StreamScanner
+        """
+        return StreamScanner(self.searches_pattern, encoding)
+
+    def extract_fragments(self, fragments):
+        """Extracts every product from the html of the elements matched by the searches rule
+
+        :param fragments: The html of each matched element, as returned by StreamScanner.finish
+        :return: A list of dictionaries, one per product, of the title, price and stock found
+        """
+        try:
+            return self.extract_from(self.backend.parse_fragments(fragments))
+        except Exception as err:
+            raise ExtractionError("Unable to parse the search results: {}".format(err)) from err
+
+    def extract_from(self, containers):
+        """Extracts every product from the elements matched by the searches rule
+
+        :param containers: The matched elements as parsed by the plan's backend
+        :return: A list of dictionaries, one per product, of the title, price and stock found
+        """
+        items = []
+        for container in containers:
+            for product in self.backend.products(container):
+                items.append({name: self.backend.field(product, name) for name in FIELD_RULES})
+        return items
+
+
+# Compiled plans, keyed by backend and rules so a plan is only rebuilt when a scraper's rules change. The least
+# recently used plans are dropped once there are more than plan_cache_size
+_plans = OrderedDict()
+_plans_lock = Lock()
+
+
+def get_plan(rules, backend='lxml'):
+    """Gets the compiled extraction plan for a set of rules
+
+    :param rules:   The scraper's rules as {'rule_name': 'rule_value'}
+    :param backend: The name of the parser backend to use
+    :return: The ExtractionPlan
+    """
+    key = (backend,) + tuple(rules.get(name) for name in ('searches', 'products') + FIELD_RULES)
+
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan
+
+        plan = ExtractionPlan(rules, backend)
+        _plans[key] = plan
+        while len(_plans) > max(configuration.get('plan_cache_size', 1024), 1):
+            _plans.popitem(last=False)
+        return plan
+
+
+def extract_items(rules, backend, partial, text, fragments=None, truncated=False):
+    """Extracts every product from a page using the cached plan for the rules. Only takes plain data so it can be
+    run in a worker process
+
+    :param rules:       The scraper's rules as {'rule_name': 'rule_value'}
+    :param backend:     The name of the parser backend to use
+    :param partial:     Only parse the parts of the page matched by the searches rule
+    :param text:        The html of the page
+    :param fragments:   The html of the matched elements if the page has already been scanned for them. When none
+                        were matched the whole page is parsed
+    :param truncated:   The page was cut off at the size limit, so without any matched elements it can not be parsed
+    :return: A list of dictionaries, one per product, of the title, price and stock found
+    """
+    plan = get_plan(rules, backend)
+
+    if fragments:
+        return plan.extract_fragments(fragments)
+    if truncated:
+        raise ExtractionError("The search results were not found before the page reached the size limit")
+    return plan.extract(text, partial)
+
+
+def extract_pages(rules, backend, partial, pages):
+    """Runs extract_items over every page of a run. A page which can not be parsed is reported and gives None
+    rather than failing the run
+
+    :param pages: A list holding (text, fragments, truncated) for each page to extract from, or None for a page to
+                  skip
+    :return: A list of the items found on each page, None for a page which could not be parsed
+    """
+    pages_items = []
+    for number, page in enumerate(pages, 1):
+        items = []
+        if page is not None:
+            try:
+                items = extract_items(rules, backend, partial, *page)
+            except ExtractionError as err:
+                print("Unable to extract page {} of {}: {}".format(number, rules.get('url'), err))
+                items = None
+        pages_items.append(items)
+    return pages_items
+
+
+def timed_extract_pages(rules, backend, partial, pages):
+    """Runs extract_pages over every page of a run and times it
+
+    :param pages: A list holding (text, fragments, truncated) for each page to extract from, or None for a page to
+                  skip
+    :return: A tuple of (a list of the items found on each page, start datetime, end datetime, duration in seconds)
+    """
+    start = perf_counter()
+    start_dt = dt.now()
+    pages_items = extract_pages(rules, backend, partial, pages)
+    return pages_items, start_dt, dt.now(), perf_counter() - start
@@ -0,0 +1,197 @@
+""" Scraper leases
+
+    Lets several factories, in separate processes or on separate machines, share the scrapers in one database
+    without running any scraper twice. When to run each scraper next is kept in the scrapers table rather than in
+    each factory, and a factory claims a due scraper by taking a lease on it:
+
+    - claim     Takes leases on due scrapers that nobody else holds, in one transaction so no two factories can
+                claim the same scraper
+    - renew     A heartbeat thread extends the leases while the scrapers run
+    - release   Drops the lease once a run finishes and records when the scraper is next due
+
+    A factory which dies stops renewing its leases, so once they expire its scrapers are claimed by the others.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import os
+import socket
+import sqlite3
+import threading
+import uuid
+from time import time
+from metrics import get_metrics
+
+# Metrics recorded by the leases
+metrics = get_metrics()
+CLAIMED = metrics.counter('lease_claimed_total', 'Scrapers claimed by this process')
+TAKEN_OVER = metrics.counter('lease_taken_over_total', 'Scrapers claimed after the lease of another process expired')
+HELD = metrics.gauge('lease_held', 'Scrapers this process holds the lease of')
+
+
+class LeaseManager:
+    """
+    Claims, renews and releases the leases of one factory
+
+    :param dbo:             Database object for querying and executing commands
+    :param lease_seconds:   Seconds a lease lasts without being renewed
+    :param renew_interval:  Seconds between renewals of the leases held, defaults to a third of lease_seconds
+    :param owner:           Identifies this factory in the lease_owner column, defaults to the host, pid and a
+                            random suffix
+
+    Methods
+    -----------
+    start()
+        Starts the heartbeat thread renewing the leases
+
+    claim(now, limit)
+        Claims up to limit due scrapers
+
+    release(scraper_id, next_due)
+        Releases the lease on a scraper which has finished running
+
+    next_claim_at(now)
+        Works out when a scraper can next be claimed
+
+    renew()
+        Extends every lease held
+
+    stop()
+        Stops the heartbeat thread and releases every lease still held
+    """
+
+    def __init__(self, dbo, lease_seconds=300.0, renew_interval=None, owner=None):
+        self.dbo = dbo
+        self.lease_seconds = lease_seconds
+        self.renew_interval = renew_interval or lease_seconds / 3
+        self.owner = owner or "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def start(self):
+        """Starts the heartbeat thread renewing the leases held
+
+        :return: The LeaseManager
+        """
+        HELD.set_function(lambda: len(self.held), owner=self.owner)
+        self.heartbeat = threading.Thread(target=self._heartbeat_loop, name='lease-heartbeat', daemon=True)
+        self.heartbeat.start()
+        return self
+
+    def _heartbeat_loop(self):
+        """Renews the leases every renew_interval seconds until stopped
+
+        :return: Nothing
+        """
+        while not self.stopped.wait(self.renew_interval):
+            self.renew()
+
+    def claim(self, now, limit):
+        """Claims up to limit scrapers which are due and not leased by anyone else, the longest overdue first
+
+        :param now:     The current timestamp
+        :param limit:   The most scrapers to claim
+        :return: A list of the ids of the scrapers claimed
+        """
+        if limit <= 0:
+            return []
+
+        due_sql = "SELECT id, lease_owner FROM scrapers WHERE enabled = 1 AND COALESCE(next_due, 0) <= ? " \
+                  "AND (lease_owner IS NULL OR lease_expires < ?) ORDER BY next_due LIMIT ?"
+        lease_sql = "UPDATE scrapers SET lease_owner = ?, lease_expires = ? WHERE id = ?"
+
+        try:
+            with self.dbo.transaction() as curs:
+                due = curs.execute(due_sql, [now, now, limit]).fetchall()
+                curs.executemany(lease_sql, [(self.owner, now + self.lease_seconds, scraper_id)
+                                             for scraper_id, lease_owner in due])
+        except sqlite3.Error as err:
+            print("Unable to claim scrapers: {}".format(err))
+            return []
+
+        for scraper_id, lease_owner in due:
+            if lease_owner is not None and lease_owner != self.owner:
+                print("Taking over scraper #{} from {}, its lease expired.".format(scraper_id, lease_owner))
+                TAKEN_OVER.inc()
+
+        claimed = [scraper_id for scraper_id, lease_owner in due]
+        with self.lock:
+            self.held.update(claimed)
+        CLAIMED.inc(len(claimed))
+
+        return claimed
+
+    def release(self, scraper_id, next_due=None):
+        """Releases the lease on a scraper, the release is skipped if the lease has since been taken over
+
+        :param scraper_id:  The ID of the scraper
+        :param next_due:    Timestamp of when the scraper is next due, None to leave it due straight away
+        :return: Nothing
+        """
+        with self.lock:
+            self.held.discard(scraper_id)
+
+        release_sql = "UPDATE scrapers SET lease_owner = NULL, lease_expires = NULL, " \
+                      "next_due = COALESCE(?, next_due) WHERE id = ? AND lease_owner = ?"
+        self.dbo.update(release_sql, [(next_due, scraper_id, self.owner)])
+
+    def next_claim_at(self, now):
+        """Works out when a scraper can next be claimed, the earliest a scraper becomes due or a lease expires
+
+        :param now: The current timestamp
+        :return: The timestamp, None if there are no enabled scrapers
+        """
+        # A lease always has an expiry, so the scrapers split into those without a lease, those whose lease is
+        # held and those whose lease has expired. Each part is read from idx_scrapers_lease_expires a row at a
+        # time, rather than working out when every scraper can be claimed. A lease that is held is waited on until
+        # it expires, by then it has either been released or is taken over once the scraper is due
+        next_sql = "SELECT MIN(next_at) FROM (" \
+                   "SELECT * FROM (SELECT COALESCE(next_due, 0) AS next_at FROM scrapers " \
+                   "WHERE enabled = 1 AND lease_expires IS NULL ORDER BY next_due LIMIT 1) " \
+                   "UNION ALL SELECT * FROM (SELECT lease_expires FROM scrapers " \
+                   "WHERE enabled = 1 AND lease_expires >= ? ORDER BY lease_expires LIMIT 1) " \
+                   "UNION ALL SELECT * FROM (SELECT COALESCE(next_due, 0) FROM scrapers " \
+                   "WHERE enabled = 1 AND lease_expires < ? ORDER BY next_due LIMIT 1))"
+        for next_at in self.dbo.query(next_sql, [now, now]) or []:
+            return next_at[0]
+
+        return None
+
+    def renew(self):
+        """Extends every lease held, from the heartbeat thread so leases are kept while scrapers run
+
+        :return: Nothing
+        """
+        with self.lock:
+            if not self.held:
+                return
+
+        # Written straight away rather than queued behind other writes, a late renewal could let the lease expire
+        renew_sql = "UPDATE scrapers SET lease_expires = ? WHERE lease_owner = ?"
+        try:
+            with self.dbo.transaction() as curs:
+                curs.execute(renew_sql, [time() + self.lease_seconds, self.owner])
+        except sqlite3.Error as err:
+            print("Unable to renew scraper leases: {}".format(err))
+
+    def stop(self):
+        """Stops the heartbeat thread and releases any lease still held, so other factories can claim the scrapers
+        straight away rather than waiting for the leases to expire
+
+        :return: Nothing
+        """
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+
+        with self.lock:
+            self.held = set()
+
+        release_sql = "UPDATE scrapers SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ?"
+        self.dbo.update(release_sql, [(self.owner,)])
+        HELD.remove(owner=self.owner)
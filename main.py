@@ -8,25 +8,41 @@
 from ScraperConfig import configuration
 from database import DbSqlite3Wrapper
 from ScraperFactory import ScraperFactory
+from metrics import start_metrics_export
+from session_pool import get_session_pool
 
-# Perform some setup and create the initial objects
-database = DbSqlite3Wrapper(configuration['database_name'])
-database.connect()
-factory = ScraperFactory(database)
+# The asyncio engine needs aiohttp, so only import it when it has been asked for
+if configuration.get('execution_mode') == 'asyncio':
+    from async_scraper import AsyncScraperFactory as ScraperFactory
 
 
 def main():
     """
 
-    Runs the application
+    Runs the application. Everything is set up here rather than when the module is imported, as the parse
+    processes of the pipeline import the main module again when they start
 
     :return:
     """
-    factory.run()
+    # Perform some setup and create the initial objects
+    database = DbSqlite3Wrapper(configuration['database_name'], configuration.get('log_buffer_size', 100),
+                                configuration.get('log_flush_interval', 5.0),
+                                configuration.get('db_writer_thread', True),
+                                configuration.get('db_write_batch_size', 500))
+    database.connect()
+    database.migrate()
+    factory = ScraperFactory(database)
+    metrics_exporter = start_metrics_export()
+
+    try:
+        factory.run()
+    finally:
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
+        get_session_pool().close()
+        database.close()
 
 
 if __name__ == '__main__':
     # Run the application
     main()
-
-database.close()
@@ -0,0 +1,489 @@
+""" Metrics
+
+    Counters, gauges and latency histograms kept in memory, so throughput, queue depths and the time spent in each
+    stage of a run can be watched live without adding load to the database. Each metric is labelled, for example by
+    scraper, host and stage, and every combination of labels is counted separately.
+
+    The metrics are exported in the Prometheus text format, either served over http on metrics_port or written to
+    metrics_file every metrics_dump_interval seconds, both set in ScraperConfig.py.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import os
+import threading
+from bisect import bisect_left
+from datetime import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from time import perf_counter
+from ScraperConfig import configuration
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _label_key(labels):
+    """Turns a dictionary of labels into a hashable key, so the same labels in any order are counted together"""
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key, extra=None):
+    """Formats a label key the way the Prometheus text format expects, {name="value",...}"""
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = ('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    """Formats a sample value, whole numbers without a trailing .0"""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Timer:
+    """
+    Times a block of code, recording the duration into a histogram when it stops. Starts as soon as it is created
+    and can be used as a context manager
+
+    :param histogram:   The Histogram the duration is recorded in, None to only time the block
+    :param labels:      The labels the duration is recorded against
+
+    Methods
+    -----------
+    stop()
+        Stops the timer and records the duration
+    """
+
+    __slots__ = ('histogram', 'labels', 'start', 'start_dt', 'end_dt', 'duration')
+
+    def __init__(self, histogram=None, **labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = perf_counter()
+        self.start_dt = dt.now()
+        self.end_dt = None
+        self.duration = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def stop(self):
+        """Stops the timer and records the duration, only the first call has any effect
+
+        :return: The seconds since the timer started
+        """
+        if self.duration is None:
+            self.duration = perf_counter() - self.start
+            self.end_dt = dt.now()
+            if self.histogram is not None:
+                self.histogram.observe(self.duration, **self.labels)
+        return self.duration
+
+
+class Counter:
+    """
+    A count which only goes up, such as the number of requests made
+
+    :param name:    The name of the metric
+    :param help:    A description of the metric
+
+    Methods
+    -----------
+    inc(amount, **labels)
+        Adds to the count
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        """Adds to the count for the labels
+
+        :param amount: The amount to add
+        :return: Nothing
+        """
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        """Lists the samples to export
+
+        :return: A list of (name, label key, extra label, value)
+        """
+        with self.lock:
+            return [(self.name, key, None, value) for key, value in sorted(self.values.items())]
+
+
+class Gauge:
+    """
+    A value which goes up and down, such as the depth of a queue. The value can be set directly or read from a
+    function each time the metrics are exported
+
+    :param name:    The name of the metric
+    :param help:    A description of the metric
+
+    Methods
+    -----------
+    set(value, **labels)
+        Sets the value
+
+    set_function(function, **labels)
+        Reads the value from a function when the metrics are exported
+
+    remove(**labels)
+        Stops exporting the value for the labels
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = Lock()
+
+    def set(self, value, **labels):
+        """Sets the value for the labels
+
+        :param value: The new value
+        :return: Nothing
+        """
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function, **labels):
+        """Reads the value for the labels from a function each time the metrics are exported
+
+        :param function: Called with no arguments, returns the current value
+        :return: Nothing
+        """
+        self.set(function, **labels)
+
+    def remove(self, **labels):
+        """Stops exporting the value for the labels
+
+        :return: Nothing
+        """
+        with self.lock:
+            self.values.pop(_label_key(labels), None)
+
+    def samples(self):
+        """Lists the samples to export
+
+        :return: A list of (name, label key, extra label, value)
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+
+        samples = []
+        for key, value in values:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as err:
+                    print("Unable to read the {} metric: {}".format(self.name, err))
+                    continue
+            samples.append((self.name, key, None, value))
+        return samples
+
+
+class Histogram:
+    """
+    Counts values into buckets, such as how long requests take, so percentiles can be worked out from the counts
+
+    :param name:    The name of the metric
+    :param help:    A description of the metric
+    :param buckets: The upper bound of each bucket, in ascending order
+
+    Methods
+    -----------
+    observe(value, **labels)
+        Records a value
+
+    time(**labels)
+        Returns a started Timer which records its duration
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}  # label key: [bucket counts, sum, count]
+        self.lock = Lock()
+
+    def observe(self, value, **labels):
+        """Records a value against the labels
+
+        :param value: The value to record
+        :return: Nothing
+        """
+        key = _label_key(labels)
+        bucket = bisect_left(self.buckets, value)  # Buckets hold the values less than or equal to their bound
+
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.values[key] = entry
+            entry[0][bucket] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """Starts timing a block of code
+
+        :return: A started Timer, recording its duration against the labels when it stops
+        """
+        return Timer(self, **labels)
+
+    def samples(self):
+        """Lists the samples to export, the buckets are cumulative as the Prometheus text format expects
+
+        :return: A list of (name, label key, extra label, value)
+        """
+        with self.lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in sorted(self.values.items())]
+
+        samples = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket', key, ('le', _format_value(float(bound))), cumulative))
+            samples.append((self.name + '_sum', key, None, total))
+            samples.append((self.name + '_count', key, None, count))
+        return samples
+
+
+class Metrics:
+    """
+    The registry of every metric, created on first use by name so modules can declare the metrics they record
+
+    Methods
+    -----------
+    counter(name, help)
+        Returns the named Counter
+
+    gauge(name, help)
+        Returns the named Gauge
+
+    histogram(name, help, buckets)
+        Returns the named Histogram
+
+    render()
+        Formats every metric in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def _get(self, metric_class, name, *args):
+        """Gets a metric by name, creating it on first use
+
+        :param metric_class:    The class of the metric
+        :param name:            The name of the metric
+        :return: The metric
+        """
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args)
+                self.metrics[name] = metric
+            return metric
+
+    def counter(self, name, help):
+        """Gets the named Counter, creating it on first use"""
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        """Gets the named Gauge, creating it on first use"""
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        """Gets the named Histogram, creating it on first use"""
+        return self._get(Histogram, name, help, buckets)
+
+    def render(self):
+        """Formats every metric in the Prometheus text format
+
+        :return: The metrics as a string
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, key, extra, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(key, extra), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """
+    Makes the metrics available outside of the process, served over http and/or written to a file
+
+    :param metrics:         The Metrics to export
+    :param port:            The port to serve the metrics on at /metrics, None to not serve them
+    :param address:         The address to serve the metrics on
+    :param file_name:       The file to write the metrics to, None to not write them
+    :param dump_interval:   Seconds between writes of the file
+
+    Methods
+    -----------
+    start()
+        Starts serving and writing the metrics
+
+    dump()
+        Writes the metrics to the file
+
+    stop()
+        Stops serving the metrics and writes the file a final time
+    """
+
+    def __init__(self, metrics, port=None, address='127.0.0.1', file_name=None, dump_interval=15.0):
+        self.metrics = metrics
+        self.port = port
+        self.address = address
+        self.file_name = file_name
+        self.dump_interval = dump_interval
+        self.httpd = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """Starts serving the metrics and the thread writing them to the file
+
+        :return: The MetricsExporter
+        """
+        if self.port is not None:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+
+                    body = metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', CONTENT_TYPE)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            try:
+                self.httpd = ThreadingHTTPServer((self.address, self.port), Handler)
+                self.httpd.daemon_threads = True
+                self.threads.append(threading.Thread(target=self.httpd.serve_forever, name='metrics-server',
+                                                     daemon=True))
+                print("Serving metrics on http://{}:{}/metrics".format(self.address, self.httpd.server_address[1]))
+            except OSError as err:
+                print("Unable to serve metrics on port {}: {}".format(self.port, err))
+                self.httpd = None
+
+        if self.file_name is not None:
+            self.threads.append(threading.Thread(target=self._dump_loop, name='metrics-dump', daemon=True))
+
+        for thread in self.threads:
+            thread.start()
+
+        return self
+
+    def _dump_loop(self):
+        """Writes the metrics to the file every dump_interval seconds until stopped
+
+        :return: Nothing
+        """
+        while not self.stopped.wait(self.dump_interval):
+            self.dump()
+
+    def dump(self):
+        """Writes the metrics to the file. The file is replaced in one go so readers never see it half written
+
+        :return: Nothing
+        """
+        temp_name = self.file_name + '.tmp'
+        try:
+            with open(temp_name, 'w') as metrics_file:
+                metrics_file.write(self.metrics.render())
+            os.replace(temp_name, self.file_name)
+        except OSError as err:
+            print("Unable to write metrics to {}: {}".format(self.file_name, err))
+
+    def stop(self):
+        """Stops serving the metrics and writes the file a final time
+
+        :return: Nothing
+        """
+        self.stopped.set()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        if self.file_name is not None:
+            self.dump()
+
+
+# The process wide metrics, shared by everything recording them
+_metrics = None
+_metrics_lock = Lock()
+
+
+def get_metrics():
+    """Gets the process wide metrics, creating them on first use
+
+    :return: The Metrics object
+    """
+    global _metrics
+
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
+
+
+def start_metrics_export():
+    """Starts exporting the process wide metrics as set in the configuration
+
+    :return: The started MetricsExporter, None when neither metrics_port or metrics_file are set
+    """
+    port = configuration.get('metrics_port')
+    file_name = configuration.get('metrics_file')
+    if port is None and file_name is None:
+        return None
+
+    return MetricsExporter(get_metrics(), port, configuration.get('metrics_address', '127.0.0.1'), file_name,
+                           configuration.get('metrics_dump_interval', 15.0)).start()
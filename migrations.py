@@ -0,0 +1,207 @@
+""" Database migrations
+
+Brings a scrapers database created by setup_scrapers_db, or by any earlier version of the app, up to the current
+schema. The schema version is kept in the database's user_version pragma and each migration is applied, in its own
+transaction, only if the database is older than it.
+
+This script is intended to be imported from other scripts and not
+run on it's own.
+
+"""
+
+
+def _columns(curs, table):
+    """Gets the columns of a table
+
+    :param curs: The cursor to run the sql with
+    :param table: The name of the table
+    :return: A dictionary of {column name: is part of the primary key}
+    """
+    curs.execute("PRAGMA table_info({})".format(table))
+    return {column[1]: column[5] for column in curs.fetchall()}
+
+
+def _blob_store_and_validators(curs):
+    """Tables for the conditional request validators and the raw page blob store"""
+    curs.execute("CREATE TABLE IF NOT EXISTS scraper_validators(scraper_id INTEGER PRIMARY KEY, etag TEXT NULL, "
+                 "last_modified TEXT NULL, content_hash TEXT NULL, updated_at TEXT NULL)")
+
+    curs.execute("CREATE TABLE IF NOT EXISTS raw_blobs(hash TEXT PRIMARY KEY, encoding TEXT NOT NULL, "
+                 "size INTEGER NOT NULL, content BLOB NOT NULL)")
+
+    if 'content_hash' not in _columns(curs, 'raw_data'):
+        curs.execute("ALTER TABLE raw_data ADD COLUMN content_hash TEXT NULL")
+
+
+def _keys_and_indexes(curs):
+    """Gives raw_data a real primary key and indexes the lookups the scrapers and reports make"""
+
+    # raw_data was created with PRIMARY_KEY rather than PRIMARY KEY so its id is not a key and is always NULL.
+    # Rebuild it with the rowid as the id
+    if not _columns(curs, 'raw_data')['id']:
+        curs.execute("CREATE TABLE raw_data_new(id INTEGER PRIMARY KEY, scraper_id INTEGER NOT NULL, "
+                     "date_time TEXT NOT NULL, content TEXT NULL, http_code INTEGER NOT NULL, content_hash TEXT NULL)")
+        curs.execute("INSERT INTO raw_data_new(id, scraper_id, date_time, content, http_code, content_hash) "
+                     "SELECT rowid, scraper_id, date_time, content, http_code, content_hash FROM raw_data")
+        curs.execute("DROP TABLE raw_data")
+        curs.execute("ALTER TABLE raw_data_new RENAME TO raw_data")
+
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_raw_data_scraper_date ON raw_data(scraper_id, date_time)")
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_scrapers_log_scraper_task ON scrapers_log(scraper_id, task, started)")
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_rules_scraper ON rules(scraper_id)")
+
+
+def _products(curs):
+    """Table of the items extracted from each stored page"""
+    curs.execute("CREATE TABLE IF NOT EXISTS products(id INTEGER PRIMARY KEY, scraper_id INTEGER NOT NULL, "
+                 "run_at TEXT NOT NULL, title TEXT NULL, price REAL NULL, price_text TEXT NULL, stock TEXT NULL)")
+
+    # run_at matches the date_time of the raw_data row the items came from
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_products_scraper_run ON products(scraper_id, run_at)")
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_products_history ON products(scraper_id, title, run_at)")
+
+
+def _raw_data_pages(curs):
+    """Records which page of search results each raw_data row holds"""
+    if 'page' not in _columns(curs, 'raw_data'):
+        curs.execute("ALTER TABLE raw_data ADD COLUMN page INTEGER NOT NULL DEFAULT 1")
+
+
+def _config_versions(curs):
+    """Versions the scraper configuration so the factory only reloads the scrapers that have changed
+
+    Every insert, update or delete of a scraper or its rules moves config_state on to a new version and stamps the
+    scraper with it. Deleted scrapers are recorded in config_deletions against the version they were deleted at
+    """
+    if 'config_version' not in _columns(curs, 'scrapers'):
+        curs.execute("ALTER TABLE scrapers ADD COLUMN config_version INTEGER NOT NULL DEFAULT 0")
+
+    curs.execute("CREATE TABLE IF NOT EXISTS config_state(id INTEGER PRIMARY KEY CHECK (id = 1), "
+                 "version INTEGER NOT NULL)")
+    curs.execute("INSERT OR IGNORE INTO config_state(id, version) VALUES(1, 0)")
+    curs.execute("CREATE TABLE IF NOT EXISTS config_deletions(scraper_id INTEGER NOT NULL, version INTEGER NOT NULL)")
+
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_scrapers_config_version ON scrapers(config_version)")
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_config_deletions_version ON config_deletions(version)")
+
+    bump_sql = "UPDATE config_state SET version = version + 1 WHERE id = 1; " \
+               "UPDATE scrapers SET config_version = (SELECT version FROM config_state WHERE id = 1) WHERE id IN ({});"
+
+    # The run bookkeeping columns, last_updated and status_code, are written on every run so are left out
+    curs.execute("CREATE TRIGGER IF NOT EXISTS scrapers_config_insert AFTER INSERT ON scrapers "
+                 "BEGIN {} END".format(bump_sql.format('NEW.id')))
+    curs.execute("CREATE TRIGGER IF NOT EXISTS scrapers_config_update AFTER UPDATE OF name, description, enabled, "
+                 "customer_id, timeout, search_terms, run_frequency ON scrapers "
+                 "BEGIN {} END".format(bump_sql.format('NEW.id')))
+    curs.execute("CREATE TRIGGER IF NOT EXISTS scrapers_config_delete AFTER DELETE ON scrapers "
+                 "BEGIN UPDATE config_state SET version = version + 1 WHERE id = 1; "
+                 "INSERT INTO config_deletions(scraper_id, version) SELECT OLD.id, version FROM config_state "
+                 "WHERE id = 1; END")
+
+    curs.execute("CREATE TRIGGER IF NOT EXISTS rules_config_insert AFTER INSERT ON rules "
+                 "BEGIN {} END".format(bump_sql.format('NEW.scraper_id')))
+    curs.execute("CREATE TRIGGER IF NOT EXISTS rules_config_update AFTER UPDATE ON rules "
+                 "BEGIN {} END".format(bump_sql.format('NEW.scraper_id, OLD.scraper_id')))
+    curs.execute("CREATE TRIGGER IF NOT EXISTS rules_config_delete AFTER DELETE ON rules "
+                 "BEGIN {} END".format(bump_sql.format('OLD.scraper_id')))
+
+
+def _scraper_leases(curs):
+    """Lets several factories share the scrapers, each claims a due scraper by taking a lease on it
+
+    A scraper is due once next_due has passed and can be claimed while it has no lease_owner or its lease has
+    expired, so the scrapers of a factory which stops without releasing them are taken over once their leases run out
+    """
+    columns = _columns(curs, 'scrapers')
+    if 'lease_owner' not in columns:
+        curs.execute("ALTER TABLE scrapers ADD COLUMN lease_owner TEXT NULL")
+    if 'lease_expires' not in columns:
+        curs.execute("ALTER TABLE scrapers ADD COLUMN lease_expires REAL NULL")
+    if 'next_due' not in columns:
+        curs.execute("ALTER TABLE scrapers ADD COLUMN next_due REAL NULL")
+
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_scrapers_due ON scrapers(enabled, next_due)")
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_scrapers_lease_owner ON scrapers(lease_owner)")
+
+
+def _raw_data_transfer(curs):
+    """Records how each page came over the wire, its size before decoding, its content encoding and http version"""
+    columns = _columns(curs, 'raw_data')
+    if 'wire_bytes' not in columns:
+        curs.execute("ALTER TABLE raw_data ADD COLUMN wire_bytes INTEGER NULL")
+    if 'content_encoding' not in columns:
+        curs.execute("ALTER TABLE raw_data ADD COLUMN content_encoding TEXT NULL")
+    if 'http_version' not in columns:
+        curs.execute("ALTER TABLE raw_data ADD COLUMN http_version TEXT NULL")
+
+
+def _products_pages(curs):
+    """Records which page of a run each product came from, so the products of a single page can be replaced
+
+    The pages of a run share its run_at, so the page is taken from the raw_data row the products were stored against.
+    Products whose run had several pages stored under the same run_at can not be told apart and are put on the first
+    page, reprocessing the first page replaces them all and the later pages then add their own
+    """
+    if 'page' not in _columns(curs, 'products'):
+        curs.execute("ALTER TABLE products ADD COLUMN page INTEGER NOT NULL DEFAULT 1")
+        curs.execute("UPDATE products SET page = (SELECT MIN(r.page) FROM raw_data r WHERE r.scraper_id = "
+                     "products.scraper_id AND r.date_time = products.run_at) WHERE EXISTS (SELECT 1 FROM raw_data r "
+                     "WHERE r.scraper_id = products.scraper_id AND r.date_time = products.run_at)")
+
+
+def _lease_expiry_index(curs):
+    """Indexes the scrapers by lease expiry and due time, so a factory finds when it can next claim a scraper without
+    reading every scraper each time it wakes"""
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_scrapers_lease_expires ON scrapers(enabled, lease_expires, next_due)")
+
+
+# (version, description, migration function). Only ever add to the end of this list
+MIGRATIONS = [
+    (1, 'Add the blob store and conditional request validators', _blob_store_and_validators),
+    (2, 'Add keys and indexes', _keys_and_indexes),
+    (3, 'Add the products table', _products),
+    (4, 'Add the page number to raw_data', _raw_data_pages),
+    (5, 'Add configuration versions', _config_versions),
+    (6, 'Add scraper leases', _scraper_leases),
+    (7, 'Add transfer details to raw_data', _raw_data_transfer),
+    (8, 'Add the page number to products', _products_pages),
+    (9, 'Index scrapers by lease expiry', _lease_expiry_index),
+]
+
+
+def schema_version(conn):
+    """Gets the schema version of a database
+
+    :param conn: The connection to the database
+    :return: The version number, 0 for a database no migrations have been applied to
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Applies every migration the database has not had yet
+
+    :param conn: The connection to the database
+    :return: The schema version of the database afterwards
+    """
+    version = schema_version(conn)
+
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        print("Migrating database to version {}: {}".format(migration_version, description))
+
+        curs = conn.cursor()
+        try:
+            curs.execute("BEGIN")
+            migration(curs)
+            curs.execute("PRAGMA user_version = {}".format(migration_version))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        version = migration_version
+
+    return version
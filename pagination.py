@@ -0,0 +1,140 @@
+""" Pagination
+
+    Works out the further pages of search results from the first page, without parsing it. A scraper paginates when
+    it has a pagination rule, which is either:
+
+    - A page template added to the end of the search url, containing {page} where the page number goes, such as
+      ?page={page} or /page/{page}. The number of pages is read from the element matched by the page_count rule,
+      or failing that from the highest numbered link to another page, so every page can be fetched at once
+    - next: followed by the rule of the link to the next page, such as next:class/pagination__next. The pages are
+      followed one at a time
+
+    The max_pages rule limits how many pages, including the first, are fetched on each run.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import re
+from html import unescape
+from urllib.parse import urljoin
+from extraction import ExtractionError, parse_rule, container_pattern, prescan_containers
+
+HREF_PATTERN = re.compile(r'\shref\s*=\s*(["\'])(.*?)\1', re.IGNORECASE | re.DOTALL)
+TAG_PATTERN = re.compile(r'<[^>]*>')
+NUMBER_PATTERN = re.compile(r'\d+')
+
+
+class Pagination:
+    """
+    A scraper's pagination rules
+
+    :param rule:            The pagination rule
+    :param page_count_rule: The rule of the element holding the number of pages, such as 'class/page-count'
+    :param max_pages:       The most pages fetched on each run, including the first
+
+    Methods
+    -----------
+    page_urls(search_url, text)
+        Works out the url of every further page from the first page
+
+    next_url(url, text)
+        Finds the url of the page after the one given
+    """
+
+    def __init__(self, rule, page_count_rule=None, max_pages=10):
+        self.max_pages = max_pages
+        self.follows_links = rule.startswith('next:')
+
+        if self.follows_links:
+            self.next_pattern = container_pattern(parse_rule(rule[len('next:'):]))
+            return
+
+        if '{page}' not in rule:
+            raise ExtractionError("Invalid pagination rule '{}', expected a page template containing {{page}} or "
+                                  "next:attribute/value".format(rule))
+
+        self.template = rule
+        parsed = parse_rule(page_count_rule)
+        self.page_count_pattern = container_pattern(parsed) if parsed is not None else None
+
+        # Links to the other pages as they appear in the html, with the page number captured
+        before, sep, after = rule.partition('{page}')
+        self.link_pattern = re.compile(r'{}(\d+){}(?!\d)'.format(self._link_literal(before),
+                                                                 self._link_literal(after)))
+
+    @staticmethod
+    def _link_literal(text):
+        """Escapes part of the page template to match it within a link, where & may be written as &amp;"""
+        return '(?:&|&amp;)'.join(re.escape(part) for part in text.split('&'))
+
+    def page_count(self, text):
+        """Works out how many pages of search results there are
+
+        :param text: The html of the first page
+        :return: The number of pages, 1 if it could not be found
+        """
+        if self.page_count_pattern is not None:
+            # Take the last number in the element, so 'Page 1 of 12' gives 12
+            for element in prescan_containers(text, self.page_count_pattern)[:1]:
+                numbers = NUMBER_PATTERN.findall(TAG_PATTERN.sub(' ', element))
+                if numbers:
+                    return int(numbers[-1])
+
+        return max([int(number) for number in self.link_pattern.findall(text)] + [1])
+
+    def page_url(self, search_url, page):
+        """Builds the url of a page of search results
+
+        :param search_url:  The url of the first page
+        :param page:        The page number
+        :return: The url
+        """
+        return search_url + self.template.replace('{page}', str(page))
+
+    def page_urls(self, search_url, text):
+        """Works out the url of every further page of search results
+
+        :param search_url:  The url of the first page
+        :param text:        The html of the first page
+        :return: A list of (page number, url) for the second page onwards, up to max_pages
+        """
+        last_page = min(self.page_count(text), self.max_pages)
+        return [(page, self.page_url(search_url, page)) for page in range(2, last_page + 1)]
+
+    def next_url(self, url, text):
+        """Finds the url of the next page of search results
+
+        :param url:     The url of the current page
+        :param text:    The html of the current page
+        :return: The url of the next page, None if this is the last page
+        """
+        for element in prescan_containers(text, self.next_pattern)[:1]:
+            href = HREF_PATTERN.search(element)
+            if href is None:
+                return None
+
+            next_url = urljoin(url, unescape(href.group(2).strip()))
+            return next_url if next_url != url else None
+
+        return None
+
+
+def get_pagination(rules, max_pages=10):
+    """Builds the pagination for a scraper's rules
+
+    :param rules:       The scraper's rules as {'rule_name': 'rule_value'}
+    :param max_pages:   The most pages to fetch when the rules do not have a max_pages rule
+    :return: The Pagination, None if the scraper does not paginate
+    """
+    if not rules.get('pagination'):
+        return None
+
+    if rules.get('max_pages'):
+        try:
+            max_pages = int(rules['max_pages'])
+        except ValueError:
+            raise ExtractionError("Invalid max_pages rule '{}', expected a number".format(rules['max_pages']))
+
+    return Pagination(rules['pagination'], rules.get('page_count'), max_pages)
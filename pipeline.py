@@ -0,0 +1,231 @@
+""" Scrape pipeline
+
+    Splits a scraper run into three stages joined by bounded queues, so the I/O bound fetching, CPU bound parsing
+    and database writes no longer hold each other up:
+
+    - fetch   A pool of threads retrieving the search results
+    - parse   A pool of processes applying the extraction rules, so parsing uses every core rather than
+              contending for the GIL with the fetch threads
+    - store   A single thread saving the raw data, items and timings of finished runs in batches
+
+    When the parse stage falls behind the fetch threads wait for it and once the fetch queue is full submit blocks,
+    so work backs up to the scheduler rather than piling up in memory.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime as dt
+from queue import Queue, Empty
+from threading import BoundedSemaphore, Thread
+from extraction import timed_extract_pages
+from metrics import get_metrics
+
+QUEUE_DEPTH = get_metrics().gauge('pipeline_queue_depth', 'Runs waiting at each stage of the pipeline')
+
+
+class PipelineJob:
+    """
+    A scraper run as it passes through the pipeline
+
+    :param bot:     The scraper being run
+    :param future:  Resolved with the number of items found once the run has been stored
+    """
+
+    __slots__ = ('bot', 'future', 'run_state', 'fetched', 'unchanged', 'parsed')
+
+    def __init__(self, bot, future):
+        self.bot = bot
+        self.future = future
+        self.run_state = None  # (current_run_at, run_timer) for ScraperBot._finish_run
+        self.fetched = False
+        self.unchanged = False
+        self.parsed = None  # Future holding the result of the parse stage, if the page needed parsing
+
+
+class ScrapePipeline:
+    """
+    Runs scrapers through separate fetch, parse and store stages
+
+    :param dbo:             Database object for querying and executing commands
+    :param fetch_workers:   The number of fetch threads
+    :param parse_workers:   The number of parse processes, defaults to the number of cores
+    :param queue_size:      The maximum number of runs waiting at each stage
+    :param store_batch:     The maximum number of finished runs stored together
+    :param backend:         The parser backend to extract with
+    :param partial:         Only parse the parts of each page matched by the searches rule
+
+    Methods
+    -----------
+    submit(bot)
+        Queues a scraper to be run
+
+    close()
+        Finishes every queued run and stops the pipeline
+    """
+
+    def __init__(self, dbo, fetch_workers=16, parse_workers=None, queue_size=64, store_batch=50, backend='lxml',
+                 partial=True):
+        self.dbo = dbo
+        self.store_batch = store_batch
+        self.backend = backend
+        self.partial = partial
+
+        self.fetch_queue = Queue(maxsize=queue_size)
+        self.store_queue = Queue()  # Not bounded, entries only arrive as fast as the earlier stages release them
+        QUEUE_DEPTH.set_function(self.fetch_queue.qsize, stage='fetch')
+        QUEUE_DEPTH.set_function(self.store_queue.qsize, stage='store')
+
+        # Spawned workers do not inherit the fetch threads or open connections of this process
+        self.parse_pool = ProcessPoolExecutor(max_workers=parse_workers,
+                                              mp_context=multiprocessing.get_context('spawn'))
+        self.parse_slots = BoundedSemaphore(queue_size)  # Pages being parsed or waiting to be
+
+        self.fetch_threads = [Thread(target=self._fetch_loop, name='fetch-{}'.format(idx), daemon=True)
+                              for idx in range(fetch_workers)]
+        self.store_thread = Thread(target=self._store_loop, name='store', daemon=True)
+
+        for thread in self.fetch_threads:
+            thread.start()
+        self.store_thread.start()
+
+    def submit(self, bot):
+        """Queues a scraper to be run, blocking while the fetch queue is full
+
+        :param bot: The scraper to run
+        :return: A future resolved with the number of items found
+        """
+        future = Future()
+        self.fetch_queue.put(PipelineJob(bot, future))
+        return future
+
+    def _fetch_loop(self):
+        """Fetch stage. Retrieves the search results and passes them on to be parsed or stored
+
+        :return: Nothing
+        """
+        while True:
+            job = self.fetch_queue.get()
+            if job is None:
+                return
+
+            bot = job.bot
+            try:
+                run_timer = bot._stage_timer('run')
+                job.run_state = (bot._start_run(), run_timer)
+
+                job.fetched = bot._get_search_results()
+                if job.fetched:
+                    job.unchanged = bot._is_unchanged()
+                if job.fetched and not job.unchanged:
+                    bot._get_more_pages()
+
+                pages = bot._pages_to_parse() if job.fetched and not job.unchanged else []
+                if any(page is not None for page in pages):
+                    # Wait here if the parse stage has fallen behind
+                    self.parse_slots.acquire()
+                    try:
+                        job.parsed = self.parse_pool.submit(timed_extract_pages, bot.rules, self.backend,
+                                                            self.partial, pages)
+                    except Exception:
+                        # The slot is only given back by _parsed once the page has been parsed
+                        self.parse_slots.release()
+                        raise
+                    job.parsed.add_done_callback(lambda done, job=job: self._parsed(job))
+                else:
+                    self.store_queue.put(job)
+            except Exception as err:
+                print("Scraper #{}: Fetch failed: {}".format(bot.id, err))
+                job.fetched = False
+                self.store_queue.put(job)
+
+    def _parsed(self, job):
+        """Called once a page has been parsed, passes the run on to be stored
+
+        :param job: The PipelineJob
+        :return: Nothing
+        """
+        self.parse_slots.release()
+        self.store_queue.put(job)
+
+    def _store_loop(self):
+        """Store stage. Saves finished runs in batches
+
+        :return: Nothing
+        """
+        running = True
+
+        while running:
+            batch = [self.store_queue.get()]
+            while len(batch) < self.store_batch:
+                try:
+                    batch.append(self.store_queue.get_nowait())
+                except Empty:
+                    break
+
+            for job in batch:
+                if job is None:
+                    running = False
+                    continue
+
+                try:
+                    job.future.set_result(self._store(job))
+                except Exception as err:
+                    print("Scraper #{}: Store failed: {}".format(job.bot.id, err))
+                    job.future.set_exception(err)
+
+            # Write the log rows of the whole batch together
+            self.dbo.flush_logs(force=False)
+
+    def _store(self, job):
+        """Saves the outcome of a single run
+
+        :param job: The PipelineJob
+        :return: The number of items found
+        """
+        bot = job.bot
+        items_found = 0
+
+        if job.fetched and job.unchanged:
+            bot._record_unchanged()
+        elif job.fetched:
+            bot._save_search_results()
+            bot._logLastRun(bot.id)
+
+            if job.parsed is not None:
+                try:
+                    pages_items, start_dt, end_dt, duration = job.parsed.result()
+                except Exception as err:
+                    print("Scraper #{}: Unable to process retrieved data: {}".format(bot.id, err))
+                    pages_items, start_dt, end_dt, duration = [None], dt.now(), dt.now(), 0
+                items = bot._save_items(pages_items)
+                items_found = bot._report_items(items, start_dt, end_dt, duration, pages_items.count(None))
+
+            if bot.status_code == 200 and not bot.failed_pages:
+                bot._save_validators()
+
+        bot._finish_run(*job.run_state)
+
+        return items_found
+
+    def close(self):
+        """Runs everything already queued through the pipeline and then stops it
+
+        :return: Nothing
+        """
+        for thread in self.fetch_threads:
+            self.fetch_queue.put(None)
+        for thread in self.fetch_threads:
+            thread.join()
+
+        # Every parse has been submitted, waiting for the pool also waits for their results to be queued
+        self.parse_pool.shutdown(wait=True)
+
+        self.store_queue.put(None)
+        self.store_thread.join()
+
+        QUEUE_DEPTH.remove(stage='fetch')
+        QUEUE_DEPTH.remove(stage='store')
@@ -0,0 +1,214 @@
+""" Rate limiting
+
+    Limits the requests made to each host so scrapers hitting the same site do not trip its defences. Each host has:
+
+    - A token bucket capping the rate requests are started at, with short bursts allowed
+    - An adaptive limit on the requests in flight at once. The limit grows by one for each limit's worth of healthy
+      responses and halves when the host responds with 429 or 503, fails to respond or its response times spike,
+      so it settles just under what the host will tolerate
+
+    The limits of each host are read from host_limits in ScraperConfig.py, falling back to its 'default' entry.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import asyncio
+from threading import Condition, Lock
+from time import monotonic
+from urllib.parse import urlsplit
+from metrics import get_metrics
+from ScraperConfig import configuration
+
+# Responses telling us to slow down
+THROTTLED_CODES = (429, 503)
+
+# Metrics recorded for each host
+metrics = get_metrics()
+CONCURRENCY_LIMIT = metrics.gauge('http_concurrency_limit', 'Requests allowed in flight to each host at once')
+IN_FLIGHT = metrics.gauge('http_in_flight', 'Requests in flight to each host')
+
+
+class HostLimiter:
+    """
+    Limits the rate of requests and the requests in flight to a single host
+
+    :param rate:                Requests started per second, None for no limit
+    :param burst:               Requests which can be started at once after a quiet spell
+    :param max_concurrency:     The most requests in flight at once
+    :param min_concurrency:     The fewest requests in flight at once the limit backs off to
+    :param latency_spike:       How many times slower than usual a response must be to count as a spike
+
+    Methods
+    -----------
+    acquire()
+        Waits until a request can be made
+
+    acquire_async()
+        Waits on the event loop until a request can be made
+
+    release(status_code, latency)
+        Records the outcome of a request and adjusts the concurrency limit
+
+    stats()
+        Returns the current limit and usage
+    """
+
+    latency_smoothing = 0.2  # Weight given to each new response time in the usual response time
+    async_poll_interval = 0.05  # Seconds between checks for a free slot on the event loop
+
+    def __init__(self, rate=None, burst=1, max_concurrency=8, min_concurrency=1, latency_spike=3.0):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.latency_spike = latency_spike
+
+        self.tokens = float(self.burst)
+        self.refilled_at = monotonic()
+        self.limit = float(max_concurrency)  # Starts open and backs off once the host complains
+        self.in_flight = 0
+        self.latency = None  # Smoothed response time of healthy requests
+        self.backed_off_at = 0.0
+        self.throttled = 0
+        self.condition = Condition(Lock())
+
+    def _try_acquire(self, now):
+        """Takes a token and a slot if both are free, must be called holding the condition
+
+        :param now: The current monotonic time
+        :return: 0 once acquired, otherwise the seconds to wait for a token or None to wait for a slot
+        """
+        if self.in_flight >= max(int(self.limit), 1):
+            return None
+
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+
+        self.in_flight += 1
+        return 0
+
+    def acquire(self):
+        """Blocks until a request to the host can be made. Every acquire must be followed by a release
+
+        :return: Nothing
+        """
+        with self.condition:
+            while True:
+                wait = self._try_acquire(monotonic())
+                if wait == 0:
+                    return
+                # A release wakes us when waiting for a slot
+                self.condition.wait(wait)
+
+    async def acquire_async(self):
+        """Waits on the event loop until a request to the host can be made. Every acquire must be followed by a
+        release
+
+        :return: Nothing
+        """
+        while True:
+            with self.condition:
+                wait = self._try_acquire(monotonic())
+            if wait == 0:
+                return
+            await asyncio.sleep(wait if wait is not None else self.async_poll_interval)
+
+    def release(self, status_code, latency):
+        """Records the outcome of a request and adjusts the concurrency limit
+
+        :param status_code: The http status code of the response, None if the request failed
+        :param latency:     Seconds the request took
+        :return: Nothing
+        """
+        with self.condition:
+            self.in_flight -= 1
+            now = monotonic()
+
+            spiked = self.latency is not None and latency > self.latency * self.latency_spike
+            if status_code is None or status_code in THROTTLED_CODES or spiked:
+                if status_code in THROTTLED_CODES:
+                    self.throttled += 1
+
+                # Back off at most once per usual response time, the requests already in flight when the host
+                # started complaining would otherwise halve the limit over and over
+                if now - self.backed_off_at >= (self.latency or 0):
+                    self.limit = max(self.limit / 2, self.min_concurrency)
+                    self.backed_off_at = now
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.max_concurrency)
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += (latency - self.latency) * self.latency_smoothing
+
+            self.condition.notify_all()
+
+    def stats(self):
+        """Gets the current limit and usage of the host
+
+        :return: A dictionary of the concurrency limit, requests in flight, usual response time and the number of
+                 throttled responses
+        """
+        with self.condition:
+            return {'concurrency_limit': round(self.limit, 2), 'in_flight': self.in_flight,
+                    'latency': round(self.latency, 3) if self.latency is not None else None,
+                    'throttled': self.throttled}
+
+
+class RateLimiter:
+    """
+    The HostLimiters of every host, created on first use
+
+    :param host_limits: Dictionary of {host: HostLimiter arguments}, hosts not listed use the 'default' entry
+
+    Methods
+    -----------
+    host(url)
+        Returns the limiter for the url's host
+    """
+
+    def __init__(self, host_limits=None):
+        self.host_limits = host_limits or {}
+        self.hosts = {}
+        self.lock = Lock()
+
+    def host(self, url):
+        """Gets the limiter for the url's host
+
+        :param url: The url about to be requested
+        :return: The HostLimiter
+        """
+        host = urlsplit(url).netloc
+
+        with self.lock:
+            limiter = self.hosts.get(host)
+            if limiter is None:
+                limiter = HostLimiter(**self.host_limits.get(host, self.host_limits.get('default', {})))
+                self.hosts[host] = limiter
+                CONCURRENCY_LIMIT.set_function(lambda limiter=limiter: limiter.limit, host=host)
+                IN_FLIGHT.set_function(lambda limiter=limiter: limiter.in_flight, host=host)
+            return limiter
+
+
+# The process wide limiter, shared by every scraper
+_rate_limiter = None
+_rate_limiter_lock = Lock()
+
+
+def get_rate_limiter():
+    """Gets the process wide rate limiter, creating it from the configuration on first use
+
+    :return: The RateLimiter object
+    """
+    global _rate_limiter
+
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(configuration.get('host_limits'))
+        return _rate_limiter
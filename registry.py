@@ -0,0 +1,224 @@
+""" Scraper registry
+
+    Holds what the factory needs to know about every registered scraper between runs, in a compact ScraperEntry
+    per scraper. A full ScraperBot, with its compiled rules and the pages it retrieves, is only built for the length
+    of a run so the memory used by a large number of scrapers stays small:
+
+    - Each entry keeps its fields in __slots__ rather than an instance dictionary
+    - The rules are held as a tuple of (name, value) pairs with the names and values interned, and scrapers with the
+      same rules share one tuple. A tuple is dropped from the registry once no scraper uses it
+    - The time of the last run is a timestamp rather than a datetime
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import sys
+from datetime import datetime as dt
+from time import time
+
+
+class ScraperEntry:
+    """
+    What is kept about a registered scraper between its runs
+
+    :param config:  The scraper's configuration from load_configurations
+    :param rules:   The scraper's rules as a tuple of (name, value) pairs
+
+    Methods
+    -----------
+    config()
+        Rebuilds the configuration the scraper bot is created from
+
+    next_run_at()
+        Works out when the scraper is next due to run
+
+    record_run(bot, keep_validators)
+        Keeps what the next run needs from a finished scraper bot
+    """
+
+    __slots__ = ('enabled', 'search_terms', 'timeout', 'last_updated', 'run_frequency', 'etag', 'last_modified',
+                 'content_hash', 'rules', 'last_run_at', 'retry_at')
+
+    def __init__(self, config, rules):
+        self.enabled = config['enabled']
+        self.search_terms = config['search_terms']
+        self.timeout = config['timeout']
+        self.last_updated = config['last_updated']
+        self.run_frequency = config['run_frequency']
+        self.etag = config['validators']['etag']
+        self.last_modified = config['validators']['last_modified']
+        self.content_hash = config['validators']['content_hash']
+        self.rules = rules
+        self.last_run_at = None  # Timestamp of the last run to finish, None until the scraper has run
+        self.retry_at = None  # Timestamp to run again at to retry a request the site asked us to wait for
+
+    def config(self):
+        """Rebuilds the configuration the scraper bot is created from
+
+        :return: The configuration in the format returned by load_configurations
+        """
+        return {
+            'enabled': self.enabled,
+            'search_terms': self.search_terms,
+            'timeout': self.timeout,
+            'last_updated': self.last_updated,
+            'run_frequency': self.run_frequency,
+            'validators': {'etag': self.etag, 'last_modified': self.last_modified, 'content_hash': self.content_hash},
+            'rules': dict(self.rules),
+        }
+
+    def next_run_at(self):
+        """Works out when the scraper is next due to run, straight away if it has not run yet and early if the last
+        run ended waiting to retry a request
+
+        :return: The timestamp of the next run
+        """
+        if self.last_run_at is None:
+            return time()
+
+        if self.retry_at is not None:
+            return self.retry_at
+
+        return self.last_run_at + self.run_frequency * 3600
+
+    def record_run(self, bot, keep_validators=True):
+        """Keeps what the next run needs from a finished scraper bot
+
+        :param bot:             The ScraperBot that ran
+        :param keep_validators: Keep the validators of the page the bot retrieved
+        :return: Nothing
+        """
+        self.last_run_at = bot.last_run_at.timestamp()
+        self.retry_at = bot.retry_at.timestamp() if bot.retry_at is not None else None
+        if keep_validators:
+            self.etag = bot.validators['etag']
+            self.last_modified = bot.validators['last_modified']
+            self.content_hash = bot.validators['content_hash']
+
+
+class ScraperRegistry:
+    """
+    The ScraperEntry of every registered scraper, keyed by scraper id
+
+    Methods
+    -----------
+    add(scraper_id, config)
+        Registers a scraper
+
+    reload(scraper_id, config)
+        Replaces a scraper's configuration
+
+    materialize(scraper_id, bot_class, dbo)
+        Builds a scraper bot to run
+
+    finished(scraper_id, entry, bot)
+        Records a finished run
+    """
+
+    def __init__(self):
+        self.entries = {}
+        # Every distinct set of rules in use as rules: [shared rules, scrapers using them], so scrapers with the same
+        # rules share them
+        self._rules = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, scraper_id):
+        return scraper_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, scraper_id):
+        return self.entries[scraper_id]
+
+    def __delitem__(self, scraper_id):
+        self._release_rules(self.entries.pop(scraper_id).rules)
+
+    def get(self, scraper_id, default=None):
+        return self.entries.get(scraper_id, default)
+
+    def _intern_rules(self, rules):
+        """Gets the shared tuple holding a set of rules
+
+        :param rules: The rules as {'rule_name': 'rule_value'}
+        :return: A tuple of (name, value) pairs
+        """
+        rules = tuple((sys.intern(name), sys.intern(value) if isinstance(value, str) else value)
+                      for name, value in rules.items())
+        shared = self._rules.setdefault(rules, [rules, 0])
+        shared[1] += 1
+        return shared[0]
+
+    def _release_rules(self, rules):
+        """Stops a scraper sharing a set of rules, dropping them once no scraper uses them
+
+        :param rules: The tuple returned by _intern_rules
+        :return: Nothing
+        """
+        shared = self._rules[rules]
+        shared[1] -= 1
+        if not shared[1]:
+            del (self._rules[rules])
+
+    def add(self, scraper_id, config):
+        """Registers a scraper
+
+        :param scraper_id:  The ID of the scraper
+        :param config:      The scraper's configuration from load_configurations
+        :return: The ScraperEntry
+        """
+        entry = ScraperEntry(config, self._intern_rules(config['rules']))
+        if scraper_id in self.entries:
+            self._release_rules(self.entries[scraper_id].rules)
+        self.entries[scraper_id] = entry
+        return entry
+
+    def reload(self, scraper_id, config):
+        """Replaces a scraper's configuration. A run in progress finishes with the old configuration
+
+        The validators are dropped, they describe the page as processed under the old rules, so the next run
+        fetches and extracts the page again rather than skipping it as unchanged
+
+        :param scraper_id:  The ID of the scraper
+        :param config:      The scraper's new configuration from load_configurations
+        :return: The new ScraperEntry
+        """
+        print("Scraper #{}: Reloading configuration.".format(scraper_id))
+        last_run_at = self.entries[scraper_id].last_run_at
+
+        entry = self.add(scraper_id, config)
+        entry.etag = entry.last_modified = entry.content_hash = None
+        entry.last_run_at = last_run_at
+        return entry
+
+    def materialize(self, scraper_id, bot_class, dbo):
+        """Builds a scraper bot to run, it only needs to be kept for the length of the run
+
+        :param scraper_id:  The ID of the scraper
+        :param bot_class:   The class of scraper bot to build
+        :param dbo:         The object that allows the bot to run commands against the database
+        :return: The scraper bot
+        """
+        entry = self.entries[scraper_id]
+        bot = bot_class(scraper_id, dbo, entry.config())
+        if entry.last_run_at is not None:
+            bot.last_run_at = dt.fromtimestamp(entry.last_run_at)
+        return bot
+
+    def finished(self, scraper_id, entry, bot):
+        """Records a finished run against the scraper
+
+        :param scraper_id:  The ID of the scraper
+        :param entry:       The ScraperEntry the bot was built from
+        :param bot:         The scraper bot that ran
+        :return: The scraper's current ScraperEntry, None if it has been removed while it was running
+        """
+        current = self.entries.get(scraper_id)
+        if current is not None:
+            # The page was processed with the old rules if the scraper was reloaded while it ran
+            current.record_run(bot, keep_validators=current is entry)
+        return current
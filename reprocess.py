@@ -0,0 +1,167 @@
+"""
+Re-extract the products from the pages already stored in raw_data using each scraper's current rules
+
+Use this after fixing the rules of a scraper whose site has changed its markup. The stored pages are streamed from
+the database a chunk at a time and parsed across a pool of processes, with the extracted products written back in
+bulk, replacing any products previously extracted from the same pages.
+
+Usage: python reprocess.py [--scraper ID ...] [--since DATE] [--chunk-size 200] [--workers N]
+"""
+
+# Imports
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from time import perf_counter
+from blob_store import BlobStore
+from database import DbSqlite3Wrapper
+from extraction import extract_items, normalize_price
+from ScraperConfig import configuration
+
+# Stored pages with their blob, oldest first
+raw_data_sql = "SELECT r.id, r.scraper_id, r.date_time, r.page, r.content, b.encoding, b.content FROM raw_data r " \
+               "LEFT JOIN raw_blobs b ON b.hash = r.content_hash WHERE r.http_code = 200"
+
+rules_sql = "SELECT scraper_id, name, value FROM rules"
+
+delete_products_sql = "DELETE FROM products WHERE scraper_id = ? AND run_at = ? AND page = ?"
+
+insert_products_sql = "INSERT INTO products(scraper_id, run_at, page, title, price, price_text, stock) " \
+                      "VALUES(?, ?, ?, ?, ?, ?, ?)"
+
+
+def reprocess_chunk(rows, rules, backend, partial):
+    """Extracts the products from a chunk of stored pages, run in the worker processes. A page which can not be
+    reprocessed is reported and skipped, leaving its products as they were
+
+    :param rows:    raw_data rows of (id, scraper_id, date_time, page, inline content, blob encoding, blob content)
+    :param rules:   The rules of each scraper in the chunk as {scraper_id: {'rule_name': 'rule_value'}}
+    :param backend: The parser backend to extract with
+    :param partial: Only parse the parts of each page matched by the searches rule
+    :return: A tuple of (the pages reprocessed as (scraper_id, date_time, page), product rows ready to insert)
+    """
+    pages = []
+    products = []
+
+    for row_id, scraper_id, run_at, page, content, encoding, blob in rows:
+        if scraper_id not in rules:
+            continue
+
+        try:
+            text = content if blob is None else BlobStore.decode(encoding, blob)
+            if text is None:
+                continue
+
+            items = extract_items(rules[scraper_id], backend, partial, text)
+        except Exception as err:
+            print("Scraper #{}: Unable to reprocess raw_data row {}: {}".format(scraper_id, row_id, err))
+            continue
+
+        pages.append((scraper_id, run_at, page))
+        products += [(scraper_id, run_at, page, item['title'], normalize_price(item['price']), item['price'],
+                      item['stock']) for item in items]
+
+    return pages, products
+
+
+def replace_products(dbo, pages, products):
+    """Replaces whatever was extracted from the reprocessed pages before with their new products. Only the pages
+    which were reprocessed are touched, the others of the same run keep their products
+
+    :param dbo:         The database object
+    :param pages:       The pages reprocessed as (scraper_id, date_time, page)
+    :param products:    The product rows to insert
+    :return: Nothing
+    """
+    # A chunk may have had no page reprocessed
+    if pages:
+        dbo.execute(delete_products_sql, pages)
+    if products:
+        dbo.execute(insert_products_sql, products)
+
+
+def load_rules(dbo):
+    """Gets the current rules of every scraper
+
+    :param dbo: The database object
+    :return: The rules as {scraper_id: {'rule_name': 'rule_value'}}
+    """
+    rules = {}
+    for scraper_id, name, value in dbo.query(rules_sql) or []:
+        rules.setdefault(scraper_id, {})[name] = value
+    return rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=configuration['database_name'], help='The database file to reprocess')
+    parser.add_argument('--scraper', type=int, action='append', help='Only reprocess this scraper, can be repeated')
+    parser.add_argument('--since', help='Only reprocess pages stored on or after this date, e.g. 2020-11-01')
+    parser.add_argument('--chunk-size', type=int, default=200, help='Pages sent to a worker at a time')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, defaults to one per core')
+    args = parser.parse_args()
+
+    dbo = DbSqlite3Wrapper(args.db)
+    dbo.connect()
+    dbo.migrate()
+
+    rules = load_rules(dbo)
+
+    sql = raw_data_sql
+    params = []
+    if args.scraper:
+        sql += " AND r.scraper_id IN ({})".format(", ".join("?" * len(args.scraper)))
+        params += args.scraper
+    if args.since:
+        sql += " AND r.date_time >= ?"
+        params.append(args.since)
+    sql += " ORDER BY r.id"
+
+    backend = configuration.get('parser_backend', 'lxml')
+    partial = configuration.get('partial_parse', True)
+
+    pages_done = 0
+    products_done = 0
+    start = perf_counter()
+
+    def store(future):
+        nonlocal pages_done, products_done
+        pages, products = future.result()
+
+        replace_products(dbo, pages, products)
+
+        pages_done += len(pages)
+        products_done += len(products)
+        elapsed = perf_counter() - start
+        print("Reprocessed {} pages, {} products ({:.1f} pages/s)".format(pages_done, products_done,
+                                                                          pages_done / elapsed))
+
+    workers = args.workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        max_in_flight = 2 * workers
+        in_flight = set()
+
+        for rows in dbo.iter_query(sql, params, args.chunk_size):
+            # Only hold a few chunks in memory at once, wait for one to finish before reading the next
+            while len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    store(future)
+
+            chunk_rules = {scraper_id: rules[scraper_id] for scraper_id in {row[1] for row in rows}
+                           if scraper_id in rules}
+            in_flight.add(pool.submit(reprocess_chunk, rows, chunk_rules, backend, partial))
+
+        for future in in_flight:
+            store(future)
+
+    dbo.close()
+
+    elapsed = perf_counter() - start
+    print("Finished: {} pages and {} products in {:.2f}s, {:.1f} rows/s".format(
+        pages_done, products_done, elapsed, pages_done / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
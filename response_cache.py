@@ -0,0 +1,295 @@
+""" Response cache
+
+    Scrapers belonging to different customers often search the same site for the same terms, so they request the
+    same url. The response cache lets them share one request:
+
+    - A request for a url which is already in flight waits for that request's response rather than making its own
+    - A successful response is kept for a short while, up to a total size, and handed to any scraper requesting the
+      same url in that time. The least recently used responses are dropped first once the size is reached
+
+    Each scraper still stores the page and logs the run as its own. Requests with conditional headers only share a
+    request in flight with the same headers, as the site may answer them with a 304, but are handed a kept response
+    whatever their headers. The scraper then spots that the page has not changed from its hash.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import asyncio
+import sys
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlsplit
+from metrics import get_metrics
+from ScraperConfig import configuration
+
+# How a request was answered, recorded in the metrics and the scraper's log
+MISS = 'miss'
+HIT = 'hit'
+COALESCED = 'coalesced'
+
+# Metrics recorded by the cache
+metrics = get_metrics()
+CACHE_REQUESTS = metrics.counter('response_cache_requests_total', 'Requests by whether they were answered by a kept '
+                                 'response, a request already in flight or a request of their own')
+CACHE_BYTES = metrics.gauge('response_cache_bytes', 'Size of the responses kept')
+CACHE_EVICTIONS = metrics.counter('response_cache_evictions_total', 'Responses dropped to keep within the size')
+
+
+class ResponseCache:
+    """
+    Shares responses between scrapers requesting the same url
+
+    :param ttl:         Seconds a response is kept for, 0 to not keep responses and only share requests in flight
+    :param max_bytes:   The most memory used by the kept responses
+    :param coalesce:    Share requests in flight
+
+    Methods
+    -----------
+    fetch(url, headers, request)
+        Gets the response for a url, making the request only when it cannot be shared
+
+    fetch_async(url, headers, request)
+        Gets the response for a url on the event loop, making the request only when it cannot be shared
+
+    get(url)
+        Returns the kept response for a url
+
+    put(url, response)
+        Keeps a response
+
+    clear()
+        Drops every kept response
+    """
+
+    def __init__(self, ttl=60.0, max_bytes=64 * 1024 * 1024, coalesce=True):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.coalesce = coalesce
+        self.entries = OrderedDict()  # url: (expires, response, size), least recently used first
+        self.size = 0
+        self._in_flight = {}  # (url, headers): Future of the response
+        self._in_flight_async = {}  # (url, headers): asyncio Future of the response
+        self.lock = Lock()
+
+        CACHE_BYTES.set_function(lambda: self.size)
+
+    @property
+    def enabled(self):
+        return self.coalesce or (self.ttl > 0 and self.max_bytes > 0)
+
+    @staticmethod
+    def _key(url, headers):
+        return url, tuple(sorted((headers or {}).items()))
+
+    @staticmethod
+    def _size(response):
+        """Works out roughly how much memory a kept response uses
+
+        :param response: The response
+        :return: Bytes
+        """
+        return sys.getsizeof(response.text) + sum(len(name) + len(value) for name, value in response.headers.items())
+
+    def _pop(self, url):
+        """Drops the kept response for a url, the lock must be held
+
+        :param url: The url
+        :return: Nothing
+        """
+        expires, response, size = self.entries.pop(url)
+        self.size -= size
+
+    def get(self, url):
+        """Gets the kept response for a url
+
+        :param url: The url
+        :return: The response, None if there is none or it has expired
+        """
+        with self.lock:
+            return self._get(url)
+
+    def _get(self, url):
+        """Gets the kept response for a url, the lock must be held
+
+        :param url: The url
+        :return: The response, None if there is none or it has expired
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+
+        if entry[0] <= monotonic():
+            self._pop(url)
+            return None
+
+        self.entries.move_to_end(url)
+        return entry[1]
+
+    def put(self, url, response):
+        """Keeps a successful response, dropping the least recently used responses to make room
+
+        :param url:         The url requested
+        :param response:    The response, only kept when its status is 200
+        :return: Nothing
+        """
+        if self.ttl <= 0 or response.status_code != 200:
+            return
+
+        size = self._size(response)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if url in self.entries:
+                self._pop(url)
+
+            while self.entries and self.size + size > self.max_bytes:
+                oldest_url, (expires, oldest, oldest_size) = self.entries.popitem(last=False)
+                self.size -= oldest_size
+                CACHE_EVICTIONS.inc()
+
+            self.entries[url] = (monotonic() + self.ttl, response, size)
+            self.size += size
+
+    def clear(self):
+        """Drops every kept response
+
+        :return: Nothing
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _lookup(self, url, key, in_flight, new_future):
+        """Looks for a kept response or a request in flight to share, otherwise registers the caller's request
+
+        :param url:         The url
+        :param key:         The url and headers of the request
+        :param in_flight:   The requests in flight, for threads or for the event loop
+        :param new_future:  Creates the future other callers wait on for the response
+        :return: A tuple of (how the request is answered, the kept response or the future of the response)
+        """
+        with self.lock:
+            response = self._get(url)
+            if response is not None:
+                return HIT, response
+
+            if not self.coalesce:
+                return MISS, None
+
+            future = in_flight.get(key)
+            if future is not None:
+                return COALESCED, future
+
+            future = in_flight[key] = new_future()
+            return MISS, future
+
+    def _finish(self, url, key, in_flight, response):
+        """Keeps the response of a request made by this cache and stops sharing the request
+
+        :param url:         The url
+        :param key:         The url and headers of the request
+        :param in_flight:   The requests in flight, for threads or for the event loop
+        :param response:    The response, None if the request failed
+        :return: Nothing
+        """
+        if response is not None:
+            self.put(url, response)
+
+        if self.coalesce:
+            with self.lock:
+                in_flight.pop(key, None)
+
+    def fetch(self, url, headers, request):
+        """Gets the response for a url, sharing a kept response or a request already in flight when there is one
+
+        :param url:         The url
+        :param headers:     The request headers
+        :param request:     Makes the request when it cannot be shared, returning a response with the text, status
+                            and headers read so it can be shared between threads
+        :return: A tuple of (response, how the request was answered)
+        """
+        key = self._key(url, headers)
+        source, shared = self._lookup(url, key, self._in_flight, Future)
+        CACHE_REQUESTS.inc(host=urlsplit(url).netloc, result=source)
+
+        if source == HIT:
+            return shared, source
+        if source == COALESCED:
+            # Raises the error of the request being waited on if it failed
+            return shared.result(), source
+
+        response = None
+        try:
+            response = request()
+        except BaseException as err:
+            if shared is not None:
+                shared.set_exception(err)
+            raise
+        finally:
+            self._finish(url, key, self._in_flight, response)
+
+        if shared is not None:
+            shared.set_result(response)
+        return response, source
+
+    async def fetch_async(self, url, headers, request):
+        """Gets the response for a url on the event loop, sharing a kept response or a request already in flight
+        when there is one
+
+        :param url:         The url
+        :param headers:     The request headers
+        :param request:     Makes the request when it cannot be shared, a coroutine function
+        :return: A tuple of (response, how the request was answered)
+        """
+        key = self._key(url, headers)
+        source, shared = self._lookup(url, key, self._in_flight_async, asyncio.get_running_loop().create_future)
+        CACHE_REQUESTS.inc(host=urlsplit(url).netloc, result=source)
+
+        if source == HIT:
+            return shared, source
+        if source == COALESCED:
+            # Shielded so one waiter being cancelled does not cancel the request for the others
+            return await asyncio.shield(shared), source
+
+        response = None
+        try:
+            response = await request()
+        except BaseException as err:
+            if shared is not None and isinstance(err, asyncio.CancelledError):
+                shared.cancel()
+            elif shared is not None:
+                shared.set_exception(err)
+                # Retrieve the error so it is not reported as never retrieved when nobody was waiting
+                shared.exception()
+            raise
+        finally:
+            self._finish(url, key, self._in_flight_async, response)
+
+        if shared is not None:
+            shared.set_result(response)
+        return response, source
+
+
+# The process wide cache, shared by every scraper
+_response_cache = None
+_response_cache_lock = Lock()
+
+
+def get_response_cache():
+    """Gets the process wide response cache, creating it from the configuration on first use
+
+    :return: The ResponseCache object
+    """
+    global _response_cache
+
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(configuration.get('response_cache_ttl', 60.0),
+                                            configuration.get('response_cache_max_bytes', 64 * 1024 * 1024),
+                                            configuration.get('coalesce_requests', True))
+        return _response_cache
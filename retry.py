@@ -0,0 +1,288 @@
+""" Retries and circuit breakers
+
+    Retries requests which fail in ways that are likely to pass, timeouts, dropped connections and 429 or 5xx
+    responses, after a jittered exponential backoff. A Retry-After header from the site is honoured. Only short
+    waits, up to max_wait, are waited out within the run. A longer wait ends the run and the scraper is run again
+    once the wait is over, so the scheduler and the workers are not held up.
+
+    Each host also has a circuit breaker. Once requests to a host have failed failure_threshold times in a row the
+    circuit opens and requests to it fail straight away rather than each waiting out its timeout. After reset_timeout
+    seconds a single probe request is let through, half-open, which closes the circuit if it succeeds and opens it
+    again if it fails. A probe which never reports back is given up on after another reset_timeout seconds and a new
+    one let through.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import random
+from datetime import datetime as dt, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlsplit
+from ScraperConfig import configuration
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request to a host whose circuit is open"""
+
+
+class RetryLaterError(Exception):
+    """Raised instead of waiting within the run for a retry that is further off than max_wait
+
+    :param message: The error message
+    :param delay:   Seconds until the request should be retried
+    """
+
+    def __init__(self, message, delay):
+        super().__init__(message)
+        self.delay = delay
+
+
+class RetryPolicy:
+    """
+    Decides which requests to retry and how long to wait before each retry
+
+    :param retries:         The most times a request is retried
+    :param backoff_base:    Seconds the first backoff is based on, doubling with each retry
+    :param backoff_max:     The longest backoff in seconds
+    :param max_retry_after: The longest Retry-After in seconds that is waited for, longer ones are not retried
+    :param retry_codes:     The http status codes to retry
+    :param max_wait:        The longest wait in seconds for a retry within the run, longer waits end the run and the
+                            scraper is run again once the wait is over
+
+    Methods
+    -----------
+    should_retry(status_code)
+        Checks if a response should be retried
+
+    delay(attempt, retry_after)
+        Works out how long to wait before a retry
+
+    wait_in_run(delay)
+        Checks if a retry is near enough to wait for within the run
+
+    parse_retry_after(value)
+        Converts a Retry-After header into seconds
+    """
+
+    def __init__(self, retries=2, backoff_base=1.0, backoff_max=30.0, max_retry_after=120.0,
+                 retry_codes=(429, 500, 502, 503, 504), max_wait=5.0):
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.retry_codes = tuple(retry_codes)
+        self.max_wait = max_wait
+
+    def should_retry(self, status_code):
+        """Checks if a response should be retried
+
+        :param status_code: The http status code of the response, None if the request failed
+        :return: True to retry
+        """
+        return status_code is None or status_code in self.retry_codes
+
+    def delay(self, attempt, retry_after=None):
+        """Works out how long to wait before a retry, picking a random time up to the backoff so scrapers which
+        failed together do not all retry together
+
+        :param attempt:     The number of the attempt that failed, starting at 0
+        :param retry_after: The Retry-After header of the response, if it had one
+        :return: Seconds to wait, None if the site asked us to wait longer than max_retry_after
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+        retry_after = self.parse_retry_after(retry_after)
+        if retry_after is not None:
+            if retry_after > self.max_retry_after:
+                return None
+            delay = max(delay, retry_after)
+
+        return delay
+
+    def wait_in_run(self, delay):
+        """Checks if a retry is near enough to wait for within the run, rather than running the scraper again later
+
+        :param delay:   Seconds until the retry
+        :return: True to wait for the retry within the run
+        """
+        return delay <= self.max_wait
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Converts a Retry-After header, either a number of seconds or a http date, into seconds
+
+        :param value: The header value
+        :return: Seconds to wait, None if there was no usable value
+        """
+        if not value:
+            return None
+
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+        return max((retry_at - dt.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a single host while it is failing
+
+    :param host:                The host the breaker is for
+    :param failure_threshold:   Failures in a row which open the circuit
+    :param reset_timeout:       Seconds the circuit stays open before a probe request is let through
+
+    Methods
+    -----------
+    allow()
+        Checks if a request can be made
+
+    record_success()
+        Records a request which succeeded
+
+    record_failure()
+        Records a request which failed
+
+    closed
+        True while requests to the host are flowing normally
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=60.0):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0  # When the circuit last opened or the probe request was let through
+        self.lock = Lock()
+
+    @property
+    def closed(self):
+        """True while requests to the host are flowing normally"""
+        return self.state == self.CLOSED
+
+    def allow(self):
+        """Checks if a request to the host can be made. While half-open only the one probe request is allowed,
+        unless it has not reported back within reset_timeout seconds
+
+        :return: True if the request can go ahead
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = monotonic()
+                return True
+
+            return False
+
+    def record_success(self):
+        """Records a request which succeeded, closing the circuit
+
+        :return: Nothing
+        """
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """Records a request which failed, opening the circuit once there have been too many in a row or the probe
+        request failed
+
+        :return: Nothing
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                print("Circuit for {} opened again, the probe request failed".format(self.host))
+            elif self.state == self.CLOSED and self.failures >= self.failure_threshold:
+                print("Circuit for {} opened after {} failures in a row".format(self.host, self.failures))
+            else:
+                return
+
+            self.state = self.OPEN
+            self.opened_at = monotonic()
+
+
+class CircuitBreakers:
+    """
+    The CircuitBreakers of every host, created on first use
+
+    :param failure_threshold:   Failures in a row which open a host's circuit
+    :param reset_timeout:       Seconds a host's circuit stays open before a probe request is let through
+
+    Methods
+    -----------
+    host(url)
+        Returns the circuit breaker for the url's host
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hosts = {}
+        self.lock = Lock()
+
+    def host(self, url):
+        """Gets the circuit breaker for the url's host
+
+        :param url: The url about to be requested
+        :return: The CircuitBreaker
+        """
+        host = urlsplit(url).netloc
+
+        with self.lock:
+            breaker = self.hosts.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(host, self.failure_threshold, self.reset_timeout)
+                self.hosts[host] = breaker
+            return breaker
+
+
+# The process wide retry policy and circuit breakers, shared by every scraper
+_retry_policy = None
+_circuit_breakers = None
+_retry_lock = Lock()
+
+
+def get_retry_policy():
+    """Gets the process wide retry policy, creating it from the configuration on first use
+
+    :return: The RetryPolicy object
+    """
+    global _retry_policy
+
+    with _retry_lock:
+        if _retry_policy is None:
+            _retry_policy = RetryPolicy(**configuration.get('retry', {}))
+        return _retry_policy
+
+
+def get_circuit_breakers():
+    """Gets the process wide circuit breakers, creating them from the configuration on first use
+
+    :return: The CircuitBreakers object
+    """
+    global _circuit_breakers
+
+    with _retry_lock:
+        if _circuit_breakers is None:
+            _circuit_breakers = CircuitBreakers(**configuration.get('circuit_breaker', {}))
+        return _circuit_breakers
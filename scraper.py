@@ -9,10 +9,161 @@
 # TODO: Remove output of processed data from screen
 
 # Imports
+import json
 import requests
-from datetime import datetime as dt
-from time import perf_counter
-from bs4 import BeautifulSoup as BS
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt, timedelta
+from threading import Lock
+from time import perf_counter, sleep
+from urllib.parse import urlsplit
+from blob_store import BlobStore
+from extraction import get_plan, extract_pages, normalize_price, ExtractionError
+from metrics import get_metrics, Timer
+from pagination import get_pagination
+from ratelimit import get_rate_limiter
+from response_cache import get_response_cache, MISS
+from retry import CircuitOpenError, RetryLaterError, get_retry_policy, get_circuit_breakers
+from ScraperConfig import configuration
+from session_pool import get_session_pool, wire_stats
+
+# Metrics recorded by the scrapers
+metrics = get_metrics()
+STAGE_SECONDS = metrics.histogram('scraper_stage_seconds', 'Seconds taken by each stage of a scraper run')
+RUNS = metrics.counter('scraper_runs_total', 'Finished scraper runs by the status code of the search results')
+UNCHANGED = metrics.counter('scraper_unchanged_total', 'Scraper runs which found the search results unchanged')
+ITEMS = metrics.counter('scraper_items_total', 'Products extracted from the search results')
+PARSE_FAILURES = metrics.counter('scraper_parse_failures_total', 'Pages of search results which could not be parsed')
+REQUESTS = metrics.counter('http_requests_total', 'Requests made by status code, or the error when there was none')
+REQUEST_SECONDS = metrics.histogram('http_request_seconds', 'Seconds taken by each request')
+RETRIES = metrics.counter('http_retries_total', 'Requests retried after a failure')
+CIRCUIT_OPEN = metrics.counter('http_circuit_open_total', 'Requests skipped because the circuit for the host was open')
+WIRE_BYTES = metrics.counter('http_response_wire_bytes_total', 'Bytes of response bodies received before decoding, '
+                             'by content encoding and http version')
+BODY_BYTES = metrics.counter('http_response_body_bytes_total', 'Characters of response bodies once decoded')
+
+
+class FetchResult:
+    """
+
+    The parts of a http response the scraper needs, read in full so it can be shared between scrapers
+
+    :param status_code: The http status code of the response
+    :param text: The decoded body of the response
+    :param headers: The response headers
+    :param wire_bytes: The size of the body as received, before decoding, None if not known
+    :param http_version: The http version the response came over, such as 'HTTP/2'
+    """
+
+    def __init__(self, status_code, text, headers=None, wire_bytes=None, http_version=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers if headers is not None else {}
+        self.wire_bytes = wire_bytes
+        self.http_version = http_version
+
+
+class SearchPage:
+    """
+
+    A further page of search results, after the first, retrieved during a run
+
+    :param page: The page number
+    :param response: The response for the page
+    """
+
+    __slots__ = ('page', 'response')
+
+    def __init__(self, page, response):
+        self.page = page
+        self.response = response
+
+
+# Threads fetching further pages of search results, shared by every scraper
+_page_pool = None
+_page_pool_lock = Lock()
+
+
+def get_page_pool():
+    """Gets the thread pool used to fetch further pages of search results at the same time
+
+    :return: The ThreadPoolExecutor
+    """
+    global _page_pool
+
+    with _page_pool_lock:
+        if _page_pool is None:
+            _page_pool = ThreadPoolExecutor(max_workers=configuration.get('pagination_workers', 8),
+                                            thread_name_prefix='page')
+        return _page_pool
+
+
+# Selects the configuration, validators and rules of a set of scrapers, one row per rule in scraper order
+CONFIG_SQL = "SELECT s.id, s.enabled, s.search_terms, s.timeout, s.last_updated, s.run_frequency, " \
+             "v.etag, v.last_modified, v.content_hash, r.name, r.value FROM scrapers s " \
+             "LEFT JOIN scraper_validators v ON v.scraper_id = s.id " \
+             "LEFT JOIN rules r ON r.scraper_id = s.id " \
+             "WHERE {} ORDER BY s.id, r.id"
+
+
+def _group_configurations(rows):
+    """Builds the configuration of each scraper from the rows of CONFIG_SQL
+
+    :param rows: The rows, all the rows of a scraper together
+    :return: A generator of (scraper_id, configuration)
+    """
+    scraper_id = None
+    config = None
+    for row in rows:
+        if row[0] != scraper_id:
+            if config is not None:
+                yield scraper_id, config
+
+            scraper_id = row[0]
+            config = {
+                'enabled': row[1],
+                'search_terms': row[2],
+                'timeout': row[3],
+                'last_updated': row[4],
+                'run_frequency': row[5],
+                'validators': {'etag': row[6], 'last_modified': row[7], 'content_hash': row[8]},
+                'rules': {}
+            }
+
+        # Format the rules into a dictionary of {'rule_name': 'rule_value'}
+        if row[9] is not None:
+            config['rules'][row[9]] = row[10]
+
+    if config is not None:
+        yield scraper_id, config
+
+
+def load_configurations(dbo, where_sql, where_params=[]):
+    """Loads the configuration, rules and validators of a set of scrapers in a single query
+
+    :param dbo:             The database object
+    :param where_sql:       The condition picking the scrapers, against the scrapers table aliased as s
+    :param where_params:    The parameters of the condition
+    :return: A dictionary of {scraper_id: configuration}, None if the query failed
+    """
+    config_results = dbo.query(CONFIG_SQL.format(where_sql), where_params)
+    if config_results is None:
+        return None
+
+    return dict(_group_configurations(config_results))
+
+
+def iter_configurations(dbo, where_sql, where_params=[], chunk_size=1000):
+    """Loads the configuration, rules and validators of a set of scrapers in a single query, reading the rows a chunk
+    at a time so only one scraper's configuration needs to be held at once. Used to load every scraper
+
+    :param dbo:             The database object
+    :param where_sql:       The condition picking the scrapers, against the scrapers table aliased as s
+    :param where_params:    The parameters of the condition
+    :param chunk_size:      The number of rows read at a time
+    :return: A generator of (scraper_id, configuration)
+    """
+    rows = (row for chunk in dbo.iter_query(CONFIG_SQL.format(where_sql), where_params, chunk_size) for row in chunk)
+    return _group_configurations(rows)
 
 
 class ScraperBot:
@@ -22,6 +173,7 @@ class ScraperBot:
 
     :param scraper_id: The unique ID of the scraper in the database
     :param dbo: The object that allows us to run commands against the database
+    :param config: The scraper's configuration from load_configurations, loaded from the database when not given
     :returns:
 
 
@@ -47,31 +199,105 @@ class ScraperBot:
     _loadConfiguration()
         Retrieves from the database this scrapers rules and config data from the DB
 
+    _apply_configuration(config)
+        Sets the scrapers rules and config data from a loaded configuration
+
+    _compile_rules()
+        Compiles the rules into the extraction plan used by _process_data
+
+    _conditional_headers()
+        Builds the request headers used to skip pages which have not changed
+
+    _is_unchanged()
+        Checks if the retrieved page is the same as the one from the last run
+
+    _save_validators()
+        Stores the ETag, Last-Modified and body hash of the current response
+
     _save_search_results()
-        Stores the raw data taken from the target site and stores it within the DB
+        Stores the raw data taken from the target site in the blob store and references it from raw_data
 
     _get_search_results()
         Go to the target url and extracts the raw data to parse through
 
-    update()
-        Each tick it updates the last run time. This is then used to determine if
-        enough time has passed between runs of the scraper
+    _fetch(url, headers, stream)
+        Requests a url, sharing the response with other scrapers requesting the same url
+
+    _read_response(response)
+        Reads a response in full
+
+    _request(url, headers, stream)
+        Requests a url within the host's rate limit, retrying failures which are likely to pass
+
+    _read_stream(response)
+        Reads a streamed response until the search results have been received
+
+    _get_more_pages()
+        Retrieves the further pages of search results when the scraper has a pagination rule
+
+    _fetch_page(page_url)
+        Retrieves a single further page of search results
+
+    _save_page(page, response, content_hash)
+        Stores a page of search results in the blob store and references it from raw_data
 
     _process_data()
         Processes the raw extracted data for the slaient information and displays
         on screen
 
+    _needs_parsing()
+        Checks if the retrieved data has search results to extract
+
+    _pages_to_parse()
+        Lists the retrieved pages which have search results to extract
+
+    _save_items(pages_items)
+        Stores the items extracted from each page in the products table
+
+    _report_items(items, task_start_dt, task_end_dt, task_duration)
+        Displays the extracted items and logs the processing time
+
+    _search_url()
+        Builds the url to search the target site with
+
+    _start_run()
+        Marks the scraper as running
+
+    _store_and_process(unchanged)
+        Stores the retrieved search results and extracts the items from them
+
+    _record_unchanged()
+        Logs that the page has not changed since the last run
+
+    _finish_run(current_run_at, run_timer)
+        Marks the scraper as stopped and logs the timings of the run
+
+    _release_run_data()
+        Drops the pages retrieved on the run
+
+    _stage_timer(stage)
+        Starts timing a stage of the run
+
+    _record_request(host, status_code, error, latency)
+        Records the outcome of a request in the metrics
+
+    _record_transfer(host, response)
+        Records the size of a response on the wire in the metrics
+
     run()
         Runs the scraper. Basically extracts the raw data, stores and processes it
 
 
     """
 
-    def __init__(self, scraper_id=None, dbo=None):
+    def __init__(self, scraper_id=None, dbo=None, config=None):
 
         self.id = scraper_id
         self.db = dbo
+        self.blobs = BlobStore(dbo)  # Compressed, deduplicated storage for the raw pages
         self.rules = {}
+        self.plan = None  # The rules compiled ready to extract the products from a page
+        self.pagination = None  # How to find the further pages of search results, None to only fetch the first
         self.last_run_at = dt.now()  # When was the scraper bot last run
         self.current_run_at = dt.now()  # Set the initial run at value for the loop
         self.run_frequency = 1  # How many hours between runs, default to once every hour
@@ -81,9 +307,30 @@ class ScraperBot:
         # for restricting runs and too many messages
         self.enabled = True  # Enable the scraper at the start so it can run right away
         self.status_code = 0
+        # Validators from the last stored page, used to skip pages which have not changed
+        self.validators = {'etag': None, 'last_modified': None, 'content_hash': None}
+        self.response = None  # The response to the search on this run, None if it could not be retrieved
+        self.content_hash = None  # Hash of the body of the current response
+        self.fragments = None  # The search results found while streaming the current response
+        self.truncated = False  # The current response was cut off at max_response_bytes
+        self.failed_pages = 0  # Pages retrieved on this run which could not be parsed
+        self.more_pages = None  # SearchPages after the first retrieved on this run, None until they are fetched
+        self.retry_at = None  # When to run again to retry a request the site asked us to wait for, None to not
+        self.metric_labels = {}  # Labels of the metrics recorded by this scraper
 
         # Load config
-        self._loadConfiguration()
+        if config is None:
+            self._loadConfiguration()
+        else:
+            self._apply_configuration(config)
+
+    def _search_url(self):
+        """
+        Builds the url to search the target site with
+
+        :return: The url including the search terms
+        """
+        return "{}/{}".format(self.rules['url'], self.terms)
 
     def _logLastRun(self, scraper_id):
         """
@@ -105,24 +352,136 @@ class ScraperBot:
         :return:
         """
         print("Scraper #{}: Loading configuration.".format(self.id))
-        config_sql = "SELECT search_terms, timeout, last_updated, run_frequency FROM scrapers WHERE id = ?"
-        id_param = [(self.id)]
-        config_results = self.db.query(config_sql, id_param)
+        configurations = load_configurations(self.db, "s.id = ?", [self.id]) or {}
 
-        for conf in config_results:
-            self.terms = conf[0]
-            self.timeout = conf[1]
-            self.last_updated = conf[2]
-            self.run_frequency = conf[3]
+        if self.id in configurations:
+            self._apply_configuration(configurations[self.id])
 
-        # Rules
-        print("Scraper #{}: Loading processing rules.".format(self.id))
-        rules_sql = "SELECT name, value FROM rules WHERE scraper_id = ?"
-        rules_results = self.db.query(rules_sql, id_param)
+    def _apply_configuration(self, config):
+        """
+        Sets the scrapers rules and other config information from a configuration loaded by load_configurations
 
-        # Format the rules into a dictionary of {'rule_name': 'rule_value'}
-        for rule in rules_results:
-            self.rules[rule[0]] = rule[1]
+        :param config: The configuration
+        :return:
+        """
+        self.terms = config['search_terms']
+        self.timeout = config['timeout']
+        self.last_updated = config['last_updated']
+        self.run_frequency = config['run_frequency']
+        self.rules = dict(config['rules'])
+        self._compile_rules()
+
+        # Validators for conditional requests
+        self.validators = dict(config['validators'])
+
+    def _compile_rules(self):
+        """
+        Compiles the rules into the extraction plan used to process the retrieved data
+
+        :return:
+        """
+        try:
+            self.plan = get_plan(self.rules, configuration.get('parser_backend', 'lxml'))
+        except ExtractionError as err:
+            print("Scraper #{}: Unable to compile rules: {}".format(self.id, err))
+            self.plan = None
+
+        try:
+            self.pagination = get_pagination(self.rules, configuration.get('max_pages', 10))
+        except ExtractionError as err:
+            print("Scraper #{}: Unable to compile pagination rules: {}".format(self.id, err))
+            self.pagination = None
+
+        self.metric_labels = {'host': urlsplit(self.rules.get('url', '')).netloc}
+        if configuration.get('metrics_scraper_label', True):
+            self.metric_labels['scraper'] = self.id
+
+    def _stage_timer(self, stage):
+        """
+        Starts timing a stage of the run, recorded in the scraper_stage_seconds metric when it stops
+
+        :param stage: The name of the stage
+        :return: The started Timer
+        """
+        return STAGE_SECONDS.time(stage=stage, **self.metric_labels)
+
+    @staticmethod
+    def _record_request(host, status_code, error, latency):
+        """
+        Records the outcome of a request in the metrics
+
+        :param host:        The host requested
+        :param status_code: The http status code of the response, None if the request failed
+        :param error:       The exception raised by the request, if any
+        :param latency:     Seconds the request took
+        :return:
+        """
+        REQUESTS.inc(host=host, code=status_code or type(error).__name__)
+        REQUEST_SECONDS.observe(latency, host=host)
+
+    @staticmethod
+    def _record_transfer(host, response):
+        """
+        Records the size of a response on the wire and once decoded in the metrics
+
+        :param host:        The host requested
+        :param response:    The FetchResult of the response
+        :return:
+        """
+        BODY_BYTES.inc(len(response.text), host=host)
+        if response.wire_bytes is not None:
+            WIRE_BYTES.inc(response.wire_bytes, host=host,
+                           encoding=response.headers.get('Content-Encoding') or 'identity',
+                           version=response.http_version or 'unknown')
+
+    def _conditional_headers(self):
+        """
+        Builds the request headers which let the target site tell us the page has not changed
+
+        :return: A dictionary of headers
+        """
+        headers = {}
+        if self.validators['etag']:
+            headers['If-None-Match'] = self.validators['etag']
+        if self.validators['last_modified']:
+            headers['If-Modified-Since'] = self.validators['last_modified']
+        return headers
+
+    def _is_unchanged(self):
+        """
+        Checks if the retrieved page is the same as the one stored on the last run, either because the site said
+        so with a 304 or because the body hashes the same
+
+        :return: True if the page has not changed
+        """
+        self.content_hash = None
+
+        if self.status_code == 304:
+            return True
+
+        if self.status_code != 200:
+            return False
+
+        self.content_hash = self.blobs.content_hash(self.response.text)
+        return self.content_hash == self.validators['content_hash']
+
+    def _save_validators(self):
+        """
+        Stores the validators of the current response for use by the next run
+
+        :return:
+        """
+        self.validators = {
+            'etag': self.response.headers.get('ETag'),
+            'last_modified': self.response.headers.get('Last-Modified'),
+            'content_hash': self.content_hash
+        }
+
+        save_validators_sql = "INSERT OR REPLACE INTO scraper_validators(scraper_id, etag, last_modified, " \
+                              "content_hash, updated_at) VALUES(?, ?, ?, ?, ?)"
+        save_validators = [(self.id, self.validators['etag'], self.validators['last_modified'],
+                            self.validators['content_hash'], dt.now())]
+        self.db.execute(save_validators_sql, save_validators)
 
     def _save_search_results(self):
         """
@@ -130,23 +489,35 @@ class ScraperBot:
         :return:
         """
 
-        task_start = perf_counter()
-        task_start_dt = dt.now()
+        with self._stage_timer('store') as timer:
+            print("Scraper #{}: Saving search results.".format(self.id))
 
-        print("Scraper #{}: Saving search results.".format(self.id))
+            self._save_page(1, self.response, self.content_hash)
+            for more_page in self.more_pages or []:
+                self._save_page(more_page.page, more_page.response)
 
-        # Save the data
-        save_raw_data_sql = "INSERT INTO raw_data(scraper_id, date_time, content, http_code) values(?, ?, ?, ?)"
-        save_raw_data = [(self.id, task_start_dt, self.response.text, self.response.status_code)]
-        self.db.execute(save_raw_data_sql, save_raw_data)
+        # Save the task stats to the database
+        self.db.log_task(self.id, timer.start_dt, timer.end_dt, 'save-raw-data', self.response.status_code,
+                         '', '', timer.duration, 'scraper')
 
-        task_end = perf_counter()
-        task_end_dt = dt.now()
-        task_duration = task_end - task_start
+    def _save_page(self, page, response, content_hash=None):
+        """
+        Save a page of search results into the database. Every page of a run is stored with the time the run
+        started, so the pages and the products extracted from them can be matched up as one run
 
-        # Save the task stats to the database
-        self.db.log_task(self.id, task_start_dt, task_end_dt, 'save-raw-data', self.response.status_code,
-                         '', '', task_duration, 'scraper')
+        :param page:            The page number
+        :param response:        The response for the page
+        :param content_hash:    The hash of the body if it has already been worked out
+        :return:
+        """
+        # Save the page to the blob store, the raw_data row only references it by hash
+        content_hash = self.blobs.put(response.text, content_hash)
+
+        save_raw_data_sql = "INSERT INTO raw_data(scraper_id, date_time, content_hash, http_code, page, wire_bytes, " \
+                            "content_encoding, http_version) values(?, ?, ?, ?, ?, ?, ?, ?)"
+        save_raw_data = [(self.id, self.current_run_at, content_hash, response.status_code, page, response.wire_bytes,
+                          response.headers.get('Content-Encoding'), response.http_version)]
+        self.db.execute(save_raw_data_sql, save_raw_data)
 
     def _get_search_results(self):
         """
@@ -155,27 +526,35 @@ class ScraperBot:
         :returns:
         """
 
-        # TODO: Handle pagination
-
         print("Scraper #{}: Retrieving data from target URL.".format(self.id))
         # Get the specified url and parameters and store ready to be processed later
         try:
-            task_start = perf_counter()
-            task_start_dt = dt.now()
-
-            self.response = requests.get("{}/{}".format(self.rules['url'], self.terms), timeout=self.timeout)
-
-            task_end = perf_counter()
-            task_end_dt = dt.now()
-            task_duration = task_end - task_start
+            with self._stage_timer('fetch') as timer:
+                # Pages are read in full when paginating, the links to the other pages come after the search results
+                url = self._search_url()
+                stream = configuration.get('stream_responses', False) and self.plan is not None and \
+                    self.pagination is None
+                self.response, cache_result = self._fetch(url, self._conditional_headers(), stream)
 
             self.status_code = self.response.status_code
 
-            # Record the task details to the log
-            self.db.log_task(self.id, task_start_dt, task_end_dt, 'extract-data', self.status_code,
-                             'GOOD', '', task_duration, 'scraper')
+            # Record the task details to the log along with the connection and rate limit stats for the host
+            host_stats = dict(get_session_pool().stats(url), **get_rate_limiter().host(url).stats())
+            host_stats.update(response_cache=cache_result, wire_bytes=self.response.wire_bytes,
+                              http_version=self.response.http_version)
+            self.db.log_task(self.id, timer.start_dt, timer.end_dt, 'extract-data', self.status_code,
+                             'GOOD', json.dumps(host_stats), timer.duration, 'scraper')
 
             return True
+        except CircuitOpenError as err_circuit:
+            print("Scraper #{}: {}".format(self.id, err_circuit))
+            self.response = None
+            return False
+        except RetryLaterError as err_retry:
+            print("Scraper #{}: {}".format(self.id, err_retry))
+            self.retry_at = dt.now() + timedelta(seconds=err_retry.delay)
+            self.response = None
+            return False
         except requests.Timeout as err_timeout:
             print("Request to {} timed out using search terms: {}".format(self.rules['url'], self.terms))
             self.response = None
@@ -193,134 +572,422 @@ class ScraperBot:
             self.response = None
             return False
 
-    def update(self):
+    def _fetch(self, url, headers=None, stream=False):
+        """
+        Requests a url through the shared response cache, so scrapers requesting the same url at about the same time
+        share one request. Streamed responses are only read in part and are never shared
 
-        self.current_run_at = dt.now()
+        :param url:     The url to request
+        :param headers: Request headers
+        :param stream:  Read the response with _read_stream
+        :return: A tuple of (response, how the request was answered by the response cache)
+        """
+        cache = get_response_cache()
+        if stream or not cache.enabled:
+            return self._request(url, headers, stream), MISS
 
-        duration = (self.current_run_at - self.last_run_at).total_seconds()
-        time_to_elapse = self.run_frequency * 3600
+        return cache.fetch(url, headers, lambda: self._request(url, headers))
 
-        if duration >= time_to_elapse:
-            self.enabled = True
-            self.last_run_at = self.current_run_at
-        else:
-            self.enabled = False
+    @staticmethod
+    def _read_response(response):
+        """
+        Reads the parts of a response the scrapers use, so it can be handed to several scrapers at once without the
+        body being decoded again by each of them
 
-    def _process_data(self):
+        :param response: The response
+        :return: A FetchResult
         """
+        wire_bytes, http_version = wire_stats(response)
+        return FetchResult(response.status_code, response.text, response.headers, wire_bytes, http_version)
 
-        Processes the data returned by the requests library and applies the custom rules to
-        extract the relevant data from it.
+    def _request(self, url, headers=None, stream=False):
+        """
+        Requests a url using the shared session for its host, so open connections are reused between runs. Waits
+        for the host's rate limit, fails straight away while the host's circuit is open and retries timeouts,
+        dropped connections and the responses the retry policy picks out. A retry further off than the policy's
+        max_wait raises RetryLaterError rather than being waited for
+
+        :param url:     The url to request
+        :param headers: Request headers
+        :param stream:  Read the response with _read_stream
+        :return: A FetchResult of the final response
+        """
+        limiter = get_rate_limiter().host(url)
+        breaker = get_circuit_breakers().host(url)
+        policy = get_retry_policy()
+
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                CIRCUIT_OPEN.inc(host=breaker.host)
+                raise CircuitOpenError("{} is failing, skipping the request until it recovers".format(breaker.host))
+
+            # Wait our turn with the other scrapers using the same host
+            limiter.acquire()
+            request_start = perf_counter()
+            response = None
+            error = None
+            try:
+                # Borrowed for the request so the pool does not close the session as idle while it is in use
+                with get_session_pool().borrow(url) as session:
+                    if stream:
+                        response = self._read_stream(session.get(url, headers=headers, timeout=self.timeout,
+                                                                 stream=True))
+                    else:
+                        response = self._read_response(session.get(url, headers=headers, timeout=self.timeout))
+            except requests.RequestException as err:
+                error = err
+            except BaseException:
+                # Any other error still has to be reported, or a probe request would leave the circuit half-open
+                breaker.record_failure()
+                raise
+            finally:
+                latency = perf_counter() - request_start
+                limiter.release(response.status_code if response is not None else None, latency)
+
+            status_code = response.status_code if response is not None else None
+            self._record_request(breaker.host, status_code, error, latency)
+            if response is not None:
+                self._record_transfer(breaker.host, response)
+            if status_code is None or status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+            # Only failures likely to pass are retried, and not once the host's circuit has opened or if the site
+            # asks us to wait too long
+            delay = None
+            retryable = error is None or isinstance(error, (requests.Timeout, requests.ConnectionError))
+            if breaker.closed and retryable and attempt < policy.retries and policy.should_retry(status_code):
+                delay = policy.delay(attempt, response.headers.get('Retry-After') if response is not None else None)
+
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+
+            if not policy.wait_in_run(delay):
+                raise RetryLaterError("Retrying {} in {:.1f}s after {}, running again then".format(
+                    url, delay, status_code or type(error).__name__), delay)
+
+            print("Scraper #{}: Retrying {} in {:.1f}s after {}.".format(self.id, url, delay,
+                                                                        status_code or type(error).__name__))
+            RETRIES.inc(host=breaker.host)
+            sleep(delay)
+            attempt += 1
+
+    def _get_more_pages(self):
+        """
+        Retrieves the further pages of search results into more_pages. With a page template every page is
+        requested at once, with a next page link they are followed one at a time
+
+        The first page gates the run. When it is unchanged since the last run the further pages are not fetched
+        again either, so a change only on a later page is picked up once the first page changes
 
         :return:
         """
+        if self.more_pages is not None:
+            return
+
+        self.more_pages = []
+        if self.pagination is None or self.status_code != 200:
+            return
+
+        with self._stage_timer('fetch_pages') as timer:
+            if self.pagination.follows_links:
+                page_url = self._search_url()
+                response = self.response
+                for page in range(2, self.pagination.max_pages + 1):
+                    page_url = self.pagination.next_url(page_url, response.text)
+                    if page_url is None:
+                        break
+
+                    response = self._fetch_page(page_url)
+                    if response is None:
+                        break
+
+                    self.more_pages.append(SearchPage(page, response))
+                    if response.status_code != 200:
+                        break
+            else:
+                page_urls = self.pagination.page_urls(self._search_url(), self.response.text)
+                responses = get_page_pool().map(self._fetch_page, [page_url for page, page_url in page_urls])
+                self.more_pages = [SearchPage(page, response)
+                                   for (page, page_url), response in zip(page_urls, responses) if response is not None]
+
+        if not self.more_pages:
+            return
+
+        print("Scraper #{}: Retrieved {} more pages of search results.".format(self.id, len(self.more_pages)))
 
-        task_start = perf_counter()
-        task_start_dt = dt.now()
+        # Record the task details to the log
+        self.db.log_task(self.id, timer.start_dt, timer.end_dt, 'extract-pages', self.status_code,
+                         'GOOD', json.dumps({'pages': len(self.more_pages) + 1}), timer.duration, 'scraper')
 
-        print("Scraper #{}: Processing retrieved data.".format(self.id))
+    def _fetch_page(self, page_url):
+        """
+        Retrieves a further page of search results
 
-        # Search data returned OK, lets parse the hell out of it
-        if self.status_code == 200:
+        :param page_url: The url of the page
+        :return: The response, None if the page could not be retrieved
+        """
+        try:
+            return self._fetch(page_url)[0]
+        except (requests.RequestException, CircuitOpenError, RetryLaterError) as err:
+            print("Scraper #{}: Unable to retrieve {}: {}".format(self.id, page_url, err))
+            return None
 
-            self.soup = BS(self.response.text, 'html.parser')
+    def _read_stream(self, response):
+        """
+        Reads a streamed response, scanning it for the search results as it arrives. Reading stops as soon as the
+        search results have been received or the response reaches the max_response_bytes limit
 
-            # Extract the rules to be uses
-            if self.rules['searches']:
-                searchesRule = self.rules['searches'].split("/")
+        :param response: The requests response, opened with stream=True
+        :return: A FetchResult holding only the part of the body that was read
+        """
+        max_bytes = configuration.get('max_response_bytes', 5 * 1024 * 1024)
+        scanner = self.plan.scanner(response.encoding) if response.status_code == 200 else None
+        chunks = []
+        received = 0
 
-            if self.rules['products']:
-                productsRule = self.rules['products'].split("/")
+        try:
+            for chunk in response.iter_content(chunk_size=configuration.get('stream_chunk_size', 16384)):
+                chunks.append(chunk)
+                received += len(chunk)
+                if scanner is not None and scanner.feed(chunk):
+                    break
+                if received >= max_bytes:
+                    print("Scraper #{}: Response reached the {} byte limit.".format(self.id, max_bytes))
+                    self.truncated = True
+                    break
+        finally:
+            # Closing part way through drops the connection rather than reading the rest of the body
+            response.close()
+
+        if scanner is not None:
+            self.fragments = scanner.finish()
+
+        wire_bytes, http_version = wire_stats(response)
+
+        body = b''.join(chunks)
+        try:
+            text = body.decode(response.encoding or 'utf-8', errors='replace')
+        except LookupError:
+            text = body.decode('utf-8', errors='replace')
 
-            if self.rules['title']:
-                productTitleRule = self.rules['title'].split("/")
+        return FetchResult(response.status_code, text, response.headers, wire_bytes, http_version)
 
-            if self.rules['price']:
-                productPriceRule = self.rules['price'].split("/")
+    def _process_data(self):
+        """
 
-            if self.rules['stock']:
-                productStockRule = self.rules['stock'].split("/")
+        Processes the data returned by the requests library and applies the custom rules to
+        extract the relevant data from it.
 
-            # Get the main body of search results
-            resultset = self.soup.find_all(attrs={searchesRule[0]: searchesRule[1]})
+        :return: The number of items found
+        """
 
-            # Now find all the individual items
+        # Not recorded in the metrics here, _report_items records it along with parsing done elsewhere
+        with Timer() as timer:
+            print("Scraper #{}: Processing retrieved data.".format(self.id))
 
-            item_count = 0
+            backend = configuration.get('parser_backend', 'lxml')
+            partial = configuration.get('partial_parse', True)
 
-            for result in resultset:
-                items = result.find_all(attrs={productsRule[0]: productsRule[1]})
+            # Search data returned OK, lets parse the hell out of it
+            pages_items = extract_pages(self.rules, backend, partial, self._pages_to_parse())
 
-                # Now for each individual item, extract the relevant data
-                for item in items:
+        items = self._save_items(pages_items)
 
-                    item_count += 1
+        return self._report_items(items, timer.start_dt, timer.end_dt, timer.duration, pages_items.count(None))
 
-                    # Check we have data
-                    if item.find(attrs={productTitleRule[0]: productTitleRule[1]}):
-                        title = item.find(attrs={productTitleRule[0]: productTitleRule[1]}).text
+    def _needs_parsing(self):
+        """
+        Checks if the retrieved data has search results to extract
 
-                    if item.find(attrs={productPriceRule[0]: productPriceRule[1]}):
-                        price = item.find(attrs={productPriceRule[0]: productPriceRule[1]}).text.strip(' ')
+        :return: True if the rules should be applied to the response
+        """
+        return self.status_code == 200 and self.plan is not None
 
-                    # Only print if the title matches all search terms we want
-                    if title == self.terms and not allResults:
-                        print("{} [ {} ]".format(title, str(price).strip()))
-                    else:
-                        print("{} [ {} ]".format(title, str(price).strip()))
+    def _pages_to_parse(self):
+        """
+        Lists the retrieved pages, the first followed by more_pages, which have search results to extract
+
+        :return: A list holding (text, fragments, truncated) for each page to extract from, or None for a page to skip
+        """
+        pages = [(self.response.text, self.fragments, self.truncated) if self._needs_parsing() else None]
+        for more_page in self.more_pages or []:
+            parse = more_page.response.status_code == 200 and self.plan is not None
+            pages.append((more_page.response.text, None, False) if parse else None)
+        return pages
+
+    def _save_items(self, pages_items):
+        """
+        Stores the extracted items against the run and page they came from, in a single insert
+
+        :param pages_items: The items extracted from each page, in the order of _pages_to_parse, None for a page which
+                            could not be parsed
+        :return: The items from every page
+        """
+        page_numbers = [1] + [more_page.page for more_page in self.more_pages or []]
+        items = []
+        save_items = []
+        for page, page_items in zip(page_numbers, pages_items):
+            if page_items is None:
+                continue
+            items += page_items
+            save_items += [(self.id, self.current_run_at, page, item['title'], normalize_price(item['price']),
+                            item['price'], item['stock']) for item in page_items]
+
+        if save_items:
+            save_items_sql = "INSERT INTO products(scraper_id, run_at, page, title, price, price_text, stock) " \
+                             "VALUES(?, ?, ?, ?, ?, ?, ?)"
+            self.db.execute(save_items_sql, save_items)
+
+        return items
+
+    def _report_items(self, items, task_start_dt, task_end_dt, task_duration, failed_pages=0):
+        """
+        Displays the extracted items and logs how long processing took. A run with pages which could not be parsed
+        is logged as failed
+
+        :param items:           The items extracted from the response
+        :param task_start_dt:   The datetime processing started
+        :param task_end_dt:     The datetime processing finished
+        :param task_duration:   How long processing took
+        :param failed_pages:    The number of pages which could not be parsed
+        :return: The number of items found
+        """
+        for item in items:
+            print("{} [ {} ]".format(item['title'], item['price']))
 
-            return item_count
+        STAGE_SECONDS.observe(task_duration, stage='parse', **self.metric_labels)
+        ITEMS.inc(len(items), **self.metric_labels)
 
-        task_end = perf_counter()
-        task_end_dt = dt.now()
-        task_duration = task_end - task_start
+        self.failed_pages = failed_pages
+        if failed_pages:
+            PARSE_FAILURES.inc(failed_pages, **self.metric_labels)
 
         # Record the task details to the log
         self.db.log_task(self.id, task_start_dt, task_end_dt, 'process-data', self.status_code,
-                         'GOOD', '', task_duration, 'scraper')
+                         'FAILED' if failed_pages else 'GOOD',
+                         json.dumps({'failed_pages': failed_pages}) if failed_pages else '', task_duration, 'scraper')
 
-    def run(self, allResults=True):
-        """
-
-        Performs the main function of the scraper, extracting and then processing the data
+        return len(items)
 
-        :param allResults:      Controls if we wish to see all results or only the first entry returned
-        :return:
+    def _start_run(self):
         """
+        Marks the scraper as running
 
-        task_start = perf_counter()
-        task_start_dt = dt.now()
-
+        :return: The time this run started
+        """
         self.running = True
         self.last_state = self.state
         self.state = 1
-
-        current_run_at = dt.now()
+        self.fragments = None
+        self.truncated = False
+        self.failed_pages = 0
+        self.more_pages = None
+        self.retry_at = None
 
         print("Scraper #{}: Starting main execution.".format(self.id))
 
-        items_found = 0
+        self.current_run_at = dt.now()
+        return self.current_run_at
 
-        # Perform the search against the website
-        if self._get_search_results():
-            # Save the the raw data
-            self._save_search_results()
-            self._logLastRun(self.id)
-            items_found = self._process_data()
+    def _store_and_process(self, unchanged=None):
+        """
+        Stores the retrieved search results and extracts the items from them
+
+        :param unchanged:   Whether the page is unchanged since the last run, None if it has not been checked yet
+        :return: The number of items found
+        """
+        if unchanged is None:
+            unchanged = self._is_unchanged()
+
+        # Nothing to store or parse if the page is the same as last time, the first page gates the further pages
+        if unchanged:
+            self._record_unchanged()
+            return 0
+
+        self._get_more_pages()
+
+        # Save the the raw data
+        self._save_search_results()
+        self._logLastRun(self.id)
+        items_found = self._process_data()
+
+        # Keep the validators only once the page has been parsed, so a failed parse is not skipped as unchanged
+        if self.status_code == 200 and not self.failed_pages:
+            self._save_validators()
+
+        return items_found
+
+    def _record_unchanged(self):
+        """
+        Logs that the page has not changed since the last run
+
+        :return:
+        """
+        print("Scraper #{}: Search results unchanged since the last run.".format(self.id))
+        UNCHANGED.inc(**self.metric_labels)
+        now = dt.now()
+        self.db.log_task(self.id, now, now, 'unchanged', self.status_code, 'GOOD', '', 0, 'scraper')
+        self._logLastRun(self.id)
 
+    def _finish_run(self, current_run_at, run_timer):
+        """
+        Marks the scraper as stopped until its next run and logs how long the run took
+
+        :param current_run_at:  The time the run started
+        :param run_timer:       The Timer started at the start of the run
+        :return:
+        """
         self.running = False
         self.state = 0
         self.enabled = False  # Disable the scraper for the allocated duration
         self.last_run_at = current_run_at
 
-        task_end = perf_counter()
-        task_end_dt = dt.now()
-        task_duration = task_end - task_start
+        run_timer.stop()
+        RUNS.inc(code=self.status_code if self.response is not None else 'failed', **self.metric_labels)
 
         # Record the task details to the log
-        self.db.log_task(self.id, task_start_dt, task_end_dt, 'scraper-run', self.status_code,
-                         'GOOD', '', task_duration, 'scraper')
+        self.db.log_task(self.id, run_timer.start_dt, run_timer.end_dt, 'scraper-run', self.status_code,
+                         'GOOD', '', run_timer.duration, 'scraper')
+
+        self._release_run_data()
 
         print("Scraper #{}: Finished main execution.".format(self.id))
 
+    def _release_run_data(self):
+        """
+        Drops the pages retrieved on the run once they have been stored and processed, so a scraper between runs
+        does not hold on to them
+
+        :return:
+        """
+        self.response = None
+        self.more_pages = None
+        self.fragments = None
+
+    def run(self, allResults=True):
+        """
+
+        Performs the main function of the scraper, extracting and then processing the data
+
+        :param allResults:      Controls if we wish to see all results or only the first entry returned
+        :return:
+        """
+
+        run_timer = self._stage_timer('run')
+
+        current_run_at = self._start_run()
+
+        items_found = 0
+
+        # Perform the search against the website
+        if self._get_search_results():
+            items_found = self._store_and_process()
+
+        self._finish_run(current_run_at, run_timer)
+
         return items_found
@@ -0,0 +1,352 @@
+""" Session pool
+
+    Keeps a persistent requests session for each scheme and host the scrapers talk to, so repeat runs against the
+    same site reuse open keep-alive connections instead of paying for new TCP and TLS handshakes every time.
+
+    With http2 turned on in ScraperConfig.py, and httpx installed with its http2 extra, each host gets an httpx
+    client instead. Sites supporting HTTP/2 then serve every scraper's requests over one multiplexed connection,
+    while other sites are spoken to over HTTP/1.1 as before. Every session asks for the smallest content encodings
+    it can decode, zstd and br when their modules are installed and otherwise gzip.
+
+    This script is intended to be imported from other scripts and not run on it's own.
+
+"""
+
+# Imports
+import requests
+import weakref
+from requests.adapters import HTTPAdapter
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlsplit
+from ScraperConfig import configuration
+
+# HTTP/2 needs httpx with its http2 extra, which installs h2
+try:
+    import httpx
+    import h2
+except ImportError:
+    httpx = None
+
+# Content encodings in order of preference, the ones which compress pages the most first
+PREFERRED_ENCODINGS = ('zstd', 'br', 'gzip', 'deflate')
+
+
+def accept_encoding(supported):
+    """Builds the Accept-Encoding header, asking for the encodings the http client can decode with the ones which
+    compress pages the most preferred
+
+    :param supported: The Accept-Encoding header the http client sends by default, listing what it can decode
+    :return: The header value, accept_encoding from the configuration when it is set
+    """
+    if configuration.get('accept_encoding') is not None:
+        return configuration['accept_encoding']
+
+    encodings = [encoding.strip() for encoding in supported.split(',') if encoding.strip()]
+    encodings.sort(key=lambda encoding: PREFERRED_ENCODINGS.index(encoding)
+                   if encoding in PREFERRED_ENCODINGS else len(PREFERRED_ENCODINGS))
+
+    # Quality values tell the site which we would rather have, it is free to ignore them
+    return ', '.join(encoding if idx == 0 else '{};q={:.1f}'.format(encoding, 1 - idx / 10)
+                     for idx, encoding in enumerate(encodings))
+
+
+def wire_stats(response):
+    """Gets how a response came over the wire, read once the body has been read
+
+    :param response: A requests response or an Http2Response
+    :return: A tuple of (bytes received before decoding, None if not known, the http version)
+    """
+    if isinstance(response, Http2Response):
+        return response.wire_bytes, response.http_version
+
+    raw = response.raw
+    if raw is None or not hasattr(raw, 'tell'):
+        return None, None
+    return raw.tell(), getattr(raw, 'version_string', None)
+
+
+class Http2Response:
+    """
+    An httpx response, with the parts of the requests response interface the scrapers use
+
+    :param response: The httpx response
+
+    Methods
+    -----------
+    iter_content(chunk_size)
+        Reads the body a chunk at a time, for streamed requests
+
+    close()
+        Closes the response
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    @property
+    def encoding(self):
+        return self.response.encoding
+
+    @property
+    def text(self):
+        return self.response.text
+
+    @property
+    def wire_bytes(self):
+        return self.response.num_bytes_downloaded
+
+    @property
+    def http_version(self):
+        return self.response.http_version
+
+    def iter_content(self, chunk_size=16384):
+        """Reads the decoded body a chunk at a time
+
+        :param chunk_size: Bytes read at a time
+        :return: A generator of chunks of bytes
+        """
+        with Http2Session.translate_errors():
+            yield from self.response.iter_bytes(chunk_size)
+
+    def close(self):
+        self.response.close()
+
+
+class Http2Session:
+    """
+    An httpx client which talks HTTP/2 to the sites supporting it, used in place of a requests session
+
+    :param pool_size:   The maximum number of connections kept open to the host, only one is needed for HTTP/2
+
+    Methods
+    -----------
+    get(url, headers, timeout, stream)
+        Requests a url
+
+    translate_errors()
+        Raises httpx errors as the requests errors the scrapers handle
+
+    stats()
+        Returns the connection statistics
+
+    close()
+        Closes the client and its connections
+    """
+
+    def __init__(self, pool_size=10):
+        self.client = httpx.Client(http2=True, follow_redirects=True,
+                                   limits=httpx.Limits(max_connections=pool_size,
+                                                       max_keepalive_connections=pool_size))
+        self.client.headers['Accept-Encoding'] = accept_encoding(self.client.headers['Accept-Encoding'])
+        self.requests = 0
+        self.connections = 0  # Connections opened, counted from the network streams seen
+        self._streams = weakref.WeakSet()
+        self.lock = Lock()
+
+    @staticmethod
+    @contextmanager
+    def translate_errors():
+        """Raises httpx errors as the requests errors the scrapers handle
+
+        :return: Nothing
+        """
+        try:
+            yield
+        except httpx.TimeoutException as err:
+            raise requests.Timeout(str(err) or type(err).__name__) from err
+        except httpx.TransportError as err:
+            raise requests.ConnectionError(str(err) or type(err).__name__) from err
+        except httpx.HTTPError as err:
+            raise requests.RequestException(str(err) or type(err).__name__) from err
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        """Requests a url
+
+        :param url:     The url to request
+        :param headers: Request headers
+        :param timeout: Seconds to wait for the site
+        :param stream:  Return before reading the body, to be read with iter_content
+        :return: An Http2Response
+        """
+        with self.translate_errors():
+            if stream:
+                request = self.client.build_request('GET', url, headers=headers, timeout=timeout)
+                response = self.client.send(request, stream=True)
+            else:
+                response = self.client.get(url, headers=headers, timeout=timeout)
+
+        # Every request over a connection reports the same network stream
+        network_stream = response.extensions.get('network_stream')
+        with self.lock:
+            self.requests += 1
+            if network_stream is not None and network_stream not in self._streams:
+                self._streams.add(network_stream)
+                self.connections += 1
+
+        return Http2Response(response)
+
+    def stats(self):
+        """Gets the connection statistics
+
+        :return: A dictionary of the number of requests made, connections opened and connections currently open
+        """
+        # A network stream is only held while its connection is in the client's pool, once the connection is closed
+        # and dropped it falls out of the weak set
+        with self.lock:
+            return {'requests': self.requests, 'connections': self.connections, 'open_connections': len(self._streams)}
+
+    def close(self):
+        self.client.close()
+
+
+class SessionPool:
+    """
+    A pool of requests sessions keyed by scheme and host
+
+    :param pool_size:       The maximum number of connections kept open to each host
+    :param idle_timeout:    Seconds a host's session can go unused before it is closed
+    :param http2:           Use an httpx client talking HTTP/2 for each host, when httpx is installed
+
+    Methods
+    -----------
+    borrow(url)
+        Lends out the session to use for the url for the length of a request
+
+    stats(url)
+        Returns the connection statistics for the url's host
+
+    close()
+        Closes every session in the pool
+    """
+
+    def __init__(self, pool_size=10, idle_timeout=300, http2=False):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        if http2 and httpx is None:
+            print("SessionPool: httpx and h2 are needed for HTTP/2, using HTTP/1.1.")
+        self.http2 = http2 and httpx is not None
+        self.sessions = {}  # (scheme, host): [session, last used, requests using it]
+        self.lock = Lock()
+
+    @staticmethod
+    def _key(url):
+        parts = urlsplit(url)
+        return parts.scheme, parts.netloc
+
+    def _evict_idle(self, now):
+        """Closes the sessions which have not been used within the idle timeout, leaving any still lent out
+
+        :param now: The current monotonic time
+        :return: Nothing
+        """
+        for key, (session, last_used, in_use) in list(self.sessions.items()):
+            if not in_use and now - last_used > self.idle_timeout:
+                session.close()
+                del (self.sessions[key])
+
+    @contextmanager
+    def borrow(self, url):
+        """Lends out the session to use for the url, creating one if the host has not been seen before. The session
+        is not closed as idle until every request borrowing it has finished
+
+        :param url: The url about to be requested
+        :return: A requests session
+        """
+        key = self._key(url)
+        now = monotonic()
+
+        with self.lock:
+            self._evict_idle(now)
+
+            entry = self.sessions.get(key)
+            if entry is None:
+                if self.http2:
+                    session = Http2Session(self.pool_size)
+                else:
+                    session = requests.Session()
+                    session.headers['Accept-Encoding'] = accept_encoding(session.headers['Accept-Encoding'])
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("{}://".format(key[0]), adapter)
+                entry = self.sessions[key] = [session, now, 0]
+            entry[2] += 1
+
+        try:
+            yield entry[0]
+        finally:
+            # Idle from when the last request finished
+            with self.lock:
+                entry[1] = monotonic()
+                entry[2] -= 1
+
+    def stats(self, url):
+        """Gets the connection statistics for the url's host
+
+        :param url: Any url on the host
+        :return: A dictionary of the number of requests made, connections opened and currently open and the ratio of
+                 requests that reused an existing connection
+        """
+        key = self._key(url)
+        result = {'host': "{}://{}".format(*key), 'requests': 0, 'connections': 0, 'open_connections': 0,
+                  'reuse_ratio': 0.0}
+
+        with self.lock:
+            if key not in self.sessions:
+                return result
+            session = self.sessions[key][0]
+
+        if isinstance(session, Http2Session):
+            result.update(session.stats())
+            if result['requests']:
+                result['reuse_ratio'] = round(1 - result['connections'] / result['requests'], 3)
+            return result
+
+        adapter = session.get_adapter(result['host'])
+
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            result['requests'] += pool.num_requests
+            result['connections'] += pool.num_connections
+            # Idle connections sit in the pool's queue, unused slots are held as None
+            result['open_connections'] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+
+        if result['requests']:
+            result['reuse_ratio'] = round(1 - result['connections'] / result['requests'], 3)
+
+        return result
+
+    def close(self):
+        """Closes every session in the pool
+
+        :return: Nothing
+        """
+        with self.lock:
+            for session, last_used, in_use in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+# The process wide pool, shared by every scraper
+_session_pool = None
+_session_pool_lock = Lock()
+
+
+def get_session_pool():
+    """Gets the process wide session pool, creating it from the configuration on first use
+
+    :return: The SessionPool object
+    """
+    global _session_pool
+
+    with _session_pool_lock:
+        if _session_pool is None:
+            _session_pool = SessionPool(configuration.get('http_pool_size', 10),
+                                        configuration.get('http_pool_idle_timeout', 300),
+                                        configuration.get('http2', False))
+        return _session_pool
@@ -0,0 +1,56 @@
+""" Blob store tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blob_store import BlobStore
+from database import DbSqlite3Wrapper
+
+PAGE = '<html><body>' + 'Bath taps £9.99 ' * 100 + '</body></html>'
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbo = DbSqlite3Wrapper(os.path.join(self.directory, 'test.db'))
+        self.dbo.connect()
+        self.dbo.setup_scrapers_db()
+        self.blobs = BlobStore(self.dbo)
+
+    def tearDown(self):
+        self.dbo.close()
+        shutil.rmtree(self.directory)
+
+    def test_body_is_stored_once(self):
+        with mock.patch('blob_store.zlib.compress', wraps=zlib.compress) as compress:
+            content_hash = self.blobs.put(PAGE)
+            self.assertEqual(self.blobs.put(PAGE), content_hash)
+            self.assertEqual(self.blobs.put(PAGE, content_hash), content_hash)
+
+        # Only compressed the first time, when it was not already held
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(self.dbo.query("SELECT COUNT(*) FROM raw_blobs"), [(1,)])
+        self.assertEqual(self.blobs.get(content_hash), PAGE)
+
+    def test_hash_given_is_used(self):
+        content_hash = self.blobs.content_hash(PAGE)
+        self.assertEqual(self.blobs.put(PAGE, content_hash), content_hash)
+        self.assertEqual(self.blobs.get(content_hash), PAGE)
+        self.assertIsNone(self.blobs.get('missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+""" Database wrapper and migration tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DbSqlite3Wrapper
+from migrations import MIGRATIONS, schema_version
+
+
+class TestWriterThread(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.directory, 'test.db')
+        self.dbo = DbSqlite3Wrapper(self.db_file, writer_thread=True)
+        self.dbo.connect()
+        self.dbo.setup_scrapers_db()
+
+    def tearDown(self):
+        self.dbo.close()
+        shutil.rmtree(self.directory)
+
+    def test_writes_apply_in_order(self):
+        self.dbo.execute("INSERT INTO customers(id, name, description) VALUES(?, ?, ?)", [(1, 'first', '')])
+        for name in ('second', 'third', 'fourth'):
+            self.dbo.update("UPDATE customers SET name = ? WHERE id = ?", [(name, 1)])
+
+        # A thread sees its own queued writes without waiting for a sync
+        self.assertEqual(self.dbo.query("SELECT name FROM customers WHERE id = 1"), [('fourth',)])
+
+    def test_sync_commits_every_thread_write(self):
+        def insert(start):
+            for customer_id in range(start, start + 100):
+                self.dbo.execute("INSERT INTO customers(id, name, description) VALUES(?, ?, ?)",
+                                 [(customer_id, 'c', '')])
+
+        threads = [Thread(target=insert, args=(start,)) for start in (0, 100, 200, 300)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.dbo.sync()
+
+        # Committed, so another connection sees every row
+        conn = sqlite3.connect(self.db_file)
+        try:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM customers").fetchone(), (400,))
+        finally:
+            conn.close()
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbo = DbSqlite3Wrapper(os.path.join(self.directory, 'test.db'))
+        self.dbo.connect()
+
+        # The tables as first released, with a page stored the way the first version stored them
+        self.dbo.setup_scrapers_db(migrate=False)
+        self.dbo.execute("INSERT INTO raw_data(scraper_id, date_time, content, http_code) VALUES(?, ?, ?, ?)",
+                         [(1, '2020-11-01 12:00:00', '<html></html>', 200),
+                          (1, '2020-11-01 13:00:00', '<html></html>', 200)])
+
+    def tearDown(self):
+        self.dbo.close()
+        shutil.rmtree(self.directory)
+
+    def test_baseline_schema_is_brought_up_to_date(self):
+        self.assertEqual(schema_version(self.dbo.conn), 0)
+        self.assertEqual(self.dbo.migrate(), MIGRATIONS[-1][0])
+
+        # raw_data was rebuilt with a real key, keeping its rows
+        self.assertEqual(self.dbo.query("SELECT id, page FROM raw_data ORDER BY id"), [(1, 1), (2, 1)])
+        self.assertEqual(self.dbo.query("SELECT COUNT(*) FROM products"), [(0,)])
+        self.assertEqual(self.dbo.query("SELECT version FROM config_state"), [(0,)])
+
+    def test_migrate_twice_does_nothing(self):
+        version = self.dbo.migrate()
+        self.assertEqual(self.dbo.migrate(), version)
+        self.assertEqual(self.dbo.query("SELECT COUNT(*) FROM raw_data"), [(2,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
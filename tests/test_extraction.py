@@ -0,0 +1,94 @@
+""" Extraction regression tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraction import ExtractionPlan, StreamScanner, extract_items, extract_pages, prescan_containers
+
+RULES = {
+    'searches': 'class/results',
+    'products': 'class/product',
+    'title': 'class/title',
+    'price': 'class/price',
+}
+
+# The script and comment inside the search results hold tags which must not be counted as the container's own
+PAGE = '<html><head><title>Search</title></head><body>' \
+       '<div class="results">' \
+       '<div class="product"><span class="title">A</span><span class="price">£1.00</span></div>' \
+       '<script>var s = "<div>"; var t = "</div>";</script>' \
+       '<!-- <div class="old"> -->' \
+       '<div class="product"><span class="title">B</span><span class="price">£2.00</span></div>' \
+       '</div>' \
+       '<footer>Footer</footer></body></html>'
+
+
+class TestPartialParse(unittest.TestCase):
+
+    def test_partial_matches_full_parse(self):
+        for backend in ('lxml', 'bs4'):
+            plan = ExtractionPlan(RULES, backend)
+            full = plan.extract(PAGE, partial=False)
+            self.assertEqual([item['title'] for item in full], ['A', 'B'])
+            self.assertEqual(plan.extract(PAGE, partial=True), full)
+
+    def test_prescan_skips_scripts_and_comments(self):
+        plan = ExtractionPlan(RULES, 'lxml')
+        containers = prescan_containers(PAGE, plan.searches_pattern)
+        self.assertEqual(len(containers), 1)
+        self.assertTrue(containers[0].endswith('£2.00</span></div></div>'))
+
+    def test_stream_scanner_with_split_script(self):
+        plan = ExtractionPlan(RULES, 'lxml')
+        scanner = StreamScanner(plan.searches_pattern)
+        data = PAGE.encode('utf-8')
+        # Feed a few bytes at a time so the script and comment are split between chunks
+        for offset in range(0, len(data), 7):
+            if scanner.feed(data[offset:offset + 7]):
+                break
+        fragments = scanner.finish()
+        self.assertEqual([item['title'] for item in plan.extract_fragments(fragments)], ['A', 'B'])
+
+    def test_unparseable_container_falls_back_to_full_parse(self):
+        plan = ExtractionPlan(RULES, 'lxml')
+
+        def parse_containers(text):
+            raise ValueError("Multiple elements found")
+
+        plan.backend.parse_containers = parse_containers
+        self.assertEqual([item['title'] for item in plan.extract(PAGE, partial=True)], ['A', 'B'])
+
+
+class TestRules(unittest.TestCase):
+
+    def test_rule_values_with_both_quotes(self):
+        rules = dict(RULES, title='data-name/it\'s "B"')
+        page = PAGE.replace('<span class="title">B</span>', '<span data-name="it\'s &quot;B&quot;">B</span>')
+        for backend in ('lxml', 'bs4'):
+            items = ExtractionPlan(rules, backend).extract(page, partial=False)
+            self.assertEqual([item['title'] for item in items], [None, 'B'])
+
+
+class TestStreamedPages(unittest.TestCase):
+
+    def test_no_fragments_parses_whole_page(self):
+        items = extract_items(RULES, 'lxml', True, PAGE, [])
+        self.assertEqual([item['title'] for item in items], ['A', 'B'])
+
+    def test_truncated_page_without_fragments_fails(self):
+        truncated = PAGE[:40]
+        pages_items = extract_pages(RULES, 'lxml', True, [(truncated, [], True), (PAGE, None, False)])
+        self.assertIsNone(pages_items[0])
+        self.assertEqual([item['title'] for item in pages_items[1]], ['A', 'B'])
+
+
+if __name__ == '__main__':
+    unittest.main()
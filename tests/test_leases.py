@@ -0,0 +1,129 @@
+""" Scraper lease tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DbSqlite3Wrapper
+from leases import LeaseManager
+
+NOW = 1000000.0
+SCRAPERS = 20
+
+
+class TestLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        db_file = os.path.join(self.directory, 'test.db')
+
+        setup = DbSqlite3Wrapper(db_file)
+        setup.connect()
+        setup.setup_scrapers_db()
+        setup.execute("INSERT INTO scrapers(id, name, enabled, customer_id, search_terms, next_due) "
+                      "VALUES(?, ?, ?, ?, ?, ?)", [(idx, 's', 1, 1, 'taps', 0) for idx in range(1, SCRAPERS + 1)])
+        setup.close()
+
+        # Two factories, each with a connection of its own
+        self.dbos = []
+        self.factories = []
+        for owner in ('a', 'b'):
+            dbo = DbSqlite3Wrapper(db_file)
+            dbo.connect()
+            self.dbos.append(dbo)
+            self.factories.append(LeaseManager(dbo, lease_seconds=60.0, owner=owner))
+        self.a, self.b = self.factories
+
+    def tearDown(self):
+        for dbo in self.dbos:
+            dbo.close()
+        shutil.rmtree(self.directory)
+
+    def test_claims_do_not_overlap(self):
+        claimed_a = self.a.claim(NOW, 8)
+        claimed_b = self.b.claim(NOW, SCRAPERS)
+
+        self.assertEqual(len(claimed_a), 8)
+        self.assertEqual(len(claimed_b), SCRAPERS - 8)
+        self.assertFalse(set(claimed_a) & set(claimed_b))
+        self.assertEqual(self.a.claim(NOW, SCRAPERS), [])
+
+    def test_concurrent_claims_never_run_a_scraper_twice(self):
+        claims = {'a': [], 'b': []}
+
+        def claim(manager):
+            for _ in range(SCRAPERS):
+                claims[manager.owner] += manager.claim(NOW, 1)
+
+        threads = [Thread(target=claim, args=(manager,)) for manager in self.factories]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(claims['a'] + claims['b']), list(range(1, SCRAPERS + 1)))
+
+    def test_release_sets_the_next_due_time(self):
+        claimed = self.a.claim(NOW, 1)
+        self.a.release(claimed[0], NOW + 3600)
+
+        self.assertNotIn(claimed[0], self.b.claim(NOW, SCRAPERS))
+        self.assertNotIn(claimed[0], self.b.claim(NOW + 3599, SCRAPERS))
+        self.assertIn(claimed[0], self.b.claim(NOW + 3600, SCRAPERS))
+
+    def test_expired_lease_is_taken_over(self):
+        claimed = self.a.claim(NOW, 1)
+
+        # Still leased until it expires
+        self.assertNotIn(claimed[0], self.b.claim(NOW + 30, SCRAPERS))
+        self.assertEqual(self.b.claim(NOW + 61, 1), claimed)
+
+        # The old owner's late release leaves the new lease alone
+        self.a.release(claimed[0], NOW + 3600)
+        self.assertEqual(self.dbos[1].query("SELECT lease_owner FROM scrapers WHERE id = ?", claimed), [('b',)])
+
+    def test_renew_keeps_the_lease(self):
+        claimed = self.a.claim(NOW, 1)
+        self.a.renew()
+
+        # Renewed from the current time, far past the lease taken at NOW
+        self.assertNotIn(claimed[0], self.b.claim(NOW + 61, SCRAPERS))
+
+    def test_next_claim_at(self):
+        self.dbos[0].update("UPDATE scrapers SET next_due = ? WHERE id = ?",
+                            [(NOW + idx, idx) for idx in range(1, SCRAPERS + 1)])
+        self.assertEqual(self.a.next_claim_at(NOW), NOW + 1)
+
+        # The earliest scraper without a lease
+        self.a.claim(NOW + 2, 2)
+        self.assertEqual(self.b.next_claim_at(NOW + 2), NOW + 3)
+
+        # Once all are leased, the earliest lease to expire
+        self.b.claim(NOW + SCRAPERS, SCRAPERS)
+        self.assertEqual(self.b.next_claim_at(NOW + SCRAPERS), NOW + 62)
+
+        # And once expired, the earliest due of the expired leases
+        self.assertEqual(self.b.next_claim_at(NOW + 100), NOW + 1)
+
+        self.dbos[0].update("UPDATE scrapers SET enabled = 0", [()])
+        self.assertIsNone(self.a.next_claim_at(NOW))
+
+    def test_stop_releases_every_lease(self):
+        claimed = self.a.claim(NOW, 5)
+        self.a.stop()
+
+        self.assertEqual(sorted(self.b.claim(NOW, 5)), sorted(claimed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+""" Pagination tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraction import ExtractionError
+from pagination import get_pagination
+
+SEARCH_URL = 'https://shop.com/search?q=taps'
+
+LINKS = '<html><body><div class="pagination">' \
+        '<a href="/search?q=taps&amp;page=2">2</a><a href="/search?q=taps&amp;page=3">3</a>' \
+        '<a href="/search?q=taps&amp;page=13">Sale</a>' \
+        '</div></body></html>'
+
+
+class TestPageTemplate(unittest.TestCase):
+
+    def test_pages_from_the_links(self):
+        pagination = get_pagination({'pagination': '&page={page}'})
+        self.assertEqual(pagination.page_urls(SEARCH_URL, LINKS.replace('13', '3')),
+                         [(2, SEARCH_URL + '&page=2'), (3, SEARCH_URL + '&page=3')])
+
+    def test_pages_limited_by_max_pages(self):
+        pagination = get_pagination({'pagination': '&page={page}', 'max_pages': '4'})
+        self.assertEqual([page for page, url in pagination.page_urls(SEARCH_URL, LINKS)], [2, 3, 4])
+
+    def test_pages_from_the_page_count(self):
+        pagination = get_pagination({'pagination': '/page/{page}', 'page_count': 'class/page-count'}, max_pages=20)
+        text = '<html><body><span class="page-count">Page 1 of <b>12</b></span>' \
+               '<a href="/search/page/30">30</a></body></html>'
+
+        urls = pagination.page_urls('https://shop.com/search', text)
+        self.assertEqual(len(urls), 11)
+        self.assertEqual(urls[-1], (12, 'https://shop.com/search/page/12'))
+
+    def test_single_page(self):
+        pagination = get_pagination({'pagination': '&page={page}'})
+        self.assertEqual(pagination.page_urls(SEARCH_URL, '<html></html>'), [])
+
+
+class TestNextLink(unittest.TestCase):
+
+    def setUp(self):
+        self.pagination = get_pagination({'pagination': 'next:class/next'})
+
+    def test_next_link_is_followed(self):
+        text = '<html><body><a class="next" href="?q=taps&amp;page=2">Next</a></body></html>'
+        self.assertTrue(self.pagination.follows_links)
+        self.assertEqual(self.pagination.next_url(SEARCH_URL, text), 'https://shop.com/search?q=taps&page=2')
+
+    def test_last_page(self):
+        self.assertIsNone(self.pagination.next_url(SEARCH_URL, '<html><body><span class="next"></span></body></html>'))
+        self.assertIsNone(self.pagination.next_url(SEARCH_URL, '<html><body></body></html>'))
+
+        # A link back to the same page ends the pages too
+        text = '<html><body><a class="next" href="{}">Next</a></body></html>'.format(SEARCH_URL)
+        self.assertIsNone(self.pagination.next_url(SEARCH_URL, text))
+
+
+class TestRules(unittest.TestCase):
+
+    def test_no_pagination(self):
+        self.assertIsNone(get_pagination({'products': 'class/product'}))
+
+    def test_invalid_rules(self):
+        with self.assertRaises(ExtractionError):
+            get_pagination({'pagination': '?page=2'})
+        with self.assertRaises(ExtractionError):
+            get_pagination({'pagination': '?page={page}', 'max_pages': 'ten'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+""" Host rate limiter tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import HostLimiter
+
+
+class TestHostLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = HostLimiter(max_concurrency=8, min_concurrency=1)
+
+    def request(self, status_code, latency=0.1):
+        self.limiter.acquire()
+        self.limiter.release(status_code, latency)
+
+    def test_throttled_response_halves_the_limit(self):
+        self.request(200)
+        self.request(503)
+        self.assertEqual(self.limiter.limit, 4)
+        self.assertEqual(self.limiter.throttled, 1)
+
+        # Responses to requests already in flight do not halve it again within the usual response time
+        self.request(429)
+        self.assertEqual(self.limiter.limit, 4)
+
+    def test_healthy_responses_grow_the_limit(self):
+        self.request(200)
+        self.request(503)
+
+        # One for each limit's worth of healthy responses
+        for _ in range(4):
+            self.request(200)
+        self.assertAlmostEqual(self.limiter.limit, 5, delta=0.1)
+
+        for _ in range(100):
+            self.request(200)
+        self.assertEqual(self.limiter.limit, 8)
+
+    def test_latency_spike_and_failures_back_off_to_the_minimum(self):
+        self.request(200)
+        self.limiter.backed_off_at -= 1
+        self.request(200, latency=1.0)
+        self.assertEqual(self.limiter.limit, 4)
+
+        for _ in range(5):
+            self.limiter.backed_off_at -= 1
+            self.request(None)
+        self.assertEqual(self.limiter.limit, 1)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+""" Scraper registry tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from registry import ScraperRegistry
+
+
+def config(rules):
+    return {
+        'enabled': 1,
+        'search_terms': 'taps',
+        'timeout': 10,
+        'last_updated': '2020-11-01 12:00:00',
+        'run_frequency': 1,
+        'validators': {'etag': '"abc"', 'last_modified': None, 'content_hash': 'abc'},
+        'rules': rules,
+    }
+
+
+class TestSharedRules(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ScraperRegistry()
+        self.registry.add(1, config({'products': 'class/product', 'title': 'class/title'}))
+        self.registry.add(2, config({'products': 'class/product', 'title': 'class/title'}))
+
+    def test_same_rules_are_shared(self):
+        self.assertIs(self.registry[1].rules, self.registry[2].rules)
+        self.assertEqual(len(self.registry._rules), 1)
+
+    def test_rules_dropped_once_no_scraper_uses_them(self):
+        rules = self.registry[1].rules
+
+        del self.registry[1]
+        self.assertIn(rules, self.registry._rules)
+
+        del self.registry[2]
+        self.assertEqual(self.registry._rules, {})
+
+    def test_reload_drops_the_old_rules(self):
+        self.registry[1].last_run_at = 1000.0
+        self.registry.reload(1, config({'products': 'class/item'}))
+        self.registry.reload(2, config({'products': 'class/item'}))
+
+        self.assertEqual(list(self.registry._rules), [(('products', 'class/item'),)])
+        self.assertIs(self.registry[1].rules, self.registry[2].rules)
+
+        # The last run is kept, the validators are not
+        self.assertEqual(self.registry[1].last_run_at, 1000.0)
+        self.assertIsNone(self.registry[1].etag)
+
+    def test_adding_again_releases_the_rules_it_replaces(self):
+        self.registry.add(1, config({'products': 'class/item'}))
+        self.registry.add(1, config({'products': 'class/item'}))
+
+        self.assertEqual(self.registry._rules[self.registry[1].rules][1], 1)
+        self.assertEqual(self.registry._rules[self.registry[2].rules][1], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
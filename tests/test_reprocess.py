@@ -0,0 +1,85 @@
+""" Reprocess tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DbSqlite3Wrapper
+from reprocess import raw_data_sql, reprocess_chunk, replace_products
+
+RULES = {
+    'searches': 'class/results',
+    'products': 'class/product',
+    'title': 'class/title',
+    'price': 'class/price',
+}
+
+PAGE = '<html><body><div class="results">' \
+       '<div class="product"><span class="title">New</span><span class="price">£3.00</span></div>' \
+       '</div></body></html>'
+
+RUN_AT = '2020-11-01 12:00:00'
+
+
+class TestReprocess(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbo = DbSqlite3Wrapper(os.path.join(self.directory, 'test.db'))
+        self.dbo.connect()
+        self.dbo.setup_scrapers_db()
+
+        # A run of two pages, the first page's blob can not be decoded
+        self.dbo.execute("INSERT INTO raw_blobs(hash, encoding, size, content) VALUES(?, ?, ?, ?)",
+                         [('broken', 'zlib', 10, b'not zlib')])
+        self.dbo.execute("INSERT INTO raw_data(scraper_id, date_time, http_code, page, content_hash, content) "
+                         "VALUES(?, ?, ?, ?, ?, ?)", [(1, RUN_AT, 200, 1, 'broken', None),
+                                                      (1, RUN_AT, 200, 2, None, PAGE)])
+        self.dbo.execute("INSERT INTO products(scraper_id, run_at, page, title, price, price_text, stock) "
+                         "VALUES(?, ?, ?, ?, ?, ?, ?)", [(1, RUN_AT, 1, 'First', 1.0, '£1.00', None),
+                                                         (1, RUN_AT, 2, 'Old', 2.0, '£2.00', None)])
+
+    def tearDown(self):
+        self.dbo.close()
+        shutil.rmtree(self.directory)
+
+    def products(self):
+        return self.dbo.query("SELECT page, title FROM products ORDER BY page")
+
+    def test_chunk_extracts_product_rows(self):
+        rows = [(7, 1, RUN_AT, 3, PAGE, None, None), (8, 2, RUN_AT, 1, PAGE, None, None)]
+
+        # Scraper 2 has no rules so its page is left alone
+        pages, products = reprocess_chunk(rows, {1: RULES}, 'lxml', True)
+        self.assertEqual(pages, [(1, RUN_AT, 3)])
+        self.assertEqual(products, [(1, RUN_AT, 3, 'New', 3.0, '£3.00', None)])
+
+    def test_failed_page_keeps_its_products(self):
+        rows = self.dbo.query(raw_data_sql + " ORDER BY r.id")
+        pages, products = reprocess_chunk(rows, {1: RULES}, 'lxml', True)
+        self.assertEqual(pages, [(1, RUN_AT, 2)])
+
+        replace_products(self.dbo, pages, products)
+        self.assertEqual(self.products(), [(1, 'First'), (2, 'New')])
+
+    def test_pages_of_a_run_in_different_chunks(self):
+        rows = self.dbo.query(raw_data_sql + " ORDER BY r.id")
+        rows[0] = rows[0][:4] + (PAGE, None, None)
+
+        # The second page is stored first, the first page must not delete its products
+        for chunk in (rows[1:], rows[:1]):
+            replace_products(self.dbo, *reprocess_chunk(chunk, {1: RULES}, 'lxml', True))
+        self.assertEqual(self.products(), [(1, 'New'), (2, 'New')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+""" Response cache tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import asyncio
+import os
+import sys
+import time
+import unittest
+from threading import Event, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from response_cache import COALESCED, HIT, MISS, ResponseCache
+
+
+class Response:
+    """A response with the text, status and headers read, as the scrapers hand to the cache"""
+
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+        self.headers = {'Content-Type': 'text/html'}
+
+
+class TestCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        # Nothing kept, so a response can only be shared while its request is in flight
+        self.cache = ResponseCache(ttl=0)
+        self.requests = 0
+        self.release = Event()
+
+        # Let the first request finish once the second is waiting on it
+        lookup = self.cache._lookup
+
+        def lookup_then_release(*args):
+            source, shared = lookup(*args)
+            if source == COALESCED:
+                self.release.set()
+            return source, shared
+
+        self.cache._lookup = lookup_then_release
+
+    def request(self):
+        self.requests += 1
+        self.release.wait(5)
+        return Response('<html>{}</html>'.format(self.requests))
+
+    def test_request_in_flight_is_shared(self):
+        results = []
+        first = Thread(target=lambda: results.append(self.cache.fetch('https://a.com/s', {}, self.request)))
+        first.start()
+        while not self.cache._in_flight:
+            time.sleep(0.001)
+
+        response, source = self.cache.fetch('https://a.com/s', {}, self.request)
+        first.join()
+
+        self.assertEqual(source, COALESCED)
+        self.assertEqual(results, [(response, MISS)])
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(self.cache._in_flight, {})
+
+        # Once finished the next request is made again
+        self.assertEqual(self.cache.fetch('https://a.com/s', {}, self.request)[1], MISS)
+        self.assertEqual(self.requests, 2)
+
+    def test_failed_request_fails_the_waiters(self):
+        def fail():
+            self.release.wait(5)
+            raise ConnectionError('refused')
+
+        errors = []
+
+        def fetch():
+            try:
+                self.cache.fetch('https://a.com/s', {}, fail)
+            except ConnectionError as err:
+                errors.append(err)
+
+        first = Thread(target=fetch)
+        first.start()
+        while not self.cache._in_flight:
+            time.sleep(0.001)
+
+        fetch()
+        first.join()
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+    def test_different_conditional_headers_are_not_shared(self):
+        self.release.set()
+        self.cache.fetch('https://a.com/s', {}, self.request)
+        self.cache.fetch('https://a.com/s', {'If-None-Match': '"abc"'}, self.request)
+        self.assertEqual(self.requests, 2)
+
+    def test_requests_on_the_event_loop_are_shared(self):
+        async def request():
+            self.requests += 1
+            await asyncio.sleep(0.01)
+            return Response('<html></html>')
+
+        async def fetch_both():
+            return await asyncio.gather(self.cache.fetch_async('https://a.com/s', {}, request),
+                                        self.cache.fetch_async('https://a.com/s', {}, request))
+
+        (first, first_source), (second, second_source) = asyncio.run(fetch_both())
+        self.assertIs(first, second)
+        self.assertEqual((first_source, second_source), (MISS, COALESCED))
+        self.assertEqual(self.requests, 1)
+
+
+class TestKeptResponses(unittest.TestCase):
+
+    def setUp(self):
+        size = ResponseCache._size(Response('<html>a</html>'))
+        self.cache = ResponseCache(ttl=60.0, max_bytes=size * 2, coalesce=False)
+
+    def test_least_recently_used_is_evicted(self):
+        a, b, c = (Response('<html>{}</html>'.format(name)) for name in 'abc')
+        self.cache.put('https://a.com/a', a)
+        self.cache.put('https://a.com/b', b)
+
+        # Using a makes b the least recently used
+        self.assertIs(self.cache.get('https://a.com/a'), a)
+        self.cache.put('https://a.com/c', c)
+
+        self.assertIsNone(self.cache.get('https://a.com/b'))
+        self.assertIs(self.cache.get('https://a.com/a'), a)
+        self.assertIs(self.cache.get('https://a.com/c'), c)
+        self.assertLessEqual(self.cache.size, self.cache.max_bytes)
+
+    def test_kept_response_is_a_hit_until_it_expires(self):
+        self.cache.ttl = 0.05
+        self.cache.put('https://a.com/a', Response('<html>a</html>'))
+        self.assertEqual(self.cache.fetch('https://a.com/a', {}, None)[1], HIT)
+
+        time.sleep(0.06)
+        self.assertIsNone(self.cache.get('https://a.com/a'))
+        self.assertEqual(self.cache.size, 0)
+
+    def test_only_successful_responses_are_kept(self):
+        self.cache.put('https://a.com/a', Response('<html>a</html>', status_code=503))
+        self.cache.put('https://a.com/b', Response('<html>' + 'b' * 1000 + '</html>'))
+        self.assertEqual(len(self.cache.entries), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+""" Retry policy and circuit breaker tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import sys
+import unittest
+from datetime import datetime as dt, timedelta, timezone
+from email.utils import format_datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retry import CircuitBreaker, RetryPolicy
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_backoff_doubles_up_to_the_max(self):
+        policy = RetryPolicy(backoff_base=1.0, backoff_max=30.0)
+        for attempt in range(10):
+            for _ in range(50):
+                delay = policy.delay(attempt)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, min(30.0, 2 ** attempt))
+
+    def test_retry_after_is_honoured(self):
+        policy = RetryPolicy(backoff_base=0.01, max_retry_after=120.0)
+        self.assertGreaterEqual(policy.delay(0, '5'), 5.0)
+
+        retry_at = format_datetime(dt.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+        self.assertAlmostEqual(policy.delay(0, retry_at), 60.0, delta=2.0)
+
+        # Too long to wait for, not retried at all
+        self.assertIsNone(policy.delay(0, '500'))
+
+    def test_retry_codes_and_waits_in_the_run(self):
+        policy = RetryPolicy(retry_codes=(429, 503), max_wait=5.0)
+        self.assertTrue(policy.should_retry(None))
+        self.assertTrue(policy.should_retry(503))
+        self.assertFalse(policy.should_retry(404))
+        self.assertTrue(policy.wait_in_run(5.0))
+        self.assertFalse(policy.wait_in_run(5.1))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('example.com', failure_threshold=2, reset_timeout=60.0)
+
+    def open_circuit(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def wait_out_reset(self):
+        self.breaker.opened_at -= self.breaker.reset_timeout
+
+    def test_opens_after_failures_in_a_row(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_probe_success_closes(self):
+        self.open_circuit()
+        self.wait_out_reset()
+
+        # Only the one probe request is let through while half-open
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.closed)
+        self.assertTrue(self.breaker.allow())
+
+    def test_probe_failure_opens_again(self):
+        self.open_circuit()
+        self.wait_out_reset()
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_lost_probe_is_replaced(self):
+        self.open_circuit()
+        self.wait_out_reset()
+        self.assertTrue(self.breaker.allow())
+
+        # The probe never reports back, another is let through once reset_timeout has passed again
+        self.assertFalse(self.breaker.allow())
+        self.wait_out_reset()
+        self.assertTrue(self.breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+""" Run queue tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import shutil
+import sys
+import tempfile
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DbSqlite3Wrapper
+from ScraperFactory import ScraperFactory
+
+CONFIG = {
+    'enabled': 1,
+    'search_terms': 'bath taps',
+    'timeout': 30,
+    'last_updated': None,
+    'run_frequency': 1,
+    'validators': {'etag': None, 'last_modified': None, 'content_hash': None},
+    'rules': {'url': 'http://127.0.0.1/search'},
+}
+
+
+class TestRunQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbo = DbSqlite3Wrapper(os.path.join(self.directory, 'test.db'))
+        self.dbo.connect()
+        self.dbo.setup_scrapers_db()
+        self.factory = ScraperFactory(self.dbo)
+
+    def tearDown(self):
+        self.dbo.close()
+        shutil.rmtree(self.directory)
+
+    def test_pops_in_due_order(self):
+        for scraper_id, due_at in ((1, 30.0), (2, 10.0), (3, 20.0)):
+            self.factory._schedule(scraper_id, due_at)
+
+        self.assertEqual(list(self.factory._pop_due(25.0)), [2, 3])
+        self.assertEqual(list(self.factory._pop_due(25.0)), [])
+        self.assertEqual(list(self.factory._pop_due(30.0)), [1])
+
+    def test_rescheduled_entry_is_skipped(self):
+        self.factory._schedule(1, 10.0)
+        self.factory._schedule(1, 50.0)
+
+        # The entry at 10 is stale, the scraper only runs at its new due time
+        self.assertEqual(list(self.factory._pop_due(20.0)), [])
+        self.assertEqual(list(self.factory._pop_due(50.0)), [1])
+
+    def test_deleted_scraper_is_skipped(self):
+        self.factory._addScraper(1, CONFIG)
+        self.factory._addScraper(2, CONFIG)
+        self.factory._delScraper(1)
+
+        self.assertEqual(list(self.factory._pop_due(float('inf'))), [2])
+
+    def test_stale_entries_are_pruned(self):
+        for due_at in range(200):
+            self.factory._schedule(1, float(due_at))
+
+        # Rebuilt once the stale entries outnumber the live ones, leaving the one live entry
+        self.assertLessEqual(len(self.factory._run_queue), 2 * len(self.factory._due) + 64)
+        self.assertEqual(list(self.factory._pop_due(1000.0)), [1])
+
+    def test_cancelled_run_is_rescheduled(self):
+        self.factory._addScraper(1, CONFIG)
+        self.assertEqual(list(self.factory._pop_due(float('inf'))), [1])
+
+        # As left by a task cancelled on the event loop, result() raises a CancelledError which is not an Exception
+        loop = asyncio.new_event_loop()
+        try:
+            future = loop.create_future()
+            future.cancel()
+            self.factory._finished.put((1, self.factory._materialize(1), future))
+            self.factory._collect_finished()
+        finally:
+            loop.close()
+
+        self.assertIn(1, self.factory._due)
+        self.assertEqual(self.factory._running, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+""" Session pool tests
+
+    Run with: python -m unittest discover tests
+
+"""
+
+# Imports
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_pool import SessionPool
+
+
+class TestIdleEviction(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SessionPool(idle_timeout=0.01)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def borrow(self, url):
+        with self.pool.borrow(url) as session:
+            return session
+
+    def test_borrowed_session_is_not_evicted(self):
+        with self.pool.borrow('https://a.com/search') as session:
+            time.sleep(0.02)
+
+            # Another host's request evicts idle sessions, but not one still in use
+            self.borrow('https://b.com/search')
+            self.assertIs(self.borrow('https://a.com/other'), session)
+
+        self.assertEqual(self.pool.sessions[('https', 'a.com')][2], 0)
+
+    def test_idle_session_is_evicted(self):
+        session = self.borrow('https://a.com/search')
+        self.assertIs(self.borrow('https://a.com/other'), session)
+
+        time.sleep(0.02)
+        self.borrow('https://b.com/search')
+        self.assertNotIn(('https', 'a.com'), self.pool.sessions)
+        self.assertIsNot(self.borrow('https://a.com/search'), session)
+
+
+if __name__ == '__main__':
+    unittest.main()